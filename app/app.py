@@ -4,17 +4,23 @@ import streamlit as st
 from PIL import Image
 import numpy as np
 import warnings
-import torch
 import sys
 import json
 import io
+import uuid
+import logging
+from concurrent.futures import ThreadPoolExecutor
 
-from model import VLMModel
-from helpers import read_config, parse_product_info
-from comfyui import ComfyUIHandler
-from audio_transcriber import AudioTranscriber
+from helpers import read_config, parse_product_info, ProductInfoStream, get_max_new_tokens
+from caption_cache import CaptionCache
+from model_factories import build_registry
+from worker_pool import WorkerPool
+from pipeline import StageGraph
+from ingest import ImageIngestor
+import tracing
 
 config = read_config()
+logger = logging.getLogger('App')
 warnings.filterwarnings('ignore')
 
 st.set_page_config(
@@ -23,38 +29,102 @@ st.set_page_config(
     layout= "wide",
     )
 
-def scale_image(image, max_size=1024):
-    """Scale down image if it's larger than max_size while preserving aspect ratio"""
-    width, height = image.size
-    
-    if width > max_size or height > max_size:
-        ratio = min(max_size/width, max_size/height)
-        new_size = (int(width * ratio), int(height * ratio))
-        
-        image_copy = image.copy()
-        image_copy.thumbnail(new_size, Image.Resampling.LANCZOS)
-        return image_copy
-    return image
-
-def generate_image(data, image):
+def generate_image(data, image, source_bytes=None, color_image=None):
     try:
         if not isinstance(data, dict):
             logger.error("Invalid model output format")
             return image
             
         # Generate enhanced image using ComfyUI
-        enhanced_image = comfy_handler.generate_enhanced_image(image, data)
+        if pool is not None:
+            payload = {"image": image, "product_data": data, "source_bytes": source_bytes, "color_image": color_image}
+            enhanced_image = pool.result(pool.submit("enhance", payload, session_id=session_id))
+        else:
+            enhanced_image = registry.get("comfyui").generate_enhanced_image(image, data, source_bytes=source_bytes,
+                                                                             color_image=color_image)
         return enhanced_image if enhanced_image else image
         
     except Exception as e:
         logger.error(f"Error in generate_image: {e}")
         return image
 
+def start_enhancement(image, source_bytes=None, color_image=None):
+    """
+    Start uploading the image and detecting its colour while the caption is decoded.
+    The workflow is queued once the 'product_data' stage is set. Returns None with the
+    worker pool, where the enhance job runs the same stages in the worker.
+    """
+    if pool is not None:
+        return None
+    try:
+        graph = StageGraph()
+        graph.add("caption")
+        registry.get("comfyui").enhancement_graph(image, source_bytes=source_bytes, graph=graph, color_image=color_image)
+        return graph
+    except Exception as e:
+        logger.error(f"Error in start_enhancement: {e}")
+        return None
+
+def finish_enhancement(graph, data, image):
+    """Hand the parsed product data to the stage graph and wait for the enhanced image."""
+    try:
+        if not graph.done("product_data"):
+            if isinstance(data, dict) and data:
+                graph.set_result("product_data", data)
+            else:
+                graph.set_exception("product_data", ValueError("Invalid model output format"))
+        enhanced_image = graph.result("result")
+        return enhanced_image if enhanced_image else image
+    except Exception as e:
+        logger.error(f"Error in finish_enhancement: {e}")
+        return image
+    finally:
+        print("Enhancement stages: ", graph.report())
+        graph.close()
+
+def caption_stream(prompt, image, instruction, max_new_tokens, assisted=None):
+    """
+    Stream the model output, or return the cached answer for a repeated image and prompt.
+    assisted is the assisted decoding mode of the request, see ASSISTED_MODES in model.py.
+    """
+    # A quantised model answers differently, its profile settings are part of the key
+    model_settings = {name: value for name, value in config["model"].items() if name != "model_id" and value is not None}
+    key = caption_cache.make_key(
+        image,
+        instruction + prompt,
+        config["model"]["model_id"],
+        max_new_tokens=max_new_tokens,
+        **({"model_settings": model_settings} if model_settings else {})
+    ) if caption_cache else None
+    if key:
+        cached = caption_cache.get(key)
+        if cached is not None:
+            print("Caption cache hit: ", caption_cache.stats())
+            yield cached
+            return
+
+    if pool is not None:
+        payload = {"prompt": prompt, "image": image, "max_new_tokens": max_new_tokens, "instruction": instruction,
+                   "assisted": assisted}
+        stream = pool.stream(pool.submit("caption", payload, session_id=session_id))
+    else:
+        stream = registry.get("vlm").generate_stream(prompt, image, max_new_tokens=max_new_tokens,
+                                                     instruction=instruction, assisted=assisted)
+    description = ""
+    for text in stream:
+        description += text
+        yield text
+    # Only reached when the stream ended normally, a failed generation raises above
+    if key and description.strip():
+        caption_cache.put(key, description)
+
 def process_audio():
     if st.session_state.audio_recorder_output:
         audio_bytes = st.session_state.audio_recorder_output['bytes']
-        audio_bio = io.BytesIO(audio_bytes)
-        audio_text, audio_language = audio_transcriber(audio_bio)
+        if pool is not None:
+            audio_text, audio_language = pool.result(pool.submit("transcribe", {"audio": audio_bytes}, session_id=session_id))
+        else:
+            audio_text, audio_language = registry.get("whisper")(io.BytesIO(audio_bytes))
         st.session_state.transcribed_text = audio_text
         st.session_state.audio_language = audio_language
     
@@ -95,12 +165,66 @@ def change_lang():
     print("prompt is: ")
     print(st.session_state["prompt"])
 
-model = VLMModel(model_id = config["model"]["model_id"])
-comfy_handler = ComfyUIHandler(server_address="127.0.0.1:8188", workflow_path="workflow.json")
-audio_transcriber = AudioTranscriber(
-    model_path="deepdml/faster-whisper-large-v3-turbo-ct2",
-    device="cuda"
-)
+@st.cache_resource
+def start_tracing():
+    # Metrics are collected per process, the worker processes serve their own
+    tracing.configure(**config.get("tracing", {}))
+
+@st.cache_resource
+def get_ingestor():
+    return ImageIngestor(**config.get("ingest", {}))
+
+@st.cache_resource
+def get_registry():
+    # One registry per server process, kept across reruns and shared by the sessions.
+    # Models are built in the background or on first use, the page renders right away.
+    return build_registry(config)
+
+@st.cache_resource
+def get_worker_pool():
+    # Worker processes own the models, the sessions only submit jobs and poll them
+    workers_config = config.get("workers", {})
+    return WorkerPool(
+        processes=workers_config.get("processes", 1),
+        config=config,
+        registry_factory=workers_config.get("registry", "model_factories:build_registry")
+    ).start()
+
+start_tracing()
+pool = get_worker_pool() if config.get("workers", {}).get("enabled", False) else None
+registry = get_registry() if pool is None else None
+if "session_id" not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
+# Read here, the enhancement runs in an executor thread without access to st.session_state
+session_id = st.session_state.session_id
+cache_config = config.get("caption_cache", {})
+caption_cache = CaptionCache(
+    memory_entries=cache_config.get("memory_entries", 256),
+    disk_dir=cache_config.get("disk_dir", ".caption_cache"),
+    disk_max_mb=cache_config.get("disk_max_mb", 512)
+) if cache_config.get("enabled", True) else None
+
+MODEL_LABELS = {"vlm": "Görsel dil modeli", "whisper": "Ses tanıma", "comfyui": "ComfyUI"}
+STATE_LABELS = {"idle": "⚪ ilk kullanımda yüklenecek", "loading": "⏳ yükleniyor", "ready": "✅ hazır", "failed": "❌ yüklenemedi"}
+ASSISTED_LABELS = {"off": "Kapalı", "prompt_lookup": "İstemden kopyalama (n-gram)", "draft": "Taslak model"}
+assisted_config = config.get("generation", {}).get("assisted_decoding") or {}
+assisted_modes = ["off", "prompt_lookup"] + (["draft"] if assisted_config.get("draft_model_id") else [])
+with st.sidebar:
+    if pool is not None:
+        pool_stats = pool.stats()
+        st.caption(f"İşçi süreçleri: {pool_stats['ready']}/{pool_stats['workers']} hazır, "
+                   f"{pool_stats['busy']} meşgul, {pool_stats['queued']} iş sırada")
+    else:
+        for name, status in registry.status().items():
+            st.caption(f"{MODEL_LABELS.get(name, name)}: {STATE_LABELS[status['state']]}")
+    # Speeds up decoding of answers copying the description, the greedy answer stays the same
+    assisted = st.selectbox(
+        "Destekli çözümleme",
+        assisted_modes,
+        index=assisted_modes.index(assisted_config.get("mode") or "off") if (assisted_config.get("mode") or "off") in assisted_modes else 0,
+        format_func=ASSISTED_LABELS.get,
+        key="assisted"
+    )
 
 st.title("Teknofest-Trendyol Hackathon - Cogitators ✨")
 default_prompt= config["prompt"]
@@ -148,15 +272,21 @@ with st.container():
         
         user_desc = st.text_input("Lütfen, ürün açıklaması buraya yazın.", key="input")
         
+        # The language prompt is passed separately as the instruction so its cache can be reused
         if 'transcribed_text' in st.session_state:
-            prompt = st.session_state["prompt"] + f"\n prompt: {st.session_state.transcribed_text}"
+            prompt = f"\n prompt: {st.session_state.transcribed_text}"
         else:
-            prompt = st.session_state["prompt"] + f"\n prompt: {user_desc}"
+            prompt = f"\n prompt: {user_desc}"
         
         image_path = st.file_uploader("Ürün foroğrafı buraya yükleyin", type=["png","jpg","bmp","jpeg"], key=st.session_state["file_key"])
         if image_path is not None:
-            image = Image.open(image_path)
-            image = scale_image(image, max_size=1024)
+            # One decode, the image of each consumer is derived from it
+            ingested = get_ingestor().ingest(image_path.getvalue())
+            image = ingested.images["comfyui"]
+            vlm_image = ingested.images["vlm"]
+            color_image = ingested.images["color"]
+            # The file can be uploaded as it is when ingestion left it untouched
+            source_bytes = ingested.source_bytes
         col5, col6 = st.columns(2)
         with col5:
             button = st.button("Başla 🚀", disabled=st.session_state.button_pressed, use_container_width= True)
@@ -168,34 +298,75 @@ with st.container():
             if image_path is not None:
                 st.session_state.button_pressed = True
                 with st.spinner("Lütfen bekleyin.. Şuan yapay zeka sizin için çalışıyor 💫"):
-                    description = model.generate(prompt, image)
-                    print("Raw output is: ", description)
-                    entity_name = description
-                    data = parse_product_info(description)
-                    if isinstance(data, dict):
-                        entity_name = data.get("entity_name", "")
-                        product_title = data.get("product_title", "")
-                        product_description = data.get("product_description", description)
-                        print("entity_name is ", entity_name)
-                        title_placeholder = st.empty()
-                        title_placeholder.subheader("Ürün Başlığı")
-                        title_placeholder_text = st.empty()
-                        title_placeholder_text.code(product_title, language="markdown")
-                        desc_placeholder = st.empty()
-                        desc_placeholder.subheader("Ürün Açıklaması")
-                        desc_placeholder_text = st.empty()
-                        desc_placeholder_text.code(product_description, language="markdown")
-                    else:
-                        desc_placeholder = st.empty()
-                        desc_placeholder_text = st.empty()
-                        desc_placeholder.subheader("Üretilen Veri")
-                        desc_placeholder_text.code(description, language="markdown")
-                    st.session_state.button_pressed = False
-                    try:
-                        image_enhanced = generate_image(data, image) 
-                        st.session_state.image_generated = True
-                    except Exception as e:
-                        print("An error happened when enhancing the image: ", e)
+                    title_placeholder = st.empty()
+                    title_placeholder_text = st.empty()
+                    desc_placeholder = st.empty()
+                    desc_placeholder_text = st.empty()
+                    description = ""
+                    product_stream = ProductInfoStream()
+                    enhance_future = None
+                    # Upload and colour detection overlap the decoding of the caption
+                    enhancement = start_enhancement(image, source_bytes, color_image)
+                    with ThreadPoolExecutor(max_workers=1) as executor:
+                        max_new_tokens = get_max_new_tokens(config, st.session_state["prompt"])
+                        try:
+                            for text in caption_stream(
+                                prompt,
+                                vlm_image,
+                                st.session_state["prompt"],
+                                max_new_tokens,
+                                assisted
+                            ):
+                                description += text
+                                completed = product_stream.feed(text)
+                                if "entity_name" in completed:
+                                    # The enhancement only needs entity_name, queue it while the description is decoded
+                                    print("entity_name is ", completed["entity_name"])
+                                    if enhancement is not None:
+                                        enhancement.set_result("product_data", dict(product_stream.fields))
+                                    elif enhance_future is None:
+                                        enhance_future = executor.submit(generate_image, dict(product_stream.fields), image, source_bytes, color_image)
+                                if "product_title" in completed:
+                                    title_placeholder.subheader("Ürün Başlığı")
+                                    title_placeholder_text.code(completed["product_title"], language="markdown")
+                        except Exception as e:
+                            # A failed caption is not cached, shown or waited on by the enhancement
+                            logger.error(f"Caption generation failed: {e}")
+                            if enhancement is not None:
+                                if not enhancement.done("product_data"):
+                                    enhancement.set_exception("product_data", e)
+                                enhancement.close()
+                            st.session_state.button_pressed = False
+                            st.error("Ürün açıklaması üretilemedi, lütfen tekrar deneyin.")
+                            st.stop()
+                        product_stream.finish()
+                        if enhancement is not None:
+                            enhancement.set_result("caption", description)
+                        print("Raw output is: ", description)
+                        data = product_stream.fields
+                        if "entity_name" not in data:
+                            data = parse_product_info("```yaml" + description)
+                        if isinstance(data, dict) and data:
+                            product_title = data.get("product_title", "")
+                            product_description = data.get("product_description", description)
+                            title_placeholder.subheader("Ürün Başlığı")
+                            title_placeholder_text.code(product_title, language="markdown")
+                            desc_placeholder.subheader("Ürün Açıklaması")
+                            desc_placeholder_text.code(product_description, language="markdown")
+                        else:
+                            desc_placeholder.subheader("Üretilen Veri")
+                            desc_placeholder_text.code(description, language="markdown")
+                        st.session_state.button_pressed = False
+                        try:
+                            if enhancement is not None:
+                                image_enhanced = finish_enhancement(enhancement, data, image)
+                            else:
+                                if enhance_future is None:
+                                    enhance_future = executor.submit(generate_image, data, image, source_bytes, color_image)
+                                image_enhanced = enhance_future.result()
+                            st.session_state.image_generated = True
+                        except Exception as e:
+                            print("An error happened when enhancing the image: ", e)
                     
         else:
             st.warning('⚠ Please upload your Image!')
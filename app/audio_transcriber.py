@@ -1,33 +1,103 @@
-from faster_whisper import WhisperModel
+from faster_whisper import WhisperModel, BatchedInferencePipeline, decode_audio
 import io
+import re
+import time
 import logging
+import numpy as np
 
+import tracing
 from helpers import singleton
+from residency import ResidencyManager, CTranslate2Resident
+
+SAMPLING_RATE = 16000
+
+# Inference settings per deployment target, any field can be overridden.
+# batch_size 0 disables the batched pipeline, it needs vad_filter for clips over 30 seconds.
+PROFILES = {
+    "gpu": {"compute_type": "float16", "cpu_threads": 0, "beam_size": 5, "vad_filter": True, "batch_size": 16},
+    "cpu": {"compute_type": "int8", "cpu_threads": 0, "beam_size": 1, "vad_filter": True, "batch_size": 8},
+    "cpu_accurate": {"compute_type": "int8_float32", "cpu_threads": 0, "beam_size": 5, "vad_filter": True, "batch_size": 0},
+}
 
 @singleton
 class AudioTranscriber:
-    def __init__(self, model_path="large-v3", device="cpu"):
+    def __init__(self, model_path="large-v3", device="cpu", residency_manager=None, memory_gb=1.6,
+                 profile=None, batched_min_seconds=30.0, vad_parameters=None, **overrides):
         """
         Initialize the AudioTranscriber with the specified model configuration.
         
         Args:
             model_path (str): Path or size of the model to use
             device (str): Device to run the model on ('cuda' or 'cpu')
-            compute_type (str): Computation type ('float16', 'int8_float16', or 'int8')
+            residency_manager (ResidencyManager): Manager shared with the other heavy models
+            memory_gb (float): Approximate device memory used by the model, for 'on_pressure'
+            profile (str): Key of PROFILES, defaults to 'gpu' on cuda and 'cpu' otherwise
+            batched_min_seconds (float): Clips at least this long use the batched pipeline
+            vad_parameters (dict): faster-whisper VadOptions, e.g. min_silence_duration_ms
+            overrides: Profile fields to override: compute_type ('float16', 'int8_float32'
+                or 'int8'), cpu_threads (0 lets CTranslate2 decide), beam_size, vad_filter, batch_size
         """
         self.logger = logging.getLogger(__name__)
         self.device = device
+        profile = profile or ("gpu" if device == "cuda" else "cpu")
+        if profile not in PROFILES:
+            raise ValueError(f"Unknown transcription profile '{profile}', expected one of {tuple(PROFILES)}")
+        unknown = set(overrides) - set(PROFILES[profile])
+        if unknown:
+            raise ValueError(f"Unknown transcription settings: {sorted(unknown)}")
+        self.profile = profile
+        self.settings = dict(PROFILES[profile], **overrides)
+        self.batched_min_seconds = batched_min_seconds
+        self.vad_parameters = vad_parameters
+        self.last_stats = None
         try:
             self.model = WhisperModel(
                 model_path,
                 device=device,
-                compute_type="float16"
+                compute_type=self.settings["compute_type"],
+                cpu_threads=self.settings["cpu_threads"]
+            )
+            self.batched_model = BatchedInferencePipeline(model=self.model) if self.settings["batch_size"] else None
+            self.logger.info(f"Successfully loaded Whisper model: {model_path} with profile {profile} {self.settings}")
+            self.residency = residency_manager or ResidencyManager()
+            self.residency.register(
+                "whisper",
+                CTranslate2Resident(self.model.model, int(memory_gb * 1024**3)),
+                loaded=True
             )
-            self.logger.info(f"Successfully loaded Whisper model: {model_path}")
         except Exception as e:
             self.logger.error(f"Failed to load Whisper model: {e}")
             raise
 
+    def run(self, audio, language=None):
+        """
+        Transcribe decoded or encoded audio with the profile settings.
+
+        Clips of at least batched_min_seconds go through the batched pipeline, which
+        transcribes the speech segments found by the VAD in parallel.
+
+        Returns:
+            Tuple of the segments generator, the TranscriptionInfo and the clip duration in seconds
+        """
+        if not hasattr(audio, "shape"):
+            audio = decode_audio(audio, sampling_rate=SAMPLING_RATE)
+        duration = audio.shape[0] / SAMPLING_RATE
+        options = {
+            "language": language,
+            "beam_size": self.settings["beam_size"],
+            "vad_filter": self.settings["vad_filter"],
+            "vad_parameters": self.vad_parameters,
+        }
+        if self.batched_model is not None and self.settings["vad_filter"] and duration >= self.batched_min_seconds:
+            segments, info = self.batched_model.transcribe(audio, batch_size=self.settings["batch_size"], **options)
+        else:
+            segments, info = self.model.transcribe(audio, **options)
+        return segments, info, duration
+
+    def stream(self, **kwargs) -> "StreamingTranscription":
+        """Start an incremental transcription fed with audio chunks, see StreamingTranscription."""
+        return StreamingTranscription(self, **kwargs)
+
     def transcribe(self, audio_data: io.BytesIO) -> str:
         """
         Transcribe audio data to text.
@@ -44,16 +114,27 @@ class AudioTranscriber:
         
         try:
             # Transcribe the audio
-            segments, info = self.model.transcribe(audio_data, beam_size=5)
-            
-            # Log detection info
-            self.logger.info(
-                f"Detected language '{info.language}' with probability {info.language_probability}"
-            )
-            
-            # Combine all segments into a single text
-            text = " ".join(segment.text.strip() for segment in segments)
-            language = info.language
+            with tracing.span("whisper.transcribe", profile=self.profile) as span, self.residency.use("whisper"):
+                start = time.perf_counter()
+                segments, info, duration = self.run(audio_data)
+
+                # Log detection info
+                self.logger.info(
+                    f"Detected language '{info.language}' with probability {info.language_probability}"
+                )
+                
+                # Combine all segments into a single text
+                text = " ".join(segment.text.strip() for segment in segments)
+                language = info.language
+
+                elapsed = time.perf_counter() - start
+                self.last_stats = {
+                    "audio_seconds": duration,
+                    "seconds": elapsed,
+                    "real_time_factor": elapsed / duration if duration else 0.0,
+                }
+                span.set(language=language, **self.last_stats)
+                self.logger.info(f"Transcribed {duration:.1f}s of audio in {elapsed:.2f}s")
             
         except Exception as e:
             self.logger.error(f"Error during transcription: {e}")
@@ -70,4 +151,165 @@ class AudioTranscriber:
         Returns:
             str: Transcribed text
         """
-        return self.transcribe(audio_data)
\ No newline at end of file
+        return self.transcribe(audio_data)
+
+
+def _normalize(word):
+    return re.sub(r"[^\w]", "", word.lower())
+
+
+class StreamingTranscription:
+    def __init__(self, transcriber, min_chunk_seconds=1.0, window_seconds=15.0,
+                 language=None, language_min_seconds=1.0, on_language=None):
+        """
+        Transcription of a recording that is still in progress.
+
+        Chunks are appended to a sliding window that is re-transcribed with word timestamps
+        once at least min_chunk_seconds of new audio arrived. Words on which two consecutive
+        hypotheses agree are committed and never change again, the window is then trimmed
+        to the audio after the last committed word, so finish() only has to transcribe that
+        uncommitted tail. The committed text is passed as the prompt for context.
+
+        Args:
+            transcriber (AudioTranscriber): Loaded model and profile settings to use
+            min_chunk_seconds (float): New audio needed before the window is transcribed again
+            window_seconds (float): Window length after which words are committed even
+                without agreement, bounds the audio transcribed per step
+            language (str): Language code, detected from the first audio when None
+            language_min_seconds (float): Audio needed for the language detection
+            on_language (callable): Called with the language code as soon as it is known
+        """
+        self.transcriber = transcriber
+        self.min_chunk_seconds = min_chunk_seconds
+        self.window_seconds = window_seconds
+        self.language_min_seconds = language_min_seconds
+        self.on_language = on_language
+        self.language = language
+        self.logger = transcriber.logger
+
+        self.buffer = np.zeros(0, dtype=np.float32)
+        # Position of buffer[0] in the recording, in seconds
+        self.buffer_offset = 0.0
+        self.unprocessed_seconds = 0.0
+        self.committed = []
+        self.previous = []
+        self.tentative = []
+
+    @property
+    def committed_end(self):
+        return self.committed[-1][1] if self.committed else 0.0
+
+    def text(self, words):
+        return "".join(word for _, _, word in words).strip()
+
+    def add_chunk(self, chunk, sample_rate=SAMPLING_RATE):
+        """
+        Append audio and transcribe the window when enough new audio has arrived.
+
+        Args:
+            chunk: Mono float32 samples in [-1, 1], int16 samples, or raw int16 PCM bytes
+            sample_rate (int): Sample rate of the chunk, resampled to 16 kHz
+
+        Returns:
+            Tuple of the stable text, which only grows, and the tentative text after it
+        """
+        if isinstance(chunk, (bytes, bytearray)):
+            chunk = np.frombuffer(chunk, dtype=np.int16)
+        chunk = np.asarray(chunk)
+        if chunk.dtype == np.int16:
+            chunk = chunk.astype(np.float32) / 32768.0
+        chunk = chunk.astype(np.float32, copy=False)
+        if sample_rate != SAMPLING_RATE:
+            positions = np.arange(0, len(chunk), sample_rate / SAMPLING_RATE)
+            chunk = np.interp(positions, np.arange(len(chunk)), chunk).astype(np.float32)
+        self.buffer = np.concatenate([self.buffer, chunk])
+        self.unprocessed_seconds += len(chunk) / SAMPLING_RATE
+
+        if self.language is None and len(self.buffer) >= self.language_min_seconds * SAMPLING_RATE:
+            self.detect_language()
+        if self.unprocessed_seconds >= self.min_chunk_seconds:
+            self.process()
+        return self.text(self.committed), self.text(self.tentative)
+
+    def detect_language(self):
+        with self.transcriber.residency.use("whisper"):
+            language, probability, _ = self.transcriber.model.detect_language(audio=self.buffer)
+        self.language = language
+        self.logger.info(f"Detected language '{language}' with probability {probability} from the first chunk")
+        if self.on_language is not None:
+            self.on_language(language)
+
+    def hypothesis(self):
+        """Words of the current window after the committed ones, with times in the recording."""
+        with self.transcriber.residency.use("whisper"):
+            segments, info = self.transcriber.model.transcribe(
+                self.buffer,
+                language=self.language,
+                beam_size=self.transcriber.settings["beam_size"],
+                vad_filter=self.transcriber.settings["vad_filter"],
+                vad_parameters=self.transcriber.vad_parameters,
+                word_timestamps=True,
+                condition_on_previous_text=False,
+                initial_prompt=self.text(self.committed)[-200:] or None
+            )
+            words = [
+                (self.buffer_offset + word.start, self.buffer_offset + word.end, word.word)
+                for segment in segments for word in (segment.words or [])
+            ]
+        if self.language is None:
+            self.language = info.language
+        words = [word for word in words if word[0] >= self.committed_end - 0.1]
+        # Drop words repeated from the end of the committed text at the window boundary
+        tail = [_normalize(word) for _, _, word in self.committed[-5:]]
+        for n in range(min(len(tail), len(words)), 0, -1):
+            if tail[-n:] == [_normalize(word) for _, _, word in words[:n]]:
+                words = words[n:]
+                break
+        return words
+
+    def process(self):
+        self.unprocessed_seconds = 0.0
+        words = self.hypothesis()
+        agreed = 0
+        while (agreed < min(len(words), len(self.previous))
+               and _normalize(words[agreed][2]) == _normalize(self.previous[agreed][2])):
+            agreed += 1
+        self.committed.extend(words[:agreed])
+        self.previous = self.tentative = words[agreed:]
+
+        buffer_seconds = len(self.buffer) / SAMPLING_RATE
+        until = self.committed_end
+        if self.committed_end <= self.buffer_offset and buffer_seconds > self.window_seconds:
+            # Nothing agreed for a whole window, keep the older words as they are
+            cut = self.buffer_offset + buffer_seconds - self.window_seconds / 2
+            forced = [word for word in self.tentative if word[1] <= cut]
+            self.committed.extend(forced)
+            self.previous = self.tentative = self.tentative[len(forced):]
+            # Silence or audio without words commits nothing, the window is still trimmed,
+            # up to the first word that is kept
+            until = max(self.committed_end, min([cut] + [word[0] for word in self.tentative]))
+        self.trim(until)
+
+    def trim(self, until):
+        """Drop the audio before `until` seconds from the window."""
+        samples = int((until - self.buffer_offset) * SAMPLING_RATE)
+        if samples > 0:
+            self.buffer = self.buffer[samples:]
+            self.buffer_offset += samples / SAMPLING_RATE
+
+    def finish(self):
+        """
+        Transcribe the rest of the window and close the stream.
+
+        Returns:
+            Tuple of the full text and the language, like AudioTranscriber.transcribe
+        """
+        try:
+            if len(self.buffer) and (self.unprocessed_seconds > 0 or self.tentative):
+                self.committed.extend(self.hypothesis())
+        except Exception as e:
+            self.logger.error(f"Error during streaming transcription: {e}")
+            self.committed.extend(self.tentative)
+        self.previous = self.tentative = []
+        self.buffer = np.zeros(0, dtype=np.float32)
+        return self.text(self.committed), self.language or "tr"
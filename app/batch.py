@@ -0,0 +1,389 @@
+"""
+Headless captioning and enhancement of a product catalogue.
+
+The input is a directory of images or a JSONL/CSV manifest with an 'image' column
+(relative to the manifest), an optional 'description' used as the user prompt and an
+optional 'id'. Every finished item is appended to <output>/results.jsonl and its
+enhanced image written to <output>/images. The results file is the checkpoint: a
+rerun skips the items already done and retries the failed ones.
+
+    python batch.py photos/ --output out/
+    python batch.py manifest.jsonl --output out/ --enhance
+    python fake_comfyui.py --port 8189 &
+    python batch.py manifest.csv --output out/ --enhance \\
+        --registry stub_models:build_stub_registry --comfyui-server 127.0.0.1:8189
+"""
+import os
+import csv
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import functools
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import tracing
+from helpers import read_config, parse_product_info, get_max_new_tokens
+from ingest import ImageIngestor, IngestedImage
+from worker_pool import resolve
+
+logger = logging.getLogger('Batch')
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".webp")
+LANGUAGE_PROMPTS = {"tr": "prompt", "en": "en_prompt"}
+
+
+def read_items(path: str) -> List[Dict[str, Any]]:
+    """
+    Items of a directory (recursive, id is the relative path) or a .jsonl/.csv manifest.
+
+    Args:
+        path (str): Image directory or manifest file
+    """
+    if os.path.isdir(path):
+        items = []
+        for root, _, files in os.walk(path):
+            for file_name in files:
+                if file_name.lower().endswith(IMAGE_EXTENSIONS):
+                    image_path = os.path.join(root, file_name)
+                    items.append({"id": os.path.relpath(image_path, path), "image": image_path, "description": ""})
+        return sorted(items, key=lambda item: item["id"])
+
+    with open(path, newline="", encoding="utf-8") as file:
+        if path.endswith(".jsonl"):
+            rows = [json.loads(line) for line in file if line.strip()]
+        elif path.endswith(".csv"):
+            rows = list(csv.DictReader(file))
+        else:
+            raise ValueError(f"Unknown manifest format '{path}', expected a directory, .jsonl or .csv")
+
+    base_dir = os.path.dirname(os.path.abspath(path))
+    items = []
+    for line_number, row in enumerate(rows, 1):
+        if not row.get("image"):
+            raise ValueError(f"{path}: row {line_number} has no 'image'")
+        items.append({
+            "id": str(row.get("id") or row["image"]),
+            "image": os.path.join(base_dir, row["image"]),
+            "description": row.get("description") or ""
+        })
+    return items
+
+
+class Checkpoint:
+    def __init__(self, path: str):
+        """
+        Append-only results file, one JSON record per item. The last record of an id
+        counts, an id is done once it has an 'ok' record. A line cut off by a crash is
+        dropped when the file is opened again.
+
+        Args:
+            path (str): results.jsonl
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.done = set()
+        self.failed = set()
+        # Records appended since the file was opened, by status
+        self.counts = {"ok": 0, "error": 0}
+        if os.path.exists(path):
+            self._load()
+        self.file = open(path, "a", encoding="utf-8")
+
+    def _load(self) -> None:
+        with open(self.path, "rb") as file:
+            data = file.read()
+        complete = data[:data.rfind(b"\n") + 1]
+        if len(complete) < len(data):
+            logger.warning(f"Dropping a truncated record at the end of {self.path}")
+            with open(self.path, "r+b") as file:
+                file.truncate(len(complete))
+        for line in complete.decode("utf-8").splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record.get("status") == "ok":
+                self.done.add(record["id"])
+                self.failed.discard(record["id"])
+            else:
+                self.failed.add(record["id"])
+                self.done.discard(record["id"])
+
+    def append(self, record: Dict[str, Any]) -> None:
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.counts[record["status"]] += 1
+            if record["status"] == "ok":
+                self.done.add(record["id"])
+                self.failed.discard(record["id"])
+            else:
+                self.failed.add(record["id"])
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class BatchRunner:
+    def __init__(self, registry, config: Dict[str, Any], output_dir: str, enhance: bool = False,
+                 language: str = "tr", batch_size: int = 4, io_workers: int = 4,
+                 ingestor: Optional[ImageIngestor] = None, assisted: Optional[str] = None):
+        """
+        Captions the items in batches on the calling thread. Reading images and writing
+        the outputs run on a thread pool, so the model does not wait on files or ComfyUI.
+        With comfyui.concurrency set the enhancement runs on the async ComfyUI client
+        (comfyui_async.py), with up to that many jobs in flight and no more than
+        comfyui.max_queue_depth prompts in the server queue. A pool of servers
+        (comfyui.servers) routes the jobs itself, they then run on the thread pool.
+
+        Args:
+            registry (ModelRegistry): Provides 'vlm' and, with enhance, 'comfyui'
+            config (dict): Parsed config.yaml, for the prompts and token budgets
+            output_dir (str): Gets results.jsonl and images/
+            enhance (bool): Enhance the images with ComfyUI
+            language (str): 'tr' or 'en', selects the instruction prompt
+            batch_size (int): Images per generate_batch call
+            io_workers (int): Threads for loading, enhancing and saving
+            ingestor (ImageIngestor): Decodes the images and derives the VLM, ComfyUI and colour sizes
+            assisted (str): Assisted decoding mode (see ASSISTED_MODES in model.py), only applied with batch_size 1
+        """
+        if language not in LANGUAGE_PROMPTS:
+            raise ValueError(f"Unknown language '{language}', expected one of {list(LANGUAGE_PROMPTS)}")
+        self.registry = registry
+        self.config = config
+        self.output_dir = output_dir
+        self.image_dir = os.path.join(output_dir, "images")
+        self.enhance = enhance
+        self.instruction = config[LANGUAGE_PROMPTS[language]]
+        self.max_new_tokens = get_max_new_tokens(config, self.instruction)
+        self.batch_size = batch_size
+        self.io_workers = io_workers
+        self.ingestor = ingestor or ImageIngestor()
+        self.assisted = assisted
+        os.makedirs(self.image_dir, exist_ok=True)
+        self.checkpoint = Checkpoint(os.path.join(output_dir, "results.jsonl"))
+        comfyui_config = config.get("comfyui", {})
+        self.enhance_concurrency = None if comfyui_config.get("servers") else comfyui_config.get("concurrency")
+        self.max_queue_depth = comfyui_config.get("max_queue_depth", 8)
+        self.enhancer = None
+
+    def load(self, item: Dict[str, Any]) -> IngestedImage:
+        with open(item["image"], "rb") as file:
+            return self.ingestor.ingest(file.read())
+
+    def prefetch(self, executor: ThreadPoolExecutor, items: List[Dict[str, Any]]) -> Iterator[Tuple[Dict[str, Any], Any]]:
+        """Yield the items with their loaded images, reading a few batches ahead."""
+        pending = deque()
+        items = iter(items)
+        for item in items:
+            pending.append((item, executor.submit(self.load, item)))
+            if len(pending) >= 2 * self.batch_size:
+                break
+        while pending:
+            item, future = pending.popleft()
+            next_item = next(items, None)
+            if next_item is not None:
+                pending.append((next_item, executor.submit(self.load, next_item)))
+            yield item, future
+
+    def batches(self, loaded: Iterable[Tuple[Dict[str, Any], Any]]) -> Iterator[List[Tuple[Dict[str, Any], Any]]]:
+        batch = []
+        for item, future in loaded:
+            try:
+                batch.append((item, future.result()))
+            except Exception as e:
+                self.record(item, error=f"Could not read image: {e}")
+                continue
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def caption(self, batch: List[Tuple[Dict[str, Any], Any]]) -> List[str]:
+        prompts = [f"\n prompt: {item['description']}" for item, _ in batch]
+        images = [ingested.images["vlm"] for _, ingested in batch]
+        return self.registry.get("vlm").generate_batch(
+            prompts, images, max_new_tokens=self.max_new_tokens, instruction=self.instruction, assisted=self.assisted
+        )
+
+    def product_data(self, item: Dict[str, Any], raw_output: str, started: float) -> Optional[Dict[str, Any]]:
+        """Parsed product fields of a caption, None after recording an invalid one."""
+        data = parse_product_info("```yaml" + raw_output)
+        if not isinstance(data, dict) or not data:
+            self.record(item, raw_output=raw_output, started=started, error="Invalid model output format")
+            return None
+        return data
+
+    def save(self, item: Dict[str, Any], enhanced_image) -> str:
+        if enhanced_image is None:
+            raise RuntimeError("no image returned")
+        enhanced_path = os.path.join(self.image_dir, self.output_name(item))
+        enhanced_image.save(enhanced_path)
+        return enhanced_path
+
+    def finish(self, item: Dict[str, Any], ingested: IngestedImage, raw_output: str, started: float) -> None:
+        """Enhance and save the image of a captioned item, then record it."""
+        data = self.product_data(item, raw_output, started)
+        if data is None:
+            return
+        enhanced_path = None
+        if self.enhance:
+            try:
+                enhanced_image = self.registry.get("comfyui").generate_enhanced_image(
+                    ingested.images["comfyui"], data, source_bytes=ingested.source_bytes,
+                    color_image=ingested.images["color"]
+                )
+                enhanced_path = self.save(item, enhanced_image)
+            except Exception as e:
+                self.record(item, raw_output=raw_output, product=data, started=started, error=f"Enhancement failed: {e}")
+                return
+        self.record(item, raw_output=raw_output, product=data, enhanced_path=enhanced_path, started=started)
+
+    async def finish_async(self, item: Dict[str, Any], ingested: IngestedImage, raw_output: str, started: float,
+                           executor: ThreadPoolExecutor) -> None:
+        """finish with the enhancement on the async client, parsing, saving and recording on the I/O threads."""
+        loop = asyncio.get_running_loop()
+        data = await loop.run_in_executor(executor, self.product_data, item, raw_output, started)
+        if data is None:
+            return
+        try:
+            enhanced_image = await self.enhancer.enhance(ingested.images["comfyui"], data, source_bytes=ingested.source_bytes,
+                                                         color_image=ingested.images["color"])
+            enhanced_path = await loop.run_in_executor(executor, self.save, item, enhanced_image)
+        except Exception as e:
+            await loop.run_in_executor(executor, functools.partial(
+                self.record, item, raw_output=raw_output, product=data, started=started, error=f"Enhancement failed: {e}"))
+            return
+        await loop.run_in_executor(executor, functools.partial(
+            self.record, item, raw_output=raw_output, product=data, enhanced_path=enhanced_path, started=started))
+
+    def start_enhancer(self) -> None:
+        from comfyui_async import AsyncComfyUIClient, EnhancementLoop
+        handler = self.registry.get("comfyui")
+        client = AsyncComfyUIClient(handler.server_address, max_queue_depth=self.max_queue_depth, handler=handler)
+        self.enhancer = EnhancementLoop(client, self.enhance_concurrency).start()
+
+    def output_name(self, item: Dict[str, Any]) -> str:
+        stem = os.path.splitext(os.path.basename(item["id"]))[0]
+        return f"{stem}_{hashlib.sha1(item['id'].encode()).hexdigest()[:8]}.png"
+
+    def record(self, item: Dict[str, Any], raw_output: Optional[str] = None, product: Optional[Dict[str, Any]] = None,
+               enhanced_path: Optional[str] = None, started: Optional[float] = None, error: Optional[str] = None) -> None:
+        status = "error" if error else "ok"
+        if error:
+            logger.error(f"{item['id']}: {error}")
+        self.checkpoint.append({
+            "id": item["id"],
+            "image": item["image"],
+            "status": status,
+            "error": error,
+            "product": product,
+            "raw_output": raw_output,
+            "enhanced_image": os.path.relpath(enhanced_path, self.output_dir) if enhanced_path else None,
+            "seconds": round(time.perf_counter() - started, 3) if started else None
+        })
+
+    def run(self, items: List[Dict[str, Any]]) -> Dict[str, int]:
+        """Process the items that are not done yet. Returns the ok/error/skipped counts."""
+        pending_items = [item for item in items if item["id"] not in self.checkpoint.done]
+        skipped = len(items) - len(pending_items)
+        logger.info(f"{len(pending_items)} items to process, {skipped} already done")
+        start = time.perf_counter()
+        in_flight = set()
+        executor = ThreadPoolExecutor(self.io_workers, thread_name_prefix="batch-io")
+        # Items waiting to be finished while the next batch is captioned
+        max_in_flight = 2 * max(self.io_workers, self.enhance_concurrency or 0)
+        try:
+            if self.enhance and self.enhance_concurrency and pending_items:
+                self.start_enhancer()
+            for batch in self.batches(self.prefetch(executor, pending_items)):
+                started = time.perf_counter()
+                try:
+                    outputs = self.caption(batch)
+                except Exception as e:
+                    for item, _ in batch:
+                        self.record(item, started=started, error=f"Captioning failed: {e}")
+                    continue
+                for (item, ingested), raw_output in zip(batch, outputs):
+                    if self.enhancer is not None:
+                        in_flight.add(self.enhancer.run(self.finish_async(item, ingested, raw_output, started, executor)))
+                    else:
+                        in_flight.add(executor.submit(self.finish, item, ingested, raw_output, started))
+                # Keep the number of finishing items bounded while the next batch is captioned
+                while len(in_flight) > max_in_flight:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    self.raise_errors(done)
+                processed = sum(self.checkpoint.counts.values())
+                logger.info(f"{processed}/{len(pending_items)} processed, "
+                            f"{processed / (time.perf_counter() - start):.2f} items/s")
+            done, _ = wait(in_flight)
+            self.raise_errors(done)
+        finally:
+            if self.enhancer is not None:
+                self.enhancer.close()
+                self.enhancer = None
+            executor.shutdown(wait=True, cancel_futures=True)
+            self.checkpoint.close()
+        return dict(self.checkpoint.counts, skipped=skipped)
+
+    def raise_errors(self, futures) -> None:
+        # finish records its own failures, anything left is a bug or an I/O error on the output
+        for future in futures:
+            future.result()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="Image directory or .jsonl/.csv manifest")
+    parser.add_argument("--output", required=True, help="Directory for results.jsonl and images/")
+    parser.add_argument("--config", default="config.yaml")
+    parser.add_argument("--enhance", action="store_true", help="Enhance the images with ComfyUI")
+    parser.add_argument("--language", choices=list(LANGUAGE_PROMPTS), default=None)
+    parser.add_argument("--batch-size", type=int, default=None)
+    parser.add_argument("--io-workers", type=int, default=None)
+    parser.add_argument("--registry", default="model_factories:build_registry",
+                        help="'module:function' building the model registry, e.g. stub_models:build_stub_registry")
+    parser.add_argument("--comfyui-server", nargs="+", default=None,
+                        help="Overrides comfyui.server_address, several servers are used as a pool (comfyui.servers)")
+    parser.add_argument("--assisted", choices=["off", "prompt_lookup", "draft"], default=None,
+                        help="Assisted decoding mode, needs --batch-size 1. generation.assisted_decoding.mode by default")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    config = read_config(args.config)
+    if args.comfyui_server:
+        config.setdefault("comfyui", {})["server_address"] = args.comfyui_server[0]
+        config["comfyui"]["servers"] = args.comfyui_server if len(args.comfyui_server) > 1 else []
+    batch_config = config.get("batch", {})
+    tracing.configure(**config.get("tracing", {}))
+    registry = resolve(args.registry)(config, warm_up=["vlm", "comfyui"] if args.enhance else ["vlm"])
+    runner = BatchRunner(
+        registry,
+        config,
+        args.output,
+        enhance=args.enhance,
+        language=args.language or batch_config.get("language", "tr"),
+        batch_size=args.batch_size or batch_config.get("batch_size", 4),
+        io_workers=args.io_workers or batch_config.get("io_workers", 4),
+        ingestor=ImageIngestor(**config.get("ingest", {})),
+        assisted=args.assisted
+    )
+    counts = runner.run(read_items(args.input))
+    if tracing.enabled():
+        with open(os.path.join(args.output, "metrics.prom"), "w") as file:
+            file.write(tracing.prometheus())
+        with open(os.path.join(args.output, "metrics.json"), "w") as file:
+            file.write(tracing.to_json())
+    print(f"Done: {counts['ok']} ok, {counts['error']} failed, {counts['skipped']} already done")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Tokens per second and acceptance rate of assisted decoding against plain decoding.
+
+Every request is captioned with each mode by VLMModel.generate, greedily so that the
+answers can be compared: assisted decoding must give the same answer as plain decoding.
+Reported per mode: generated tokens per second of the whole generate call, the speedup
+over plain decoding, the share of proposed candidate tokens the model accepted, tokens
+per forward pass and the answers identical to the plain ones. Plain decoding uses the
+prefix cache, assisted decoding cannot, so prefill differences are part of the result.
+
+The model of config.yaml is used, or with --tiny a random tiny_vlm checkpoint and
+draft model, which only checks the mechanics: random weights copy little text.
+    python -m benchmarks.assisted_decoding --images photos/ --modes off prompt_lookup
+    python -m benchmarks.assisted_decoding --tiny
+"""
+import os
+import shutil
+import logging
+import argparse
+import tempfile
+from collections import defaultdict
+from typing import Any, Dict, List
+
+from benchmarks.color_backends import generate_images
+from helpers import read_config, get_max_new_tokens
+from ingest import ImageIngestor
+from model_factories import build_vlm
+from residency import ResidencyManager
+
+# Seller descriptions like the app gets, with the sizes and names the answer copies
+DESCRIPTIONS = [
+    "700 gram kuşburnu marmelat yüzde yüz doğal açtıktan sonra dolaba koyun",
+    "100% pamuklu kot pantolon mavi slim fit 32 beden",
+    "Karaca 6 parça granit tencere seti 24 cm indüksiyon uyumlu",
+    "Arçelik 1800 W su ısıtıcısı 1.7 litre paslanmaz çelik",
+]
+
+
+def load_images(directory: str, ingestor: ImageIngestor) -> List[Any]:
+    names = sorted(name for name in os.listdir(directory)
+                   if name.lower().endswith((".jpg", ".jpeg", ".png", ".bmp", ".webp")))
+    images = []
+    for name in names:
+        with open(os.path.join(directory, name), "rb") as file:
+            images.append(ingestor.ingest(file.read()).images["vlm"])
+    return images
+
+
+def run_modes(vlm, requests, instruction: str, max_new_tokens: int, modes: List[str]) -> Dict[str, Dict[str, Any]]:
+    totals = defaultdict(lambda: defaultdict(float))
+    plain_answers = {}
+    for index, (description, image) in enumerate(requests):
+        prompt = f"\n prompt: {description}"
+        for mode in modes:
+            answer = vlm.generate(prompt, image, max_new_tokens, instruction=instruction, assisted=mode)
+            stats = vlm.last_generation_stats
+            total = totals[mode]
+            total["requests"] += 1
+            total["new_tokens"] += sum(stats["new_tokens"])
+            total["seconds"] += stats["seconds"]
+            total["proposed_tokens"] += stats.get("proposed_tokens") or 0
+            total["accepted_tokens"] += stats.get("accepted_tokens") or 0
+            total["forwards"] += stats.get("forwards") or sum(stats["new_tokens"])
+            if mode == "off":
+                plain_answers[index] = answer
+            total["identical"] += plain_answers.get(index) == answer
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", default=None, help="Directory of product photos, generated images by default")
+    parser.add_argument("--descriptions", nargs="+", default=DESCRIPTIONS)
+    parser.add_argument("--requests", type=int, default=4, help="Requests when the images are generated")
+    parser.add_argument("--modes", nargs="+", default=None, choices=["off", "prompt_lookup", "draft"],
+                        help="off, prompt_lookup and draft when a draft model is configured by default")
+    parser.add_argument("--language", choices=["prompt", "en_prompt"], default="prompt")
+    parser.add_argument("--max-new-tokens", type=int, default=None, help="generation.max_new_tokens by default")
+    parser.add_argument("--config", default="config.yaml")
+    parser.add_argument("--tiny", action="store_true", help="Random tiny checkpoint and draft model instead of model_id")
+    parser.add_argument("--sample", action="store_true", help="Keep the sampling of the generation config")
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    config = read_config(args.config)
+    assisted_config = config.setdefault("generation", {}).setdefault("assisted_decoding", {}) or {}
+    directory = tempfile.mkdtemp(prefix="assisted_decoding-")
+    try:
+        if args.tiny:
+            from benchmarks.tiny_mllama import tiny_vlm, tiny_draft
+            from stub_models import STUB_ANSWER
+            tiny_config = tiny_vlm(os.path.join(directory, "vlm"), [config["prompt"], config["en_prompt"], STUB_ANSWER])
+            tiny_draft(os.path.join(directory, "draft"), tiny_config)
+            config["model"] = {"model_id": os.path.join(directory, "vlm"), "profile": "cpu_float"}
+            assisted_config["draft_model_id"] = os.path.join(directory, "draft")
+        config["generation"]["assisted_decoding"] = assisted_config
+        modes = args.modes or ["off", "prompt_lookup"] + (["draft"] if assisted_config.get("draft_model_id") else [])
+        if "off" not in modes:
+            modes = ["off"] + modes
+
+        vlm = build_vlm(config, ResidencyManager())
+        if not args.sample:
+            vlm.model.generation_config.do_sample = False
+        if args.images:
+            images = load_images(args.images, ImageIngestor(**config.get("ingest", {})))
+        else:
+            images = [image for image, _ in generate_images(args.requests, 512)]
+        requests = [(args.descriptions[index % len(args.descriptions)], image) for index, image in enumerate(images)]
+        instruction = config[args.language]
+        max_new_tokens = args.max_new_tokens or get_max_new_tokens(config, instruction)
+
+        # Warm up, and fill the prefix cache of the instruction
+        vlm.generate(f"\n prompt: {requests[0][0]}", requests[0][1], 8, instruction=instruction, assisted="off")
+        totals = run_modes(vlm, requests, instruction, max_new_tokens, modes)
+
+        plain = totals["off"]["new_tokens"] / totals["off"]["seconds"]
+        print(f"{len(requests)} requests, {max_new_tokens} token budget, {'sampled' if args.sample else 'greedy'}:")
+        for mode in modes:
+            total = totals[mode]
+            tokens_per_second = total["new_tokens"] / total["seconds"]
+            acceptance = (f"{total['accepted_tokens'] / total['proposed_tokens'] * 100:5.1f}%"
+                          if total["proposed_tokens"] else "    -")
+            print(f"  {mode:14s} {tokens_per_second:7.1f} tokens/s  speedup {tokens_per_second / plain:4.2f}x  "
+                  f"acceptance {acceptance} of {int(total['proposed_tokens'])} proposed  "
+                  f"{total['new_tokens'] / total['forwards']:4.2f} tokens/forward  "
+                  f"identical answers {int(total['identical'])}/{int(total['requests'])}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Latency and agreement of the ColorDetector backends on generated product photos.
+
+Run from the app directory:
+    python -m benchmarks.color_backends --images 50
+"""
+import time
+import logging
+import argparse
+from typing import List, Tuple
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from color_utils import ColorDetector, BACKENDS
+
+
+def generate_images(count: int, size: int = 768, seed: int = 0) -> List[Tuple[Image.Image, Tuple[int, int, int]]]:
+    """Noisy photos of a few shapes on a plain background, paired with the background colour."""
+    rng = np.random.default_rng(seed)
+    images = []
+    for _ in range(count):
+        background = tuple(int(c) for c in rng.integers(0, 256, 3))
+        image = Image.new('RGB', (size, size), background)
+        draw = ImageDraw.Draw(image)
+        for _ in range(int(rng.integers(1, 4))):
+            x0, y0 = rng.integers(0, size // 2, 2)
+            w, h = rng.integers(size // 8, size // 3, 2)
+            fill = tuple(int(c) for c in rng.integers(0, 256, 3))
+            draw.ellipse([int(x0), int(y0), int(x0 + w), int(y0 + h)], fill=fill)
+        pixels = np.asarray(image).astype(np.int16)
+        noise = rng.normal(0, 6, pixels.shape).astype(np.int16)
+        images.append((Image.fromarray(np.clip(pixels + noise, 0, 255).astype(np.uint8)), background))
+    return images
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=50)
+    parser.add_argument("--size", type=int, default=768)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    images = generate_images(args.images, args.size)
+    namer = ColorDetector()
+    expected = [namer.rgb_to_color_name(namer.quantize_color(background)) for _, background in images]
+
+    results = {}
+    for backend in BACKENDS:
+        if backend == "kmeans":
+            try:
+                import cv2  # noqa: F401
+            except ImportError as e:
+                print(f"{backend:18s} unavailable: {e}")
+                continue
+        detector = ColorDetector(backend=backend)
+        timings, names, errors = [], [], []
+        for image, background in images:
+            for _ in range(args.repeats):
+                start = time.perf_counter()
+                color = detector.get_dominant_color(image)
+                timings.append(time.perf_counter() - start)
+            names.append(detector.rgb_to_color_name(detector.quantize_color(color)))
+            errors.append(float(np.abs(np.array(color) - np.array(background)).max()))
+        results[backend] = names
+        timings_ms = np.array(timings) * 1000
+        agreement = np.mean([name == truth for name, truth in zip(names, expected)])
+        print(f"{backend:18s} p50 {np.percentile(timings_ms, 50):7.2f} ms  p95 {np.percentile(timings_ms, 95):7.2f} ms  "
+              f"name agreement {agreement:6.1%}  max channel error p50 {np.median(errors):5.1f}")
+
+    if "kmeans" in results:
+        for backend, names in results.items():
+            if backend != "kmeans":
+                agreement = np.mean([a == b for a, b in zip(names, results["kmeans"])])
+                print(f"{backend:18s} agrees with kmeans on {agreement:6.1%} of images")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Enhancement throughput of one ComfyUI server against a ComfyUIPool of several.
+
+One in-process FakeComfyUIServer is started per --delays entry, so the servers differ
+in speed. The same number of jobs is run through a ComfyUIHandler on the first server
+and through the pool of all of them, built by build_comfy_handler from comfyui.servers.
+--stop-server stops one server --stop-after seconds into the pool run, and
+--failing-server rejects every prompt, to exercise the health checks and the
+resubmission to another server. Reported: throughput, latency, failed jobs and the
+jobs each server ran.
+    python -m benchmarks.comfyui_pool --delays 0.5 0.5 1.0 --jobs 32 --concurrency 8
+    python -m benchmarks.comfyui_pool --stop-server 0 --stop-after 2
+"""
+import time
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+import numpy as np
+
+from benchmarks.color_backends import generate_images
+from comfyui import ComfyUIHandler
+from fake_comfyui import FakeComfyUIServer
+from helpers import read_config
+from model_factories import build_comfy_handler
+
+PRODUCT_DATA = {"entity_name": "jar"}
+
+
+def run_jobs(handler, images, concurrency: int) -> Dict[str, Any]:
+    def job(image):
+        start = time.perf_counter()
+        result = handler.generate_enhanced_image(image, PRODUCT_DATA)
+        return result is not None, time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(job, images))
+    elapsed = time.perf_counter() - start
+    latencies = [seconds for ok, seconds in results if ok] or [0.0]
+    return {
+        "throughput": sum(ok for ok, _ in results) / elapsed,
+        "latency_p50": float(np.percentile(latencies, 50)),
+        "latency_p90": float(np.percentile(latencies, 90)),
+        "failed": sum(not ok for ok, _ in results)
+    }
+
+
+def report(name: str, result: Dict[str, Any], servers: List[FakeComfyUIServer], prompts_before: List[int]) -> None:
+    print(f"  {name:6s} {result['throughput']:6.2f} jobs/s  latency p50 {result['latency_p50']:.3f}s "
+          f"p90 {result['latency_p90']:.3f}s  {result['failed']} failed")
+    print("         prompts per server: " + ", ".join(
+        f"{server.address} {server.counters['prompts'] - before}" for server, before in zip(servers, prompts_before)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--delays", type=float, nargs="+", default=[0.5, 0.5, 1.0], help="Seconds per prompt of each server")
+    parser.add_argument("--jobs", type=int, default=32)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--image-size", type=int, default=512)
+    parser.add_argument("--stop-server", type=int, default=None, help="Index of a server stopped during the pool run")
+    parser.add_argument("--stop-after", type=float, default=1.0, help="Seconds into the pool run the server is stopped")
+    parser.add_argument("--failing-server", type=int, default=None, help="Index of a server rejecting every prompt")
+    parser.add_argument("--health-interval", type=float, default=1.0)
+    parser.add_argument("--config", default="config.yaml")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    servers = [FakeComfyUIServer(delay=delay, fail_prompts=index == args.failing_server).start()
+               for index, delay in enumerate(args.delays)]
+    config = read_config(args.config)
+    comfyui_config = config.setdefault("comfyui", {})
+    comfyui_config["servers"] = [server.address for server in servers]
+    comfyui_config["pool"] = dict(comfyui_config.get("pool") or {}, health_interval=args.health_interval)
+    single = ComfyUIHandler(server_address=servers[0].address,
+                            workflow_path=comfyui_config.get("workflow_path", "workflow.json"),
+                            color_backend=comfyui_config.get("color_backend", "kmeans"))
+    pool = build_comfy_handler(config)
+    try:
+        # Distinct images per run, so every job uploads and is not served from the content hash
+        images = [image for image, _ in generate_images(args.jobs * 2, args.image_size)]
+        print(f"{args.jobs} jobs, {args.concurrency} in flight, servers with "
+              + ", ".join(f"{delay}s" for delay in args.delays) + " per prompt:")
+        prompts_before = [server.counters["prompts"] for server in servers]
+        report("single", run_jobs(single, images[:args.jobs], args.concurrency), servers, prompts_before)
+
+        prompts_before = [server.counters["prompts"] for server in servers]
+        if args.stop_server is not None:
+            stopped = servers[args.stop_server]
+            threading.Timer(args.stop_after, stopped.stop).start()
+            print(f"  stopping {stopped.address} after {args.stop_after}s")
+        report("pool", run_jobs(pool, images[args.jobs:], args.concurrency), servers, prompts_before)
+        for stats in pool.stats():
+            print(f"         {stats['address']}: {'healthy' if stats['healthy'] else 'down'}, {stats['jobs']} routed, "
+                  f"{stats['failovers']} failed over, prompt {stats['prompt_seconds'] or 0:.3f}s")
+    finally:
+        single.close()
+        pool.close()
+        for server in servers:
+            server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+"""
+End-to-end benchmark of a product request without the real models or ComfyUI.
+
+Every request runs the app path: hash the image for the caption cache, optionally
+transcribe a voice description, stream the caption while the enhancement stages run
+(StageGraph), parse the product fields and wait for the enhanced image. The models
+come from a registry factory, the stub models by default, and the enhancement goes to
+an in-process FakeComfyUIServer. The same requests are run at each concurrency level.
+
+Reported per stage: latency percentiles. Per concurrency level: throughput, request
+latency and the peak of the Python heap (tracemalloc) and of the process RSS. The
+results are written as JSON, compare them with an earlier run to see regressions:
+    python -m benchmarks.end_to_end --requests 32 --concurrency 1 4 8
+    python -m benchmarks.end_to_end --compare benchmarks/results/end_to_end-<time>.json
+"""
+import io
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import resource
+import tracemalloc
+import subprocess
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from benchmarks.color_backends import generate_images
+from fake_comfyui import FakeComfyUIServer
+from helpers import read_config, image_hash, parse_product_info, ProductInfoStream, get_max_new_tokens
+from pipeline import StageGraph
+from worker_pool import resolve
+
+PERCENTILES = (50, 90, 99)
+ENHANCEMENT_STAGES = ("upload", "color", "workflow", "queue", "wait", "result")
+# Metrics compared between runs, p99 and mean of a few requests are too noisy for it.
+# A larger value is a regression except for throughput.
+COMPARED = ("p50", "p90", "latency_p50", "latency_p90", "heap_peak_mb", "rss_peak_mb", "throughput")
+HIGHER_IS_BETTER = ("throughput",)
+# Latency changes below this many seconds are not reported as regressions
+MIN_CHANGE_SECONDS = 0.002
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    values = np.asarray(values, dtype=float)
+    summary = {f"p{p}": float(np.percentile(values, p)) for p in PERCENTILES}
+    summary.update(mean=float(values.mean()), count=int(values.size))
+    return summary
+
+
+def silence(seconds: float) -> bytes:
+    """16 kHz int16 audio, the stub transcriber only looks at the length."""
+    return bytes(int(seconds * 16000) * 2)
+
+
+def run_request(registry, config: Dict[str, Any], image, audio: Optional[bytes]) -> Dict[str, float]:
+    """One request as the app runs it, returns the seconds of each stage."""
+    timings = {}
+    start = time.perf_counter()
+
+    stage_start = time.perf_counter()
+    image_hash(image)
+    timings["hash"] = time.perf_counter() - stage_start
+
+    if audio is not None:
+        stage_start = time.perf_counter()
+        registry.get("whisper")(io.BytesIO(audio))
+        timings["transcribe"] = time.perf_counter() - stage_start
+
+    graph = StageGraph()
+    graph.add("caption")
+    registry.get("comfyui").enhancement_graph(image, graph=graph)
+    instruction = config["prompt"]
+    product_stream = ProductInfoStream()
+    description = ""
+    caption_start = time.perf_counter()
+    for text in registry.get("vlm").generate_stream("\n prompt: ", image, get_max_new_tokens(config, instruction), instruction):
+        if not description:
+            timings["first_token"] = time.perf_counter() - caption_start
+        description += text
+        completed = product_stream.feed(text)
+        if "entity_name" in completed:
+            timings["entity_name"] = time.perf_counter() - caption_start
+            graph.set_result("product_data", dict(product_stream.fields))
+    product_stream.finish()
+    graph.set_result("caption", description)
+    timings["caption"] = time.perf_counter() - caption_start
+
+    stage_start = time.perf_counter()
+    data = parse_product_info("```yaml" + description)
+    timings["parse"] = time.perf_counter() - stage_start
+    if not graph.done("product_data"):
+        graph.set_result("product_data", data)
+
+    try:
+        if graph.result("result") is None:
+            raise RuntimeError("no enhanced image")
+        for name, timing in graph.timings().items():
+            if name in ENHANCEMENT_STAGES and timing["seconds"] is not None:
+                timings[name] = timing["seconds"]
+    finally:
+        graph.close()
+    timings["total"] = time.perf_counter() - start
+    return timings
+
+
+def run_level(registry, config, images, audio, concurrency: int) -> Dict[str, Any]:
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        futures = [executor.submit(run_request, registry, config, image, audio) for image in images]
+        results, errors = [], 0
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                logging.getLogger('Benchmark').error(f"Request failed: {e}")
+                errors += 1
+    elapsed = time.perf_counter() - start
+    latencies = [result["total"] for result in results] or [0.0]
+    return {
+        "throughput": len(results) / elapsed,
+        "latency_p50": float(np.percentile(latencies, 50)),
+        "latency_p90": float(np.percentile(latencies, 90)),
+        "errors": errors,
+        "heap_peak_mb": tracemalloc.get_traced_memory()[1] / 2 ** 20,
+        # ru_maxrss is in KiB on Linux and only grows, it is the peak up to this level
+        "rss_peak_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "stages": {name: summarize(values) for name, values in collect(results).items()}
+    }
+
+
+def collect(results: List[Dict[str, float]]) -> Dict[str, List[float]]:
+    stages = defaultdict(list)
+    for result in results:
+        for name, seconds in result.items():
+            stages[name].append(seconds)
+    return stages
+
+
+def git_revision() -> Optional[str]:
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True)
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True, text=True)
+        return revision.stdout.strip() + ("-dirty" if dirty.stdout.strip() else "")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(results: Dict[str, Any]) -> Dict[str, float]:
+    """'level.metric' and 'level.stage.metric' values of a result file, for comparing runs."""
+    flat = {}
+    for level, level_results in results["levels"].items():
+        for metric, value in level_results.items():
+            if metric == "stages":
+                for stage, summary in value.items():
+                    for name, stage_value in summary.items():
+                        if name != "count":
+                            flat[f"c{level}.{stage}.{name}"] = stage_value
+            elif metric != "errors":
+                flat[f"c{level}.{metric}"] = value
+    return flat
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any], threshold: float) -> List[str]:
+    """Print the change of every metric in both runs, returns the regressions beyond threshold."""
+    before, after = flatten(baseline), flatten(current)
+    regressions = []
+    print(f"\nCompared with {baseline['meta'].get('revision')} ({baseline['meta']['timestamp']}):")
+    for key in sorted(before.keys() & after.keys()):
+        metric = key.rsplit(".", 1)[-1]
+        if metric not in COMPARED or before[key] == 0:
+            continue
+        change = (after[key] - before[key]) / before[key]
+        worse = -change if metric in HIGHER_IS_BETTER else change
+        if metric in ("p50", "p90", "latency_p50", "latency_p90") and abs(after[key] - before[key]) < MIN_CHANGE_SECONDS:
+            worse = 0.0
+        flag = ""
+        if worse > threshold:
+            flag = "  REGRESSION"
+            regressions.append(key)
+        elif worse < -threshold:
+            flag = "  improved"
+        print(f"  {key:32s} {before[key]:10.4f} -> {after[key]:10.4f} {change * 100:+7.1f}%{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=16, help="Requests per concurrency level")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--image-size", type=int, default=768)
+    parser.add_argument("--audio-seconds", type=float, default=0.0, help="Voice description per request, 0 skips it")
+    parser.add_argument("--registry", default="stub_models:build_stub_registry",
+                        help="'module:function' building the models, e.g. model_factories:build_registry")
+    parser.add_argument("--token-seconds", type=float, default=0.005, help="Stub VLM decode time per token")
+    parser.add_argument("--prefill-seconds", type=float, default=0.1, help="Stub VLM time to the first token")
+    parser.add_argument("--real-time-factor", type=float, default=0.05, help="Stub transcriber seconds per audio second")
+    parser.add_argument("--comfyui-delay", type=float, default=0.05, help="Fake ComfyUI seconds per prompt")
+    parser.add_argument("--comfyui-node-delay", type=float, default=0.0, help="Fake ComfyUI seconds per node")
+    parser.add_argument("--config", default="config.yaml")
+    parser.add_argument("--output", default=None, help="Result file, benchmarks/results/end_to_end-<time>.json by default")
+    parser.add_argument("--compare", default=None, help="Earlier result file to compare with")
+    parser.add_argument("--threshold", type=float, default=0.15, help="Relative change reported as a regression")
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    server = FakeComfyUIServer(delay=args.comfyui_delay, node_delay=args.comfyui_node_delay).start()
+    config = read_config(args.config)
+    config.setdefault("comfyui", {})["server_address"] = server.address
+    config["stub_models"] = {"token_seconds": args.token_seconds, "prefill_seconds": args.prefill_seconds,
+                             "real_time_factor": args.real_time_factor}
+    registry = resolve(args.registry)(config, warm_up=["vlm", "comfyui"] + (["whisper"] if args.audio_seconds else []))
+    audio = silence(args.audio_seconds) if args.audio_seconds else None
+
+    tracemalloc.start()
+    results = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "revision": git_revision(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "args": vars(args)
+        },
+        "levels": {}
+    }
+    try:
+        # Distinct images, so every request uploads and is not served from the content hash
+        images = [image for image, _ in generate_images(args.requests * (len(args.concurrency) + 1), args.image_size)]
+        run_level(registry, config, images[:args.requests], audio, 1)
+        for index, concurrency in enumerate(args.concurrency, 1):
+            level_images = images[index * args.requests:(index + 1) * args.requests]
+            level = run_level(registry, config, level_images, audio, concurrency)
+            results["levels"][str(concurrency)] = level
+            print(f"concurrency {concurrency}: {level['throughput']:.2f} req/s, latency p50 {level['latency_p50']:.3f}s "
+                  f"p90 {level['latency_p90']:.3f}s, heap peak {level['heap_peak_mb']:.1f} MB, "
+                  f"RSS peak {level['rss_peak_mb']:.1f} MB, {level['errors']} errors")
+            for stage, summary in level["stages"].items():
+                print(f"    {stage:12s} p50 {summary['p50'] * 1000:8.1f} ms  p90 {summary['p90'] * 1000:8.1f} ms  "
+                      f"p99 {summary['p99'] * 1000:8.1f} ms")
+    finally:
+        tracemalloc.stop()
+        server.stop()
+
+    output = args.output or os.path.join("benchmarks", "results", f"end_to_end-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(json.load(file), results, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} metrics regressed by more than {args.threshold * 100:.0f}%")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
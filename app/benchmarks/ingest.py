@@ -0,0 +1,117 @@
+"""
+Decode and resize time of uploaded photos, the previous path against ImageIngestor.
+
+The previous path decodes the full JPEG, scales it to 1024 with LANCZOS for the app,
+then the VLM processor resizes that to its tile canvas and ColorDetector to its
+sample. The ingestor decodes at a reduced DCT scale and resizes once per consumer.
+The photos are generated phone-like JPEGs with an EXIF orientation. With
+--processor the Mllama image processor of transformers is timed on both inputs.
+Run from the app directory:
+    python -m benchmarks.ingest --sizes 4032x3024 8000x6000 --repeats 5
+"""
+import io
+import time
+import logging
+import argparse
+import statistics
+from typing import Dict, List, Tuple
+
+import numpy as np
+from PIL import Image
+
+from color_utils import ColorDetector
+from helpers import scale_image
+from ingest import ImageIngestor, mllama_canvas_size, EXIF_ORIENTATION
+
+
+def phone_photo(width: int, height: int, orientation: int = 6, quality: int = 90, seed: int = 0) -> bytes:
+    """A noisy product-like photo stored sideways, as phone cameras do, with its EXIF orientation."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    background = np.stack([180 + 40 * x / width, 170 + 30 * y / height, np.full(x.shape, 160.0)], axis=-1)
+    inside = ((x - width / 2) / (width / 4)) ** 2 + ((y - height / 2) / (height / 3)) ** 2 < 1
+    background[inside] = (160, 30, 40)
+    pixels = np.clip(background + rng.normal(0, 8, background.shape), 0, 255).astype(np.uint8)
+    exif = Image.Exif()
+    exif[EXIF_ORIENTATION] = orientation
+    output = io.BytesIO()
+    Image.fromarray(pixels).save(output, format="JPEG", quality=quality, exif=exif.tobytes())
+    return output.getvalue()
+
+
+def previous_path(data: bytes, detector: ColorDetector) -> Tuple[Dict[str, float], Dict[str, Image.Image]]:
+    timings = {}
+    start = time.perf_counter()
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    timings["decode"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    comfyui_image = scale_image(image, max_size=1024)
+    timings["resize comfyui"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    vlm_image = comfyui_image.resize(mllama_canvas_size(*comfyui_image.size), Image.Resampling.BILINEAR)
+    timings["resize vlm"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    color_image = comfyui_image.convert("RGB").resize((detector.sample_size, detector.sample_size))
+    timings["resize color"] = time.perf_counter() - start
+    return timings, {"comfyui": comfyui_image, "vlm": vlm_image, "color": color_image}
+
+
+def ingestor_path(data: bytes, ingestor: ImageIngestor) -> Tuple[Dict[str, float], Dict[str, Image.Image]]:
+    ingested = ingestor.ingest(data)
+    timings = {"decode": ingested.stats["decode_seconds"], "orient": ingested.stats["orient_seconds"]}
+    for name, seconds in ingested.stats["resize_seconds"].items():
+        timings[f"resize {name}"] = seconds
+    return timings, ingested.images
+
+
+def median_ms(runs: List[Dict[str, float]]) -> Dict[str, float]:
+    return {key: statistics.median(run[key] for run in runs) * 1000 for key in runs[0]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", nargs="+", default=["4032x3024", "1600x1200"], help="Stored WIDTHxHEIGHT of the photos")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--processor", action="store_true", help="Also time the Mllama image processor")
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    detector = ColorDetector(backend="histogram")
+    ingestor = ImageIngestor()
+    processor = None
+    if args.processor:
+        from transformers.models.mllama.image_processing_pil_mllama import MllamaImageProcessorPil
+        processor = MllamaImageProcessorPil(size={"height": 560, "width": 560})
+
+    for size in args.sizes:
+        width, height = (int(value) for value in size.split("x"))
+        data = phone_photo(width, height)
+        print(f"{width}x{height} JPEG, {len(data) / 1e6:.1f} MB, EXIF orientation 6:")
+        results = {}
+        for name, run in (("previous", lambda: previous_path(data, detector)),
+                          ("ingestor", lambda: ingestor_path(data, ingestor))):
+            runs = [run()[0] for _ in range(args.repeats)]
+            _, images = run()
+            timings = median_ms(runs)
+            results[name] = (timings, images)
+            total = sum(timings.values())
+            print(f"  {name:9s} total {total:8.1f} ms  " + "  ".join(f"{key} {value:.1f}" for key, value in timings.items()))
+            print(f"            sizes: " + ", ".join(f"{key} {image.size[0]}x{image.size[1]}" for key, image in images.items()))
+            if processor is not None:
+                start = time.perf_counter()
+                for _ in range(args.repeats):
+                    processor(images=[[images["vlm"].convert("RGB")]], return_tensors="np")
+                print(f"            Mllama processor {(time.perf_counter() - start) / args.repeats * 1000:.1f} ms")
+
+        previous_total = sum(results["previous"][0].values())
+        ingestor_total = sum(results["ingestor"][0].values())
+        colors = [detector.get_color_name(images["color"]) for _, images in results.values()]
+        print(f"  speedup {previous_total / ingestor_total:.1f}x, colour previous {colors[0]} / ingestor {colors[1]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Import time of the app modules and startup time of the model registry with stub models.
+
+Every module is imported in a fresh interpreter, which reports the heavy libraries
+it pulled in. The startup part compares building all models before the UI renders
+with registering them and warming them up in the background. The stubs sleep for
+the given load times instead of loading weights. Run from the app directory:
+    python -m benchmarks.startup --vlm-seconds 8 --whisper-seconds 3
+"""
+import sys
+import time
+import json
+import argparse
+import subprocess
+
+from model_registry import ModelRegistry
+
+MODULES = ["helpers", "residency", "model_registry", "caption_cache", "color_utils",
+           "comfyui", "audio_transcriber", "model"]
+HEAVY = ["torch", "transformers", "faster_whisper", "ctranslate2", "cv2", "websocket"]
+
+IMPORT_PROBE = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+print(json.dumps({{"seconds": time.perf_counter() - start, "heavy": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def import_times():
+    for module in MODULES:
+        completed = subprocess.run([sys.executable, "-c", IMPORT_PROBE.format(module=module, heavy=HEAVY)],
+                                   capture_output=True, text=True)
+        if completed.returncode != 0:
+            error = (completed.stderr.strip().splitlines() or ["unknown error"])[-1]
+            print(f"  {module:18s} failed: {error}")
+            continue
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        print(f"  {module:18s} {result['seconds'] * 1000:8.1f} ms  heavy imports: {', '.join(result['heavy']) or '-'}")
+
+
+def stub(seconds, name):
+    def factory():
+        time.sleep(seconds)
+        return name
+    return factory
+
+
+def startup(load_seconds, warm_up):
+    start = time.perf_counter()
+    eager = {name: stub(seconds, name)() for name, seconds in load_seconds.items()}
+    eager_ready = time.perf_counter() - start
+    print(f"  eager: UI renders after {eager_ready:.2f}s, all {len(eager)} models built before it")
+
+    start = time.perf_counter()
+    registry = ModelRegistry()
+    for name, seconds in load_seconds.items():
+        registry.register(name, stub(seconds, name))
+    registry.warm_up(warm_up)
+    ui_ready = time.perf_counter() - start
+    print(f"  registry: UI renders after {ui_ready * 1000:.2f}ms, warming up {', '.join(warm_up)}")
+    for name in warm_up:
+        registry.get(name)
+        print(f"    {name:10s} ready {time.perf_counter() - start:.2f}s after start")
+    for name in load_seconds:
+        if name not in warm_up:
+            first_use = time.perf_counter()
+            registry.get(name)
+            print(f"    {name:10s} lazy, first use waits {time.perf_counter() - first_use:.2f}s")
+    print(f"  status: {registry.status()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--vlm-seconds", type=float, default=8.0)
+    parser.add_argument("--whisper-seconds", type=float, default=3.0)
+    parser.add_argument("--comfyui-seconds", type=float, default=0.3)
+    parser.add_argument("--warm-up", nargs="*", default=["vlm", "comfyui"])
+    parser.add_argument("--skip-imports", action="store_true")
+    args = parser.parse_args()
+
+    if not args.skip_imports:
+        print("Import time (fresh interpreter per module):")
+        import_times()
+    print("Startup with stub models:")
+    startup({"vlm": args.vlm_seconds, "whisper": args.whisper_seconds, "comfyui": args.comfyui_seconds}, args.warm_up)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Randomly initialised Mllama checkpoints for checking the VLM code without downloading
+weights. tiny_checkpoint writes the model only, tiny_vlm also a processor with a small
+byte-level BPE tokenizer trained on the prompts of config.yaml and the chat format of
+Llama 3.2 Vision, so VLMModel can load the directory like the real model_id.
+
+    config = tiny_vlm("/tmp/tiny_vlm")
+    vlm = VLMModel(model_id="/tmp/tiny_vlm", profile="cpu_float")
+"""
+from typing import Iterable, Optional
+
+import torch
+from transformers import (LlamaConfig, LlamaForCausalLM, MllamaConfig, MllamaForConditionalGeneration,
+                          MllamaProcessor, PreTrainedTokenizerFast)
+
+# Special tokens of Llama 3.2 Vision used by the chat template, the processor and VLMModel
+SPECIAL_TOKENS = ["<|begin_of_text|>", "<|end_of_text|>", "<|finetune_right_pad_id|>", "<|start_header_id|>",
+                  "<|end_header_id|>", "<|eot_id|>", "<|image|>"]
+CHAT_TEMPLATE = (
+    "{{ bos_token }}{% for message in messages %}"
+    "<|start_header_id|>{{ message['role'] }}<|end_header_id|>\n\n"
+    "{% if message['content'] is string %}{{ message['content'] }}{% else %}"
+    "{% for content in message['content'] %}"
+    "{% if content['type'] == 'image' %}<|image|>{% elif content['type'] == 'text' %}{{ content['text'] }}{% endif %}"
+    "{% endfor %}{% endif %}<|eot_id|>{% endfor %}"
+    "{% if add_generation_prompt %}<|start_header_id|>assistant<|end_header_id|>\n\n{% endif %}"
+)
+
+
+def tiny_checkpoint(directory: str, hidden_size: int = 256, layers: int = 4, vocab_size: int = 2048, seed: int = 0,
+                    image_token_index: Optional[int] = None, bos_token_id: int = 1, eos_token_id: int = 2,
+                    pad_token_id: int = 3) -> MllamaConfig:
+    """Write a randomly initialised Mllama checkpoint, with a cross attention layer in every other layer."""
+    config = MllamaConfig(
+        text_config=dict(vocab_size=vocab_size, hidden_size=hidden_size, intermediate_size=hidden_size * 11 // 4,
+                         num_hidden_layers=layers, num_attention_heads=max(hidden_size // 64, 2),
+                         num_key_value_heads=max(hidden_size // 128, 1), cross_attention_layers=list(range(1, layers, 2)),
+                         max_position_embeddings=4096, bos_token_id=bos_token_id, eos_token_id=eos_token_id,
+                         pad_token_id=pad_token_id),
+        vision_config=dict(hidden_size=hidden_size // 2, intermediate_size=hidden_size, num_hidden_layers=2,
+                           num_global_layers=1, attention_heads=max(hidden_size // 128, 2), image_size=112,
+                           patch_size=14, intermediate_layers_indices=[0, 1],
+                           # The last hidden state is concatenated with the two intermediate ones
+                           vision_output_dim=hidden_size // 2 * 3,
+                           max_num_tiles=4),
+        image_token_index=vocab_size - 1 if image_token_index is None else image_token_index
+    )
+    torch.manual_seed(seed)
+    MllamaForConditionalGeneration(config).to(torch.bfloat16).save_pretrained(directory)
+    return config
+
+
+def train_tokenizer(texts: Iterable[str], vocab_size: int = 2048) -> PreTrainedTokenizerFast:
+    """Byte-level BPE like the Llama 3 tokenizer, with its special tokens first."""
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(vocab_size=vocab_size, special_tokens=SPECIAL_TOKENS,
+                                  initial_alphabet=pre_tokenizers.ByteLevel.alphabet())
+    tokenizer.train_from_iterator(texts, trainer)
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, bos_token="<|begin_of_text|>", eos_token="<|eot_id|>",
+                                   pad_token="<|finetune_right_pad_id|>")
+
+
+def tiny_vlm(directory: str, texts: Iterable[str] = (), hidden_size: int = 256, layers: int = 4,
+             vocab_size: int = 2048, seed: int = 0) -> MllamaConfig:
+    """
+    Write a random checkpoint with a processor VLMModel can load.
+
+    Args:
+        directory (str): Checkpoint directory, used as model_id
+        texts (list): Texts the tokenizer is trained on, e.g. the prompts of config.yaml
+        hidden_size (int): Hidden size of the language model, the vision model has half
+        layers (int): Language model layers
+        vocab_size (int): Tokenizer and language model vocabulary
+        seed (int): Seed of the random weights
+    """
+    from transformers.models.mllama.image_processing_pil_mllama import MllamaImageProcessorPil
+    tokenizer = train_tokenizer(list(texts) or ["product"], vocab_size)
+    # The tokenizer can end up smaller than asked for when the texts are short
+    vocab_size = len(tokenizer)
+    config = tiny_checkpoint(directory, hidden_size, layers, vocab_size, seed,
+                             image_token_index=tokenizer.convert_tokens_to_ids("<|image|>"),
+                             bos_token_id=tokenizer.bos_token_id, eos_token_id=tokenizer.eos_token_id,
+                             pad_token_id=tokenizer.pad_token_id)
+    image_processor = MllamaImageProcessorPil(size={"height": config.vision_config.image_size,
+                                                    "width": config.vision_config.image_size},
+                                              max_image_tiles=config.vision_config.max_num_tiles)
+    MllamaProcessor(image_processor=image_processor, tokenizer=tokenizer, chat_template=CHAT_TEMPLATE).save_pretrained(directory)
+    return config
+
+
+def tiny_draft(directory: str, config: MllamaConfig, hidden_size: int = 64, layers: int = 2, seed: int = 1) -> None:
+    """Write a random Llama draft model with the vocabulary of a tiny_vlm checkpoint."""
+    text_config = config.text_config
+    draft_config = LlamaConfig(vocab_size=text_config.vocab_size, hidden_size=hidden_size,
+                               intermediate_size=hidden_size * 11 // 4, num_hidden_layers=layers,
+                               num_attention_heads=2, num_key_value_heads=1, bos_token_id=text_config.bos_token_id,
+                               eos_token_id=text_config.eos_token_id, pad_token_id=text_config.pad_token_id)
+    torch.manual_seed(seed)
+    LlamaForCausalLM(draft_config).save_pretrained(directory)
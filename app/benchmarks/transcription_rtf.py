@@ -0,0 +1,90 @@
+"""
+Real-time factor (processing seconds / audio seconds) of the AudioTranscriber profiles.
+
+Each profile runs in its own process, AudioTranscriber is a singleton and the load
+time and memory of one profile should not leak into the next. Run from the app directory:
+    python -m benchmarks.transcription_rtf sample.wav --device cpu --profiles cpu cpu_accurate
+    python -m benchmarks.transcription_rtf sample.wav --pad-silence 20 --set beam_size=1
+"""
+import sys
+import json
+import time
+import logging
+import argparse
+import subprocess
+
+import numpy as np
+
+
+def parse_value(value: str):
+    for cast in (int, float):
+        try:
+            return cast(value)
+        except ValueError:
+            pass
+    return {"true": True, "false": False}.get(value.lower(), value)
+
+
+def run_profile(args) -> dict:
+    from faster_whisper import decode_audio
+    from audio_transcriber import AudioTranscriber, SAMPLING_RATE
+
+    overrides = dict(item.split("=", 1) for item in args.set)
+    start = time.perf_counter()
+    transcriber = AudioTranscriber(model_path=args.model, device=args.device, profile=args.profile,
+                                   **{key: parse_value(value) for key, value in overrides.items()})
+    load_seconds = time.perf_counter() - start
+
+    silence = np.zeros(int(args.pad_silence * SAMPLING_RATE), dtype=np.float32)
+    files = []
+    for path in args.audio:
+        audio = np.concatenate([silence, decode_audio(path, sampling_rate=SAMPLING_RATE), silence])
+        if args.warmup:
+            # The first run includes one-off allocations, only the later ones are timed
+            list(transcriber.run(audio)[0])
+        timings = []
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            segments, info, duration = transcriber.run(audio)
+            text = " ".join(segment.text.strip() for segment in segments)
+            timings.append(time.perf_counter() - start)
+        files.append({"file": path, "audio_seconds": duration, "seconds": min(timings),
+                      "rtf": min(timings) / duration, "language": info.language, "text": text})
+    return {"profile": args.profile, "settings": transcriber.settings, "load_seconds": load_seconds, "files": files}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("audio", nargs="+", help="Speech recordings to transcribe")
+    parser.add_argument("--model", default="deepdml/faster-whisper-large-v3-turbo-ct2")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--profiles", nargs="+", default=["cpu", "cpu_accurate"])
+    parser.add_argument("--set", nargs="*", default=[], help="Profile overrides such as cpu_threads=8")
+    parser.add_argument("--pad-silence", type=float, default=0.0, help="Seconds of silence added on both sides")
+    parser.add_argument("--repeats", type=int, default=2)
+    parser.add_argument("--no-warmup", dest="warmup", action="store_false")
+    parser.add_argument("--profile", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.profile:
+        logging.disable(logging.INFO)
+        print(json.dumps(run_profile(args)))
+        return
+
+    for profile in args.profiles:
+        command = [sys.executable, "-m", "benchmarks.transcription_rtf", *sys.argv[1:], "--profile", profile]
+        completed = subprocess.run(command, capture_output=True, text=True)
+        if completed.returncode != 0:
+            print(f"{profile:14s} failed: {completed.stderr.strip().splitlines()[-1:]}")
+            continue
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        total_audio = sum(f["audio_seconds"] for f in result["files"])
+        total_seconds = sum(f["seconds"] for f in result["files"])
+        print(f"{profile:14s} load {result['load_seconds']:6.1f}s  RTF {total_seconds / total_audio:6.3f}  "
+              f"({total_seconds:.1f}s for {total_audio:.1f}s of audio)  {result['settings']}")
+        for f in result["files"]:
+            print(f"    {f['file']}: RTF {f['rtf']:.3f} [{f['language']}] {f['text'][:80]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+Load time, peak memory and output agreement of the CPU profiles of VLMModel.
+
+A randomly initialised Mllama checkpoint is written as bfloat16 safetensors, so no
+weights are downloaded, then every profile is loaded in a fresh process with
+load_vlm: cpu_float as the reference, cpu converting to int8 and writing the
+quantised cache, and cpu again loading from that cache. Each process runs a forward
+pass and a greedy generate on the same random image and tokens, and reports its
+peak RSS. Random weights give nearly tied logits, so the top-1 and greedy agreement
+with float32 understate what a trained model keeps, the relative logit error is the
+better measure. Scale the model up to make the timings meaningful:
+    python -m benchmarks.vlm_cpu --hidden-size 1024 --layers 8 --threads 4
+"""
+import os
+import time
+import queue
+import shutil
+import logging
+import argparse
+import resource
+import tempfile
+import multiprocessing
+from typing import Any, Dict
+
+import numpy as np
+import torch
+from transformers import MllamaConfig
+
+from benchmarks.tiny_mllama import tiny_checkpoint
+from model import VLM_PROFILES, load_vlm, set_threads
+
+
+def random_inputs(config: MllamaConfig, length: int = 32, seed: int = 0) -> Dict[str, torch.Tensor]:
+    """One image of one tile before random tokens, shaped as the Mllama processor returns them."""
+    generator = torch.Generator().manual_seed(seed)
+    vision = config.vision_config
+    input_ids = torch.randint(4, config.text_config.vocab_size - 1, (1, length), generator=generator)
+    input_ids[0, 0] = config.image_token_index
+    cross_attention_mask = torch.zeros(1, length, 1, vision.max_num_tiles, dtype=torch.long)
+    cross_attention_mask[:, :, :, 0] = 1
+    aspect_ratio_mask = torch.zeros(1, 1, vision.max_num_tiles, dtype=torch.long)
+    aspect_ratio_mask[:, :, 0] = 1
+    return dict(
+        input_ids=input_ids,
+        attention_mask=torch.ones_like(input_ids),
+        pixel_values=torch.randn(1, 1, vision.max_num_tiles, 3, vision.image_size, vision.image_size, generator=generator),
+        aspect_ratio_ids=torch.ones(1, 1, dtype=torch.long),
+        aspect_ratio_mask=aspect_ratio_mask,
+        cross_attention_mask=cross_attention_mask
+    )
+
+
+def run_profile(checkpoint: str, settings: Dict[str, Any], new_tokens: int, results) -> None:
+    """Child process: load, one forward pass and a greedy generate."""
+    logging.disable(logging.INFO)
+    set_threads(settings)
+    start = time.perf_counter()
+    model = load_vlm(checkpoint, settings)
+    load_seconds = time.perf_counter() - start
+
+    inputs = random_inputs(model.config)
+    with torch.no_grad():
+        model(**inputs)
+        start = time.perf_counter()
+        logits = model(**inputs).logits[0].float()
+        forward_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        output = model.generate(**inputs, max_new_tokens=new_tokens, min_new_tokens=new_tokens, do_sample=False)
+        generate_seconds = time.perf_counter() - start
+    results.put({
+        "load_seconds": load_seconds,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "forward_ms": forward_seconds * 1000,
+        "tokens_per_second": (output.shape[1] - inputs["input_ids"].shape[1]) / generate_seconds,
+        "logits": logits.numpy(),
+        "tokens": output[0, inputs["input_ids"].shape[1]:].tolist()
+    })
+
+
+def measure(checkpoint: str, settings: Dict[str, Any], new_tokens: int) -> Dict[str, Any]:
+    # A fresh process per load, so the peak RSS is the one of that load alone
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=run_profile, args=(checkpoint, settings, new_tokens, results))
+    process.start()
+    while True:
+        try:
+            result = results.get(timeout=1)
+            break
+        except queue.Empty:
+            if not process.is_alive():
+                raise RuntimeError(f"Loading with {settings} failed, exit code {process.exitcode}")
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--hidden-size", type=int, default=256)
+    parser.add_argument("--layers", type=int, default=4)
+    parser.add_argument("--vocab-size", type=int, default=2048)
+    parser.add_argument("--threads", type=int, default=0, help="torch threads, 0 keeps the default")
+    parser.add_argument("--new-tokens", type=int, default=32)
+    parser.add_argument("--checkpoint", default=None, help="Existing Mllama checkpoint instead of a random one")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="vlm_cpu-")
+    try:
+        checkpoint = args.checkpoint or os.path.join(directory, "checkpoint")
+        if args.checkpoint is None:
+            tiny_checkpoint(checkpoint, args.hidden_size, args.layers, args.vocab_size)
+        size = sum(os.path.getsize(os.path.join(checkpoint, name)) for name in os.listdir(checkpoint)
+                   if name.endswith(".safetensors"))
+        print(f"Checkpoint {checkpoint}, {size / 2 ** 20:.1f} MB of bfloat16 safetensors")
+
+        cache_dir = os.path.join(directory, "cache")
+        # gpu on a machine without CUDA is what VLMModel did before the CPU profiles
+        runs = (("cpu_float", "cpu_float", {}),
+                ("bfloat16", "gpu", {}),
+                ("cpu (convert)", "cpu", {"quantized_cache_dir": cache_dir}),
+                ("cpu (cached)", "cpu", {"quantized_cache_dir": cache_dir}))
+        results = {}
+        for name, profile, overrides in runs:
+            settings = dict(VLM_PROFILES[profile], threads=args.threads, **overrides)
+            results[name] = measure(checkpoint, settings, args.new_tokens)
+
+        reference = results["cpu_float"]
+        for name, result in results.items():
+            error = np.linalg.norm(result["logits"] - reference["logits"]) / np.linalg.norm(reference["logits"])
+            agreement = (result["logits"].argmax(-1) == reference["logits"].argmax(-1)).mean()
+            same_tokens = sum(a == b for a, b in zip(result["tokens"], reference["tokens"]))
+            print(f"  {name:14s} load {result['load_seconds']:6.2f} s  peak RSS {result['peak_rss_mb']:7.1f} MB  "
+                  f"forward {result['forward_ms']:7.1f} ms  {result['tokens_per_second']:6.1f} tokens/s  "
+                  f"logit error {error * 100:5.2f}%  top-1 agreement {agreement * 100:5.1f}%  "
+                  f"greedy tokens equal {same_tokens}/{len(reference['tokens'])}")
+        cached = [name for name in os.listdir(cache_dir)] if os.path.isdir(cache_dir) else []
+        print(f"  quantised cache: {', '.join(f'{name} {os.path.getsize(os.path.join(cache_dir, name)) / 2 ** 20:.1f} MB' for name in cached)}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+from PIL import Image
+
+from helpers import singleton, image_hash
+
+logger = logging.getLogger('CaptionCache')
+
+@singleton
+class CaptionCache:
+    def __init__(self, memory_entries: int = 256, disk_dir: Optional[str] = ".caption_cache", disk_max_mb: float = 512):
+        """
+        Two tier cache of model outputs: an in-memory LRU in front of an on-disk store.
+
+        Args:
+            memory_entries (int): Number of answers kept in memory
+            disk_dir (str): Directory of the on-disk store, None to keep the cache in memory only
+            disk_max_mb (float): Size of the on-disk store above which the least recently used
+                entries are evicted, down to 90% of it so that the next writes do not scan again
+        """
+        self.memory_entries = memory_entries
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = int(disk_max_mb * 1024**2)
+        self.memory: "OrderedDict[str, str]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+        # Bytes of the on-disk store, scanned once and then kept up to date by the writes
+        self.disk_bytes = 0
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self.disk_bytes = sum(size for _, size, _ in self._disk_entries())
+
+    def make_key(self, image: Image.Image, prompt: str, model_id: str, **generation_params) -> str:
+        """
+        Key combining the image content, the full prompt text and the model id.
+
+        The prompt must include the language instruction from config.yaml, so that editing
+        the prompts or switching model_id never returns stale answers.
+        """
+        prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        params = json.dumps(generation_params, sort_keys=True)
+        key = f"{image_hash(image)}:{prompt_hash}:{model_id}:{params}"
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.counters["memory_hits"] += 1
+                return self.memory[key]
+
+            value = self._read_disk(key)
+            if value is None:
+                self.counters["misses"] += 1
+                return None
+            self.counters["disk_hits"] += 1
+            self._put_memory(key, value)
+            return value
+
+    def put(self, key: str, value: str) -> None:
+        with self.lock:
+            self._put_memory(key, value)
+            self._write_disk(key, value)
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return dict(self.counters, memory_entries=len(self.memory))
+
+    def _put_memory(self, key: str, value: str) -> None:
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _read_disk(self, key: str) -> Optional[str]:
+        if not self.disk_dir:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding="utf-8") as file:
+                value = json.load(file)["output"]
+            # Access time drives the eviction order
+            os.utime(path)
+            return value
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"Error reading cache entry {key}: {e}")
+            return None
+
+    def _write_disk(self, key: str, value: str) -> None:
+        if not self.disk_dir:
+            return
+        try:
+            path = self._path(key)
+            data = json.dumps({"output": value, "created": time.time()}, ensure_ascii=False).encode("utf-8")
+            try:
+                replaced = os.stat(path).st_size
+            except FileNotFoundError:
+                replaced = 0
+            tmp_path = path + ".tmp"
+            with open(tmp_path, 'wb') as file:
+                file.write(data)
+            os.replace(tmp_path, path)
+            self.disk_bytes += len(data) - replaced
+            if self.disk_bytes > self.disk_max_bytes:
+                self._evict_disk()
+        except OSError as e:
+            logger.error(f"Error writing cache entry {key}: {e}")
+
+    def _disk_entries(self):
+        entries = []
+        for entry in os.scandir(self.disk_dir):
+            if entry.name.endswith(".json"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def _evict_disk(self) -> None:
+        entries = self._disk_entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.disk_max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                self.counters["evictions"] += 1
+            except OSError as e:
+                logger.error(f"Error evicting cache entry {path}: {e}")
+        self.disk_bytes = total
@@ -1,44 +1,186 @@
-import cv2
 import numpy as np
 import webcolors
-import math
+import threading
 from PIL import Image
 import logging
-from typing import Tuple, Optional
+from typing import Dict, List, Tuple, Optional, Sequence
+
+import tracing
 
 logger = logging.getLogger('ColorUtils')
 
+# Dominant colour estimators, see ColorDetector.get_dominant_color
+BACKENDS = ("kmeans", "minibatch_kmeans", "histogram")
+
+# Channel weights of the colour distance, weighted Euclidean for better human perception
+METRICS = {
+    "weighted_euclidean": (2, 4, 1),
+    "euclidean": (1, 1, 1),
+}
+
+
+class ColorNameIndex:
+    """
+    Nearest CSS3 colour name of every point of the quantize_color grid, built once per
+    (quant_size, metric).
+
+    Ties go to the name listed last by webcolors, as in the original per-call search.
+    Colours off the grid are answered with one vectorised distance computation.
+    """
+    _indexes: Dict[Tuple[int, str], "ColorNameIndex"] = {}
+    _lock = threading.Lock()
+
+    def __init__(self, quant_size: int, metric: str = "weighted_euclidean"):
+        if metric not in METRICS:
+            raise ValueError(f"Unknown color metric '{metric}', expected one of {tuple(METRICS)}")
+        self.quant_size = quant_size
+        self.step = 256 / quant_size
+        self.names = list(webcolors.names("css3"))
+        self.palette = np.array([tuple(webcolors.name_to_rgb(name)) for name in self.names], dtype=np.int64)
+        self.weights = np.array(METRICS[metric], dtype=np.int64)
+        # Grid values per channel, quantize_color can round up to 256
+        self.levels = np.array([int(k * self.step) for k in range(quant_size + 1)], dtype=np.int64)
+        grid = np.stack(np.meshgrid(self.levels, self.levels, self.levels, indexing="ij"), -1).reshape(-1, 3)
+        self.table = self._nearest(grid).reshape((quant_size + 1,) * 3)
+
+    @classmethod
+    def get(cls, quant_size: int, metric: str = "weighted_euclidean") -> "ColorNameIndex":
+        with cls._lock:
+            index = cls._indexes.get((quant_size, metric))
+            if index is None:
+                index = cls(quant_size, metric)
+                cls._indexes[(quant_size, metric)] = index
+            return index
+
+    def _nearest(self, colors: np.ndarray) -> np.ndarray:
+        """Palette index of the nearest name of each colour, exact on integer squared distances."""
+        distances = ((colors[:, None, :] - self.palette[None]) ** 2 * self.weights).sum(-1)
+        # argmin returns the first minimum, search the reversed palette to prefer the last name
+        return len(self.names) - 1 - distances[:, ::-1].argmin(1)
+
+    def name(self, color: Tuple[int, int, int]) -> str:
+        """Nearest name of a single RGB colour, a table read when it lies on the grid."""
+        steps = [min(max(int(round(c / self.step)), 0), self.quant_size) for c in color]
+        if all(self.levels[k] == c for k, c in zip(steps, color)):
+            return self.names[self.table[steps[0], steps[1], steps[2]]]
+        return self.names[self._nearest(np.array([color], dtype=np.int64))[0]]
+
+    def lookup(self, colors: np.ndarray) -> List[str]:
+        """Nearest names of an (N, 3) array of RGB colours."""
+        colors = np.asarray(colors, dtype=np.int64).reshape(-1, 3)
+        steps = np.clip(np.rint(colors / self.step), 0, self.quant_size).astype(np.int64)
+        on_grid = (self.levels[steps] == colors).all(1)
+        result = np.empty(len(colors), dtype=np.int64)
+        result[on_grid] = self.table[steps[on_grid, 0], steps[on_grid, 1], steps[on_grid, 2]]
+        if not on_grid.all():
+            result[~on_grid] = self._nearest(colors[~on_grid])
+        return [self.names[i] for i in result]
+
 class ColorDetector:
-    def __init__(self, n_clusters: int = 5, quant_size: int = 16):
+    def __init__(self, n_clusters: int = 5, quant_size: int = 16, backend: str = "kmeans",
+                 sample_size: int = 150, seed: int = 0, metric: str = "weighted_euclidean"):
+        """
+        Args:
+            n_clusters (int): Number of clusters of the k-means backends
+            quant_size (int): Levels per channel colours are snapped to before naming,
+                also the histogram bins per channel
+            backend (str): 'kmeans' (cv2, 10 attempts), 'minibatch_kmeans' (seeded NumPy)
+                or 'histogram' (most populated cell of a quantised 3D histogram)
+            sample_size (int): Images are resized to sample_size x sample_size first
+            seed (int): Seed of the mini-batch k-means initialisation
+            metric (str): Colour distance used for naming, a key of METRICS
+        """
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown color backend '{backend}', expected one of {BACKENDS}")
+        if metric not in METRICS:
+            raise ValueError(f"Unknown color metric '{metric}', expected one of {tuple(METRICS)}")
         self.n_clusters = n_clusters
         self.quant_size = quant_size
-        
+        self.backend = backend
+        self.sample_size = sample_size
+        self.seed = seed
+        self.metric = metric
+
+    def get_pixels(self, image: Image.Image) -> np.ndarray:
+        """Pixels of the resized image as an (N, 3) uint8 array, without going through Python lists."""
+        image = image.convert('RGB')
+        if image.size != (self.sample_size, self.sample_size):
+            image = image.resize((self.sample_size, self.sample_size))
+        # One copy of the image bytes as uint8, no float conversion, and reshape adds no further copy
+        return np.asarray(image).reshape(-1, 3)
+
     def get_dominant_color(self, image: Image.Image) -> Optional[Tuple[int, int, int]]:
         """Extract dominant color from PIL Image."""
         try:
-            # Convert to RGB and resize for faster processing
-            image = image.convert('RGB').resize((150, 150))
-            pixels = np.float32(list(image.getdata()))
-            
-            # Use k-means clustering to find dominant colors
-            criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 200, .1)
-            _, labels, palette = cv2.kmeans(
-                pixels, 
-                self.n_clusters, 
-                None, 
-                criteria, 
-                10, 
-                cv2.KMEANS_RANDOM_CENTERS
-            )
-            
-            # Get the most dominant color
-            dominant_color = tuple(map(int, palette[np.argmax(np.unique(labels, return_counts=True)[1])]))
+            pixels = self.get_pixels(image)
+            if self.backend == "histogram":
+                dominant_color = self._histogram(pixels)
+            elif self.backend == "minibatch_kmeans":
+                dominant_color = self._minibatch_kmeans(pixels)
+            else:
+                dominant_color = self._kmeans(pixels)
             logger.info(f"Successfully extracted dominant color: {dominant_color}")
             return dominant_color
             
         except Exception as e:
             logger.error(f"Error extracting dominant color: {e}")
             return None
+
+    def _kmeans(self, pixels: np.ndarray) -> Tuple[int, int, int]:
+        """OpenCV k-means with 10 random restarts."""
+        import cv2
+
+        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 200, .1)
+        _, labels, palette = cv2.kmeans(
+            pixels.astype(np.float32),
+            self.n_clusters,
+            None,
+            criteria,
+            10,
+            cv2.KMEANS_RANDOM_CENTERS
+        )
+        # Get the most dominant color
+        return tuple(map(int, palette[np.argmax(np.unique(labels, return_counts=True)[1])]))
+
+    def _minibatch_kmeans(self, pixels: np.ndarray, batch_size: int = 1024, iterations: int = 30) -> Tuple[int, int, int]:
+        """Mini-batch k-means (Sculley 2010) with k-means++ seeding, deterministic for a given seed."""
+        rng = np.random.default_rng(self.seed)
+        data = pixels.astype(np.float32)
+        n_clusters = min(self.n_clusters, len(data))
+
+        # k-means++ seeding on a sample
+        sample = data[rng.choice(len(data), min(len(data), batch_size), replace=False)]
+        centers = [sample[rng.integers(len(sample))]]
+        for _ in range(1, n_clusters):
+            distances = ((sample[:, None, :] - np.array(centers)[None]) ** 2).sum(-1).min(1)
+            total = distances.sum()
+            if total == 0:
+                break
+            centers.append(sample[rng.choice(len(sample), p=distances / total)])
+        centers = np.array(centers)
+
+        counts = np.zeros(len(centers))
+        for _ in range(iterations):
+            batch = data[rng.integers(0, len(data), batch_size)]
+            labels = ((batch[:, None, :] - centers[None]) ** 2).sum(-1).argmin(1)
+            for k in np.unique(labels):
+                members = batch[labels == k]
+                counts[k] += len(members)
+                # Per-centre learning rate 1 / count, applied to the batch mean
+                centers[k] += (members.mean(0) - centers[k]) * (len(members) / counts[k])
+
+        labels = ((data[:, None, :] - centers[None]) ** 2).sum(-1).argmin(1)
+        dominant = np.bincount(labels, minlength=len(centers)).argmax()
+        return tuple(int(c) for c in np.clip(np.rint(centers[dominant]), 0, 255))
+
+    def _histogram(self, pixels: np.ndarray) -> Tuple[int, int, int]:
+        """Mean colour of the most populated cell of a quant_size^3 colour histogram."""
+        bins = self.quant_size
+        cells = (pixels.astype(np.int64) * bins) >> 8
+        index = (cells[:, 0] * bins + cells[:, 1]) * bins + cells[:, 2]
+        counts = np.bincount(index, minlength=bins ** 3)
+        members = pixels[index == counts.argmax()]
+        return tuple(int(c) for c in np.rint(members.mean(0)))
     
     def quantize_color(self, rgb_color: Tuple[int, int, int]) -> Tuple[int, int, int]:
         """Quantize RGB color values."""
@@ -52,35 +194,32 @@ class ColorDetector:
     def rgb_to_color_name(self, rgb_color: Tuple[int, int, int]) -> str:
         """Convert RGB color to nearest CSS3 color name."""
         try:
-            color_distances = {}
-            for color_name in webcolors.names("css3"):
-                r, g, b = webcolors.name_to_rgb(color_name)
-                # Use weighted Euclidean distance for better human perception
-                distance = math.sqrt(2*(r-rgb_color[0])**2 + 
-                                  4*(g-rgb_color[1])**2 + 
-                                  (b-rgb_color[2])**2)
-                color_distances[distance] = color_name
-            
-            nearest_color = min(color_distances.items())[1]
+            nearest_color = ColorNameIndex.get(self.quant_size, self.metric).name(tuple(rgb_color))
             logger.info(f"Found nearest color name: {nearest_color}")
             return nearest_color
             
         except Exception as e:
             logger.error(f"Error converting RGB to color name: {e}")
             return "white"  # Safe fallback
+
+    def rgb_to_color_names(self, rgb_colors: Sequence[Tuple[int, int, int]]) -> List[str]:
+        """Nearest CSS3 color names of many colours at once, table lookups for quantized colours."""
+        return ColorNameIndex.get(self.quant_size, self.metric).lookup(np.asarray(rgb_colors))
     
     def get_color_name(self, image: Image.Image) -> str:
         """Get color name from image with fallback handling."""
         try:
-            dominant_color = self.get_dominant_color(image)
-            if dominant_color is None:
-                logger.warning("Failed to get dominant color, using fallback")
-                return "white"
+            with tracing.span("color.detect", backend=self.backend) as span:
+                dominant_color = self.get_dominant_color(image)
+                if dominant_color is None:
+                    logger.warning("Failed to get dominant color, using fallback")
+                    return "white"
+                    
+                quantized_color = self.quantize_color(dominant_color)
+                color_name = self.rgb_to_color_name(quantized_color)
+                span.set(color=color_name)
                 
-            quantized_color = self.quantize_color(dominant_color)
-            color_name = self.rgb_to_color_name(quantized_color)
-            
-            return color_name
+                return color_name
             
         except Exception as e:
             logger.error(f"Error in get_color_name: {e}")
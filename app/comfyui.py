@@ -1,14 +1,20 @@
-import json
+import os
+import time
 import uuid
-import urllib.request
-import websocket
+import hashlib
 from PIL import Image
 import io
 import logging
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, Tuple
+import requests
 from requests_toolbelt import MultipartEncoder
 
 from color_utils import ColorDetector
+from comfyui_session import ComfyUISession, PromptWaiter, PromptValidationError
+from workflow_compiler import WorkflowTemplate, upstream_nodes
+import tracing
+from helpers import image_hash
+from pipeline import StageGraph
 
 # Set up logging
 logging.basicConfig(
@@ -21,21 +27,69 @@ logging.basicConfig(
 )
 logger = logging.getLogger('ComfyUI')
 
+# Transfer encodings for uploads: 'original' sends the source file bytes when they are given
+UPLOAD_ENCODINGS = ("png", "webp_lossless", "original")
+
 class ComfyUIHandler:
-    def __init__(self, server_address: str = "127.0.0.1:8188", workflow_path: str = "workflow.json"):
+    def __init__(self, server_address: str = "127.0.0.1:8188", workflow_path: str = "workflow.json",
+                 output_node: str = "75", history_output_node: Optional[str] = "76",
+                 upload_encoding: str = "png", png_compress_level: int = 1,
+                 input_dir: Optional[str] = None, max_input_age_hours: Optional[float] = 24,
+                 max_inputs: Optional[int] = 1000, color_backend: str = "kmeans"):
+        """
+        Args:
+            server_address: host:port of the ComfyUI server
+            workflow_path: Workflow template used for every job
+            output_node: SaveImageWebsocket node whose image is the result
+            history_output_node: SaveImage node read from /history when no websocket image arrived.
+                It is pruned from the jobs and only run for a prompt whose image got lost,
+                None disables the fallback
+            upload_encoding: 'png', 'webp_lossless' or 'original' (source bytes as they are)
+            png_compress_level: zlib level for 'png', lower is faster and larger
+            input_dir: ComfyUI input folder when it is reachable from here, enables cleanup
+            max_input_age_hours: Uploaded inputs older than this are removed from input_dir
+            max_inputs: Only the most recent uploaded inputs are kept in input_dir
+            color_backend: Dominant colour estimator, see ColorDetector
+        """
+        if upload_encoding not in UPLOAD_ENCODINGS:
+            raise ValueError(f"Unknown upload encoding '{upload_encoding}', expected one of {UPLOAD_ENCODINGS}")
         self.server_address = server_address
         self.workflow_path = workflow_path
+        self.output_node = output_node
+        self.history_output_node = history_output_node
         self.client_id = str(uuid.uuid4())
-        self.color_detector = ColorDetector()
+        self.color_detector = ColorDetector(backend=color_backend)
+        self.session = ComfyUISession(server_address, self.client_id)
+        self.template = None
+        self.history_nodes = None
+        self.upload_encoding = upload_encoding
+        self.png_compress_level = png_compress_level
+        self.input_dir = input_dir
+        self.max_input_age_hours = max_input_age_hours
+        self.max_inputs = max_inputs
+        self.last_cleanup = 0.0
+        self.last_upload_stats: Optional[Dict[str, Any]] = None
         
-    def load_workflow(self) -> Dict[str, Any]:
-        """Load the workflow JSON file."""
-        try:
-            with open(self.workflow_path, 'r') as file:
-                return json.load(file)
-        except (FileNotFoundError, json.JSONDecodeError) as e:
-            logger.error(f"Error loading workflow: {e}")
-            raise Exception(f"Error loading workflow: {e}")
+    def load_workflow(self) -> WorkflowTemplate:
+        """Load and compile the workflow template once, pruned to the nodes feeding our outputs."""
+        if self.template is None:
+            template = WorkflowTemplate(self.workflow_path, outputs=[self.output_node])
+            if self.history_output_node:
+                self.history_nodes = upstream_nodes(template.workflow, [self.history_output_node])
+            self.template = template
+        return self.template
+
+    def history_workflow(self, workflow: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        The nodes of a queued workflow that feed the history output node, with that node added back.
+
+        ComfyUI reuses the cached outputs of nodes whose inputs did not change, so when the
+        job ran last on the server only the SaveImage node is executed again.
+        """
+        template = self.load_workflow()
+        if self.history_nodes is None:
+            raise Exception("No history output node configured")
+        return {node_id: workflow.get(node_id, template.workflow[node_id]) for node_id in self.history_nodes}
 
     def modify_workflow(self, uploaded_image_path: str, product_data: Dict[str, Any], background_color: str) -> Dict[str, Any]:
         """
@@ -44,179 +98,306 @@ class ComfyUIHandler:
         Args:
             uploaded_image_path: The path of the uploaded image in ComfyUI
             product_data: Dictionary containing product information from the model output
-                Expected keys: 'entity_name', 'product_title'
+                Expected key: 'entity_name'
         """
         try:
-            workflow = self.load_workflow()
+            template = self.load_workflow()
             
             # Extract product information
             product_name = product_data.get('entity_name', '')
-            product_title = product_data.get('product_title', '')
-            
-            if not product_name or not product_title:
+                
+            # Only entity_name is used in the prompts, so the workflow can be built
+            # before the rest of the model output has been generated
+            if not product_name:
                 logger.warning("Missing product information in model output")
                 product_name = "generic product"
-                product_title = "generic title"
 
             # Construct the enhanced prompt
             enhanced_prompt = f"{product_name} with {background_color} background, professional product photography, studio lighting"
             
-            # Update specific nodes
-            try:
-                # Update image input node (node 15)
-                workflow['15']['inputs']['image'] = uploaded_image_path
-                logger.info(f"Updated image path to: {uploaded_image_path}")
-
-                # Update GroundingDino prompt (node 41)
-                workflow['41']['inputs']['prompt'] = product_name
-                logger.info(f"Updated GroundingDino prompt to: {product_name}")
-
-                # Update CLIP Text Encode prompt (node 54)
-                workflow['54']['inputs']['text'] = enhanced_prompt
-                logger.info(f"Updated CLIP Text Encode prompt to: {enhanced_prompt}")
-
-            except KeyError as e:
-                logger.error(f"Failed to update workflow node: {e}")
-                raise Exception(f"Workflow structure mismatch: {e}")
+            workflow = template.render(
+                image=uploaded_image_path,
+                grounding_prompt=product_name,
+                positive_prompt=enhanced_prompt
+            )
+            logger.info(f"Updated image path to: {uploaded_image_path}")
+            logger.info(f"Updated GroundingDino prompt to: {product_name}")
+            logger.info(f"Updated CLIP Text Encode prompt to: {enhanced_prompt}")
                 
             return workflow
         except Exception as e:
             logger.error(f"Error in modify_workflow: {e}")
             raise
 
-    def upload_image(self, image: Image.Image, image_name: str) -> str:
+    def upload_name(self, image: Image.Image, source_bytes: Optional[bytes] = None) -> str:
+        """Content addressed upload name, identical images map to the same server file."""
+        if self.upload_encoding == "original" and source_bytes is not None:
+            digest = hashlib.sha256(source_bytes).hexdigest()
+            extension = (Image.open(io.BytesIO(source_bytes)).format or "png").lower()
+        else:
+            digest = image_hash(image)
+            extension = "webp" if self.upload_encoding == "webp_lossless" else "png"
+        return f"input_{digest[:32]}.{extension}"
+
+    def encode_image(self, image: Image.Image, source_bytes: Optional[bytes] = None) -> Tuple[bytes, str]:
+        """Encode an image for upload, returns the bytes and their content type."""
+        if self.upload_encoding == "original" and source_bytes is not None:
+            image_format = Image.open(io.BytesIO(source_bytes)).format or "PNG"
+            return source_bytes, Image.MIME.get(image_format, "application/octet-stream")
+        img_byte_arr = io.BytesIO()
+        if self.upload_encoding == "webp_lossless":
+            image.save(img_byte_arr, format='WEBP', lossless=True)
+            return img_byte_arr.getvalue(), 'image/webp'
+        image.save(img_byte_arr, format='PNG', compress_level=self.png_compress_level)
+        return img_byte_arr.getvalue(), 'image/png'
+
+    def input_exists(self, image_name: str) -> bool:
+        """
+        Whether the server already has an input file with this name.
+
+        With input_dir the file is looked up there and its mtime refreshed, so that
+        cleanup_inputs does not evict an input that is being reused.
+        """
+        if self.input_dir:
+            try:
+                os.utime(os.path.join(self.input_dir, image_name))
+                return True
+            except FileNotFoundError:
+                return False
+            except OSError as e:
+                logger.warning(f"Could not refresh existing input {image_name}: {e}")
+        try:
+            with tracing.span("comfyui.input_exists"):
+                response = self.session.http.head(
+                    self.session.url("/view"),
+                    params={'filename': image_name, 'type': 'input', 'subfolder': ''},
+                    timeout=self.session.http_timeout
+                )
+            return response.status_code == 200
+        except Exception as e:
+            logger.warning(f"Could not check for existing input {image_name}: {e}")
+            return False
+
+    def upload_image(self, image: Image.Image, image_name: Optional[str] = None,
+                     source_bytes: Optional[bytes] = None) -> str:
         """
         Upload an image to ComfyUI and return the server-side path.
+
+        The upload is named by content hash and skipped when the server already has it.
         """
         try:
-            img_byte_arr = io.BytesIO()
-            image.save(img_byte_arr, format='PNG')
-            img_byte_arr = img_byte_arr.getvalue()
+            image_name = image_name or self.upload_name(image, source_bytes)
+            if self.input_exists(image_name):
+                logger.info(f"Image already on server, skipping upload: {image_name}")
+                self.last_upload_stats = {"name": image_name, "skipped": True, "encode_seconds": 0.0,
+                                          "upload_seconds": 0.0, "bytes": 0}
+                return image_name
+
+            start = time.perf_counter()
+            with tracing.span("comfyui.encode", encoding=self.upload_encoding):
+                img_byte_arr, content_type = self.encode_image(image, source_bytes)
+            encode_seconds = time.perf_counter() - start
             
             multipart_data = MultipartEncoder(
                 fields={
-                    'image': (image_name, img_byte_arr, 'image/png'),
+                    'image': (image_name, img_byte_arr, content_type),
                     'type': 'input',
                     'overwrite': 'true'
                 }
             )
             
             headers = {'Content-Type': multipart_data.content_type}
-            request = urllib.request.Request(
-                f"http://{self.server_address}/upload/image",
-                data=multipart_data,
-                headers=headers
-            )
-            
-            with urllib.request.urlopen(request) as response:
-                response_data = json.loads(response.read())
-                image_path = response_data.get('name', '')
-                if not image_path:
-                    raise Exception("No image path received from server")
-                logger.info(f"Successfully uploaded image: {image_path}")
-                return image_path
+            start = time.perf_counter()
+            with tracing.span("comfyui.upload") as span:
+                response_data = self.session.post("/upload/image", data=multipart_data, headers=headers).json()
+                span.set(bytes=len(img_byte_arr))
+            upload_seconds = time.perf_counter() - start
+            image_path = response_data.get('name', '')
+            if not image_path:
+                raise Exception("No image path received from server")
+            self.last_upload_stats = {"name": image_path, "skipped": False, "encode_seconds": encode_seconds,
+                                      "upload_seconds": upload_seconds, "bytes": len(img_byte_arr)}
+            logger.info(f"Successfully uploaded image: {image_path} ({len(img_byte_arr)} bytes, "
+                        f"encode {encode_seconds:.3f}s, upload {upload_seconds:.3f}s)")
+            self.cleanup_inputs()
+            return image_path
                 
         except Exception as e:
             logger.error(f"Failed to upload image: {e}")
             raise Exception(f"Failed to upload image: {e}")
 
+    def cleanup_inputs(self, force: bool = False) -> int:
+        """
+        Remove old uploads from the ComfyUI input folder, at most once a minute.
+
+        ComfyUI has no API to delete inputs, so this only runs when input_dir points to
+        the server's input folder. Only files named like our uploads are touched.
+        """
+        if not self.input_dir or (not force and time.time() - self.last_cleanup < 60):
+            return 0
+        self.last_cleanup = time.time()
+        removed = 0
+        try:
+            entries = sorted(
+                (entry.stat().st_mtime, entry.path)
+                for entry in os.scandir(self.input_dir)
+                if entry.name.startswith("input_") and entry.is_file()
+            )
+            expired = []
+            if self.max_input_age_hours is not None:
+                cutoff = time.time() - self.max_input_age_hours * 3600
+                expired = [path for mtime, path in entries if mtime < cutoff]
+            if self.max_inputs is not None and len(entries) > self.max_inputs:
+                expired += [path for _, path in entries[:len(entries) - self.max_inputs]]
+            for path in set(expired):
+                os.remove(path)
+                removed += 1
+            if removed:
+                logger.info(f"Removed {removed} old inputs from {self.input_dir}")
+        except OSError as e:
+            logger.error(f"Error cleaning up inputs: {e}")
+        return removed
+
     def queue_prompt(self, workflow: Dict[str, Any]) -> str:
         """Queue a prompt and return the prompt ID."""
         try:
+            # The websocket has to be listening before the prompt starts executing
+            self.session.ensure_websocket()
             p = {"prompt": workflow, "client_id": self.client_id}
-            headers = {'Content-Type': 'application/json'}
-            data = json.dumps(p).encode('utf-8')
-            
-            req = urllib.request.Request(
-                f"http://{self.server_address}/prompt",
-                data=data,
-                headers=headers
-            )
-            response = urllib.request.urlopen(req)
-            prompt_id = json.loads(response.read())['prompt_id']
+            with tracing.span("comfyui.queue_prompt"):
+                try:
+                    prompt_id = self.session.post("/prompt", json=p).json()['prompt_id']
+                except requests.HTTPError as e:
+                    if e.response is not None and e.response.status_code == 400:
+                        raise PromptValidationError(f"Workflow rejected by the server: {e.response.text}") from e
+                    raise
+            node_types = {node_id: node.get('class_type') for node_id, node in workflow.items()}
+            self.session.register(prompt_id, self.websocket_output_nodes(workflow), node_types=node_types,
+                                  workflow=workflow)
             logger.info(f"Successfully queued prompt with ID: {prompt_id}")
             return prompt_id
         except Exception as e:
             logger.error(f"Failed to queue prompt: {e}")
             raise
 
-    def wait_for_completion(self, prompt_id: str) -> None:
-        """Wait for the workflow to complete using WebSocket."""
-        ws = websocket.WebSocket()
+    def websocket_output_nodes(self, workflow: Dict[str, Any]) -> list:
+        """Ids of the SaveImageWebsocket nodes of a workflow."""
+        return [node_id for node_id, node in workflow.items() if node.get('class_type') == 'SaveImageWebsocket']
+
+    def wait_for_completion(self, prompt_id: str, timeout: Optional[float] = None) -> PromptWaiter:
+        """Wait for the workflow to complete on the shared WebSocket, collecting its images."""
         try:
-            ws.connect(f"ws://{self.server_address}/ws?clientId={self.client_id}")
-            logger.info(f"WebSocket connected, waiting for prompt {prompt_id}")
-            
-            while True:
-                out = ws.recv()
-                if isinstance(out, str):
-                    message = json.loads(out)
-                    if message['type'] == 'executing':
-                        if 'node' in message['data']:
-                            logger.debug(f"Processing node: {message['data']['node']}")
-                        if not message['data']['node'] and message['data']['prompt_id'] == prompt_id:
-                            logger.info(f"Workflow completed for prompt {prompt_id}")
-                            break
+            with tracing.span("comfyui.wait"):
+                return self.session.wait(prompt_id, timeout)
         except Exception as e:
             logger.error(f"WebSocket error: {e}")
             raise
-        finally:
-            ws.close()
 
-    def get_result(self, prompt_id: str) -> Image.Image:
-        """Get the resulting image."""
+    def result_image_params(self, outputs: Dict[str, Any]) -> Dict[str, str]:
+        """Query parameters of /view for the result image in the history outputs of a prompt."""
+        if not self.history_output_node:
+            raise Exception("No history output node configured")
+        image_data = outputs[self.history_output_node]['images'][0]
+        return {
+            'filename': image_data['filename'],
+            'type': image_data['type'],
+            'subfolder': image_data['subfolder']
+        }
+
+    def websocket_result(self, waiter: Optional[PromptWaiter]) -> Optional[Image.Image]:
+        """Decode the image the output node sent over the WebSocket, if any."""
+        if waiter is None or not waiter.images.get(self.output_node):
+            return None
         try:
-            with urllib.request.urlopen(f"http://{self.server_address}/history/{prompt_id}") as response:
-                history = json.loads(response.read())
+            with tracing.span("comfyui.ws_decode"):
+                image = Image.open(io.BytesIO(waiter.images[self.output_node][-1]))
+                image.load()
+            return image
+        except Exception as e:
+            logger.error(f"Failed to decode WebSocket image: {e}")
+            return None
 
-            outputs = history[prompt_id]['outputs']
-            last_node = "70"
-            image_data = outputs[last_node]['images'][0]
-            
-            image_url = f"http://{self.server_address}/view?" + urllib.parse.urlencode({
-                'filename': image_data['filename'],
-                'type': image_data['type'],
-                'subfolder': image_data['subfolder']
-            })
-            
-            with urllib.request.urlopen(image_url) as response:
-                logger.info(f"Successfully retrieved result image for prompt {prompt_id}")
-                return Image.open(io.BytesIO(response.read()))
+    def get_result(self, prompt_id: str, waiter: Optional[PromptWaiter] = None) -> Image.Image:
+        """Get the resulting image, from the WebSocket frames when available, else from the history."""
+        try:
+            image = self.websocket_result(waiter)
+            if image is not None:
+                logger.info(f"Received result image over WebSocket for prompt {prompt_id}")
+                return image
+            with tracing.span("comfyui.history"):
+                history = self.session.get(f"/history/{prompt_id}").json()
+                outputs = history[prompt_id]['outputs']
+                if self.history_output_node not in outputs and waiter is not None and waiter.workflow is not None:
+                    logger.warning(f"No result image for prompt {prompt_id}, running the history output node")
+                    history_prompt_id = self.queue_prompt(self.history_workflow(waiter.workflow))
+                    self.wait_for_completion(history_prompt_id)
+                    outputs = self.session.get(f"/history/{history_prompt_id}").json()[history_prompt_id]['outputs']
+
+            with tracing.span("comfyui.view"):
+                response = self.session.get("/view", params=self.result_image_params(outputs))
+            logger.info(f"Successfully retrieved result image for prompt {prompt_id}")
+            return Image.open(io.BytesIO(response.content))
         except Exception as e:
             logger.error(f"Failed to get result: {e}")
             raise
 
-    def generate_enhanced_image(self, input_image: Image.Image, product_data: Dict[str, Any]) -> Optional[Image.Image]:
+    def generate_enhanced_image(self, input_image: Image.Image, product_data: Dict[str, Any],
+                                source_bytes: Optional[bytes] = None,
+                                color_image: Optional[Image.Image] = None) -> Optional[Image.Image]:
         """
         Main method to generate enhanced image using ComfyUI.
         
         Args:
             input_image: The input PIL Image
             product_data: Dictionary containing product information from the model output
-                Expected keys: 'entity_name', 'product_title'
+                Expected key: 'entity_name'
+            source_bytes: Original file bytes of input_image, sent as they are with 'original' encoding
+            color_image: Smaller copy of input_image the background colour is detected on, see ingest.py
         """
+        graph = self.enhancement_graph(input_image, source_bytes=source_bytes, color_image=color_image)
         try:
-            # Generate a unique name for the image
-            image_name = f"input_{uuid.uuid4()}.png"
-            
-            # Upload the image and get the server-side path
-            uploaded_image_path = self.upload_image(input_image, image_name)
-            
-            background_color = self.color_detector.get_color_name(input_image)
-            logger.info(f"Detected background color: {background_color}")
-            
-            # Modify workflow with new image path and prompts
-            modified_workflow = self.modify_workflow(uploaded_image_path, product_data, background_color)
-            
-            # Queue the prompt and get prompt ID
-            prompt_id = self.queue_prompt(modified_workflow)
-            
-            # Wait for completion
-            self.wait_for_completion(prompt_id)
-            
-            # Get and return the result
-            return self.get_result(prompt_id)
+            graph.set_result("product_data", product_data)
+            return graph.result("result")
             
         except Exception as e:
             logger.error(f"Error in generate_enhanced_image: {e}")
-            return None
\ No newline at end of file
+            return None
+        finally:
+            logger.info(f"Enhancement stages: {graph.report()}")
+            graph.close()
+
+    def enhancement_graph(self, input_image: Image.Image, source_bytes: Optional[bytes] = None,
+                          graph: Optional[StageGraph] = None,
+                          color_image: Optional[Image.Image] = None) -> StageGraph:
+        """
+        Add the enhancement stages to a stage graph, a new one by default.
+
+        Uploading the image and detecting the background colour do not depend on the
+        model output, they start right away. Only patching the workflow waits for the
+        external 'product_data' stage, which the caller resolves with
+        graph.set_result("product_data", ...) once entity_name is known. The enhanced
+        image is the result of the 'result' stage.
+        """
+        graph = graph or StageGraph()
+
+        def detect_color():
+            background_color = self.color_detector.get_color_name(color_image if color_image is not None else input_image)
+            logger.info(f"Detected background color: {background_color}")
+            return background_color
+
+        # Upload the image under its content hash and get the server-side path
+        graph.add("upload", lambda: self.upload_image(input_image, source_bytes=source_bytes))
+        graph.add("color", detect_color)
+        graph.add("product_data")
+        # Modify workflow with new image path and prompts
+        graph.add("workflow", lambda upload, color, product_data: self.modify_workflow(upload, product_data, color),
+                  deps=("upload", "color", "product_data"))
+        graph.add("queue", lambda workflow: self.queue_prompt(workflow), deps=("workflow",))
+        # Wait for completion, collecting the SaveImageWebsocket images
+        graph.add("wait", lambda queue: self.wait_for_completion(queue), deps=("queue",))
+        graph.add("result", lambda queue, wait: self.get_result(queue, wait), deps=("queue", "wait"))
+        return graph
+
+    def close(self) -> None:
+        """Close the pooled HTTP connections and the WebSocket."""
+        self.session.close()
@@ -0,0 +1,349 @@
+import io
+import json
+import time
+import uuid
+import asyncio
+import logging
+import threading
+import concurrent.futures
+from typing import Dict, Any, Optional, List, Tuple
+
+import aiohttp
+from PIL import Image
+
+from comfyui import ComfyUIHandler
+from comfyui_session import PromptEvents, PromptWaiter, PromptExecutionError, PromptValidationError
+
+logger = logging.getLogger('ComfyUI')
+
+
+class AsyncComfyUIClient:
+    def __init__(self, server_address: str = "127.0.0.1:8188", workflow_path: str = "workflow.json",
+                 max_queue_depth: int = 8, queue_poll_interval: float = 0.5, http_timeout: float = 60,
+                 handler: Optional[ComfyUIHandler] = None):
+        """
+        Asyncio ComfyUI client, so uploads, queueing, completion waits and downloads of
+        many enhancement jobs overlap.
+
+        Args:
+            server_address (str): host:port of the ComfyUI server
+            workflow_path (str): Workflow template used for every job
+            max_queue_depth (int): New prompts are held back while the server queue
+                (running + pending) is at least this deep
+            queue_poll_interval (float): Seconds between /queue checks while held back
+            http_timeout (float): Timeout of a single HTTP request in seconds
+            handler (ComfyUIHandler): Handler whose workflow building and colour detection
+                are reused, one is created when not given
+        """
+        self.server_address = server_address
+        self.max_queue_depth = max_queue_depth
+        self.queue_poll_interval = queue_poll_interval
+        self.http_timeout = aiohttp.ClientTimeout(total=http_timeout)
+        self.handler = handler or ComfyUIHandler(server_address=server_address, workflow_path=workflow_path)
+        self.client_id = str(uuid.uuid4())
+
+        self.http: Optional[aiohttp.ClientSession] = None
+        self.ws_task: Optional[asyncio.Task] = None
+        self.connected: Optional[asyncio.Event] = None
+        self.queue_lock: Optional[asyncio.Lock] = None
+        self.events = PromptEvents(asyncio.Event)
+
+    async def __aenter__(self) -> "AsyncComfyUIClient":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
+
+    async def start(self) -> None:
+        """Open the HTTP session and connect the WebSocket."""
+        if self.http is not None:
+            return
+        self.http = aiohttp.ClientSession(timeout=self.http_timeout)
+        self.connected = asyncio.Event()
+        self.queue_lock = asyncio.Lock()
+        self.ws_task = asyncio.ensure_future(self._run_websocket())
+        await asyncio.wait_for(self.connected.wait(), 10)
+
+    async def close(self) -> None:
+        if self.ws_task is not None:
+            self.ws_task.cancel()
+            try:
+                await self.ws_task
+            except asyncio.CancelledError:
+                pass
+            self.ws_task = None
+        if self.http is not None:
+            await self.http.close()
+            self.http = None
+
+    def url(self, path: str) -> str:
+        return f"http://{self.server_address}{path}"
+
+    async def input_exists(self, image_name: str) -> bool:
+        """Whether the server already has an input file with this name."""
+        try:
+            params = {'filename': image_name, 'type': 'input', 'subfolder': ''}
+            async with self.http.head(self.url("/view"), params=params) as response:
+                return response.status == 200
+        except Exception as e:
+            logger.warning(f"Could not check for existing input {image_name}: {e}")
+            return False
+
+    async def upload_image(self, image: Image.Image, image_name: Optional[str] = None,
+                           source_bytes: Optional[bytes] = None) -> str:
+        """Upload an image to ComfyUI under its content hash and return the server-side path."""
+        try:
+            loop = asyncio.get_running_loop()
+            image_name = image_name or await loop.run_in_executor(None, self.handler.upload_name, image, source_bytes)
+            if await self.input_exists(image_name):
+                logger.info(f"Image already on server, skipping upload: {image_name}")
+                return image_name
+            start = time.perf_counter()
+            img_bytes, content_type = await loop.run_in_executor(None, self.handler.encode_image, image, source_bytes)
+            encode_seconds = time.perf_counter() - start
+            form = aiohttp.FormData()
+            form.add_field('image', img_bytes, filename=image_name, content_type=content_type)
+            form.add_field('type', 'input')
+            form.add_field('overwrite', 'true')
+            start = time.perf_counter()
+            async with self.http.post(self.url("/upload/image"), data=form) as response:
+                response.raise_for_status()
+                image_path = (await response.json()).get('name', '')
+            upload_seconds = time.perf_counter() - start
+            if not image_path:
+                raise Exception("No image path received from server")
+            logger.info(f"Successfully uploaded image: {image_path} ({len(img_bytes)} bytes, "
+                        f"encode {encode_seconds:.3f}s, upload {upload_seconds:.3f}s)")
+            await loop.run_in_executor(None, self.handler.cleanup_inputs)
+            return image_path
+        except Exception as e:
+            logger.error(f"Failed to upload image: {e}")
+            raise Exception(f"Failed to upload image: {e}")
+
+    async def queue_depth(self) -> int:
+        async with self.http.get(self.url("/queue")) as response:
+            response.raise_for_status()
+            queue = await response.json()
+        return len(queue.get('queue_running', [])) + len(queue.get('queue_pending', []))
+
+    async def wait_for_queue_capacity(self) -> None:
+        """Hold back new prompts while the server queue is at max_queue_depth."""
+        while True:
+            depth = await self.queue_depth()
+            if depth < self.max_queue_depth:
+                return
+            logger.debug(f"ComfyUI queue depth {depth}, waiting before queueing")
+            await asyncio.sleep(self.queue_poll_interval)
+
+    async def queue_prompt(self, workflow: Dict[str, Any]) -> str:
+        """Queue a prompt once the server has capacity and return the prompt ID."""
+        try:
+            # Serialised so that concurrent jobs do not all see the same free slot
+            async with self.queue_lock:
+                await self.wait_for_queue_capacity()
+                p = {"prompt": workflow, "client_id": self.client_id}
+                async with self.http.post(self.url("/prompt"), json=p) as response:
+                    if response.status == 400:
+                        raise PromptValidationError(f"Workflow rejected by the server: {await response.text()}")
+                    response.raise_for_status()
+                    prompt_id = (await response.json())['prompt_id']
+            node_types = {node_id: node.get('class_type') for node_id, node in workflow.items()}
+            self.events.register(prompt_id, self.handler.websocket_output_nodes(workflow), node_types=node_types,
+                                 workflow=workflow)
+            logger.info(f"Successfully queued prompt with ID: {prompt_id}")
+            return prompt_id
+        except Exception as e:
+            logger.error(f"Failed to queue prompt: {e}")
+            raise
+
+    async def wait_for_completion(self, prompt_id: str, timeout: Optional[float] = None) -> PromptWaiter:
+        """Wait for the workflow to complete on the shared WebSocket."""
+        waiter = self.events.register(prompt_id)
+        try:
+            await asyncio.wait_for(waiter.done.wait(), timeout)
+            if waiter.error:
+                raise PromptExecutionError(f"Prompt {prompt_id} failed: {waiter.error}")
+            logger.info(f"Workflow completed for prompt {prompt_id}")
+            return waiter
+        finally:
+            self.events.unregister(prompt_id)
+
+    async def history_outputs(self, prompt_id: str) -> Dict[str, Any]:
+        async with self.http.get(self.url(f"/history/{prompt_id}")) as response:
+            response.raise_for_status()
+            history = await response.json()
+        return history[prompt_id]['outputs']
+
+    async def get_result(self, prompt_id: str, waiter: Optional[PromptWaiter] = None) -> Image.Image:
+        """Get the resulting image, from the websocket frames when available, else from the history."""
+        try:
+            image = self.handler.websocket_result(waiter)
+            if image is not None:
+                logger.info(f"Received result image over WebSocket for prompt {prompt_id}")
+                return image
+            outputs = await self.history_outputs(prompt_id)
+            if self.handler.history_output_node not in outputs and waiter is not None and waiter.workflow is not None:
+                logger.warning(f"No result image for prompt {prompt_id}, running the history output node")
+                history_prompt_id = await self.queue_prompt(self.handler.history_workflow(waiter.workflow))
+                await self.wait_for_completion(history_prompt_id)
+                outputs = await self.history_outputs(history_prompt_id)
+            params = self.handler.result_image_params(outputs)
+            async with self.http.get(self.url("/view"), params=params) as response:
+                response.raise_for_status()
+                data = await response.read()
+            logger.info(f"Successfully retrieved result image for prompt {prompt_id}")
+            return Image.open(io.BytesIO(data))
+        except Exception as e:
+            logger.error(f"Failed to get result: {e}")
+            raise
+
+    async def generate_enhanced_image(self, input_image: Image.Image, product_data: Dict[str, Any],
+                                      source_bytes: Optional[bytes] = None,
+                                      color_image: Optional[Image.Image] = None) -> Optional[Image.Image]:
+        """
+        Async counterpart of ComfyUIHandler.generate_enhanced_image.
+
+        Args:
+            input_image: The input PIL Image
+            product_data: Dictionary containing product information from the model output
+                Expected key: 'entity_name'
+            source_bytes: Original file bytes of input_image, sent as they are with 'original' encoding
+            color_image: Smaller copy of input_image the background colour is detected on, see ingest.py
+        """
+        try:
+            await self.start()
+            loop = asyncio.get_running_loop()
+            # Colour detection is CPU bound, run it while the upload is in flight
+            upload = self.upload_image(input_image, source_bytes=source_bytes)
+            color = loop.run_in_executor(None, self.handler.color_detector.get_color_name,
+                                         color_image if color_image is not None else input_image)
+            uploaded_image_path, background_color = await asyncio.gather(upload, color)
+            logger.info(f"Detected background color: {background_color}")
+
+            modified_workflow = self.handler.modify_workflow(uploaded_image_path, product_data, background_color)
+            prompt_id = await self.queue_prompt(modified_workflow)
+            waiter = await self.wait_for_completion(prompt_id)
+            return await self.get_result(prompt_id, waiter)
+        except Exception as e:
+            logger.error(f"Error in generate_enhanced_image: {e}")
+            return None
+
+    async def gather(self, jobs: List[Tuple[Image.Image, Dict[str, Any]]], concurrency: int = 4) -> List[Optional[Image.Image]]:
+        """
+        Enhance many images with at most `concurrency` jobs in flight.
+
+        Args:
+            jobs: (input image, product data) pairs
+            concurrency: Maximum number of jobs processed at the same time
+
+        Returns:
+            Enhanced images in the order of the jobs, None for failed jobs
+        """
+        await self.start()
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run(image, product_data):
+            async with semaphore:
+                return await self.generate_enhanced_image(image, product_data)
+
+        return await asyncio.gather(*(run(image, product_data) for image, product_data in jobs))
+
+    async def _run_websocket(self) -> None:
+        delay = 1.0
+        while True:
+            try:
+                async with self.http.ws_connect(f"ws://{self.server_address}/ws?clientId={self.client_id}") as ws:
+                    logger.info(f"WebSocket connected to {self.server_address}")
+                    delay = 1.0
+                    self.connected.set()
+                    await self._check_pending()
+                    async for message in ws:
+                        if message.type == aiohttp.WSMsgType.TEXT:
+                            self.events.dispatch(json.loads(message.data))
+                        elif message.type == aiohttp.WSMsgType.BINARY:
+                            self.events.dispatch_frame(message.data)
+                        elif message.type == aiohttp.WSMsgType.ERROR:
+                            break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"WebSocket error: {e}")
+            self.connected.clear()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
+
+    async def _check_pending(self) -> None:
+        """After a reconnect, finish waiters whose prompt completed while the socket was down."""
+        for waiter in self.events.pending():
+            try:
+                async with self.http.get(self.url(f"/history/{waiter.prompt_id}")) as response:
+                    history = await response.json()
+            except Exception as e:
+                logger.error(f"Failed to check history of prompt {waiter.prompt_id}: {e}")
+                continue
+            if waiter.prompt_id in history:
+                for node, output in history[waiter.prompt_id].get('outputs', {}).items():
+                    waiter.outputs.setdefault(node, output)
+                waiter.done.set()
+
+
+class EnhancementLoop:
+    def __init__(self, client: AsyncComfyUIClient, concurrency: int = 4):
+        """
+        Runs an AsyncComfyUIClient on an event loop thread for callers that are not async,
+        e.g. batch.py. At most `concurrency` enhancement jobs are in flight, the client
+        also holds back prompts while the server queue is at its max_queue_depth.
+
+            enhancer = EnhancementLoop(AsyncComfyUIClient(address, handler=handler)).start()
+            future = enhancer.run(enhancer.enhance(image, product_data))
+            enhancer.close()
+
+        Args:
+            client (AsyncComfyUIClient): Client the jobs run on
+            concurrency (int): Maximum number of jobs processed at the same time
+        """
+        self.client = client
+        self.concurrency = concurrency
+        self.loop = asyncio.new_event_loop()
+        self.thread: Optional[threading.Thread] = None
+        self.semaphore: Optional[asyncio.Semaphore] = None
+
+    def start(self) -> "EnhancementLoop":
+        """Start the event loop thread and connect the client."""
+        self.thread = threading.Thread(target=self.loop.run_forever, name="comfyui-async", daemon=True)
+        self.thread.start()
+        self.run(self._start()).result()
+        return self
+
+    async def _start(self) -> None:
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        await self.client.start()
+
+    def run(self, coroutine) -> concurrent.futures.Future:
+        """Schedule a coroutine on the loop, from any thread."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    async def enhance(self, input_image: Image.Image, product_data: Dict[str, Any], source_bytes: Optional[bytes] = None,
+                      color_image: Optional[Image.Image] = None) -> Optional[Image.Image]:
+        """AsyncComfyUIClient.generate_enhanced_image, waiting for a free slot first."""
+        async with self.semaphore:
+            return await self.client.generate_enhanced_image(input_image, product_data, source_bytes=source_bytes,
+                                                             color_image=color_image)
+
+    def close(self) -> None:
+        """Close the client and stop the loop, jobs still running are cancelled."""
+        if self.thread is None:
+            return
+        self.run(self._close()).result(30)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(10)
+        self.loop.close()
+        self.thread = None
+
+    async def _close(self) -> None:
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.client.close()
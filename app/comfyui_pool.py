@@ -0,0 +1,308 @@
+"""
+Several ComfyUI servers behind the interface of one ComfyUIHandler.
+
+Every enhancement job is routed to the healthy server with the shortest queue: the
+running and pending prompts of its last /queue, updated as our prompts are queued and
+finish, plus the jobs routed to it that have not queued their prompt yet. The upload, the prompt, the websocket wait and the /history
+lookup of a job stay on that server, since inputs and history are per server. When
+one of them fails, the server is marked down and the job is uploaded and queued again
+on another server, up to max_attempts servers. A background thread probes /queue of
+every server: a server that stops answering is marked down and the prompts waiting on
+it are released so they are resubmitted, a server that is down is probed again after
+a growing delay and takes jobs again once it answers.
+
+    pool = ComfyUIPool([ComfyUIHandler(server_address=address) for address in servers])
+    enhanced_image = pool.generate_enhanced_image(image, product_data)
+"""
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Set
+
+from PIL import Image
+
+import tracing
+from comfyui import ComfyUIHandler
+from comfyui_session import PromptExecutionError, PromptValidationError, PromptWaiter
+from pipeline import StageGraph
+
+logger = logging.getLogger('ComfyUIPool')
+
+
+class PoolMember:
+    def __init__(self, handler: ComfyUIHandler):
+        """Routing and health state of one server of the pool."""
+        self.handler = handler
+        self.address = handler.server_address
+        self.healthy = True
+        # Consecutive failures, each doubles the delay before the next probe, a completed prompt resets them
+        self.failures = 0
+        self.retry_at = 0.0
+        self.last_error: Optional[str] = None
+        # Prompts of the last /queue, counting ours as they are queued and finish until the
+        # next probe, and jobs routed here that have not queued their prompt yet
+        self.queue_depth = 0
+        self.reserved = 0
+        self.jobs = 0
+        self.failovers = 0
+        # Moving average of the seconds from queueing a prompt to its completion
+        self.prompt_seconds: Optional[float] = None
+
+    def load(self) -> int:
+        return self.queue_depth + self.reserved
+
+
+class PooledJob:
+    def __init__(self, image: Image.Image, source_bytes: Optional[bytes] = None):
+        """Server an enhancement job is pinned to, and the servers it already failed on."""
+        self.image = image
+        self.source_bytes = source_bytes
+        self.member: Optional[PoolMember] = None
+        self.reserved = False
+        self.image_path: Optional[str] = None
+        # (product_data, background colour) to build the workflow again after a failover
+        self.workflow_args: Optional[tuple] = None
+        self.prompt_id: Optional[str] = None
+        self.queued_at: Optional[float] = None
+        self.waiter: Optional[PromptWaiter] = None
+        self.failed: Set[str] = set()
+
+
+class ComfyUIPool:
+    def __init__(self, handlers: List[ComfyUIHandler], health_interval: float = 5.0, probe_timeout: float = 2.0,
+                 max_attempts: int = 2, max_retry_delay: float = 60.0):
+        """
+        Args:
+            handlers (list): One ComfyUIHandler per server, the first one also builds the
+                workflows and detects the background colour
+            health_interval (float): Seconds between /queue probes of the servers
+            probe_timeout (float): Timeout of a /queue request in seconds
+            max_attempts (int): Servers a job is tried on before it fails
+            max_retry_delay (float): Longest delay before a server that is down is probed again
+        """
+        if not handlers:
+            raise ValueError("ComfyUIPool needs at least one server")
+        self.members = [PoolMember(handler) for handler in handlers]
+        self.handler = handlers[0]
+        self.health_interval = health_interval
+        self.probe_timeout = probe_timeout
+        self.max_attempts = max_attempts
+        self.max_retry_delay = max_retry_delay
+        self.lock = threading.Lock()
+        self.probes = ThreadPoolExecutor(len(self.members), thread_name_prefix="comfyui-probe")
+        self.stopped = threading.Event()
+        self.health_thread = threading.Thread(target=self._check_health, daemon=True)
+        self.health_thread.start()
+
+    def probe(self, member: PoolMember) -> Optional[int]:
+        """Read the queue length of a server, marking it down when it does not answer."""
+        try:
+            queue = member.handler.session.get("/queue", timeout=self.probe_timeout).json()
+        except Exception as e:
+            self.mark_down(member, e, abort=True)
+            return None
+        depth = len(queue.get('queue_running', [])) + len(queue.get('queue_pending', []))
+        with self.lock:
+            member.queue_depth = depth
+            recovered = not member.healthy
+            member.healthy = True
+        if recovered:
+            logger.info(f"ComfyUI server {member.address} is back, queue {depth}")
+        return depth
+
+    def mark_down(self, member: PoolMember, error: Exception, abort: bool = False) -> None:
+        """
+        Stop routing to a server until a probe after the retry delay succeeds.
+
+        With abort the prompts waiting on it are released, for when the server itself
+        stopped answering rather than one request failing.
+        """
+        with self.lock:
+            member.failures += 1
+            member.last_error = str(error)
+            member.retry_at = time.monotonic() + min(self.health_interval * 2 ** (member.failures - 1),
+                                                     self.max_retry_delay)
+            was_healthy = member.healthy
+            member.healthy = False
+        if was_healthy:
+            logger.warning(f"ComfyUI server {member.address} marked down: {error}")
+            tracing.count("comfyui.server_down", server=member.address)
+        if abort:
+            member.handler.session.abort_pending(f"server {member.address} is down: {error}")
+
+    def route(self, job: PooledJob) -> PoolMember:
+        """Pin a job to the healthy server with the shortest queue it has not failed on."""
+        with tracing.span("comfyui.route"):
+            with self.lock:
+                candidates = [member for member in self.members if member.healthy and member.address not in job.failed]
+                if not candidates:
+                    raise ConnectionError(f"No healthy ComfyUI server left, failed on {sorted(job.failed)}")
+                # Ties go to the server that finished prompts faster, then to the one with fewer jobs
+                member = min(candidates, key=lambda m: (m.load(), m.prompt_seconds or 0.0, m.jobs))
+                member.reserved += 1
+                member.jobs += 1
+                load = member.load()
+        job.member = member
+        job.reserved = True
+        tracing.count("comfyui.routed", server=member.address)
+        logger.info(f"Routed job to {member.address}, load {load}")
+        return member
+
+    def release(self, job: PooledJob) -> None:
+        """Drop the reservation of a job, once its prompt shows up in /queue or it ended."""
+        with self.lock:
+            if job.reserved:
+                job.member.reserved -= 1
+                job.reserved = False
+
+    def failover(self, job: PooledJob, error: Exception) -> None:
+        """Mark the server of a failed job down, raises when the job has no attempts left."""
+        member = job.member
+        self.release(job)
+        job.failed.add(member.address)
+        with self.lock:
+            member.failovers += 1
+        self.mark_down(member, error)
+        tracing.count("comfyui.failover", server=member.address)
+        if len(job.failed) >= self.max_attempts or len(job.failed) >= len(self.members):
+            raise ConnectionError(f"Enhancement failed on {len(job.failed)} servers, last {member.address}: {error}")
+        logger.warning(f"Job failed on {member.address}, resubmitting: {error}")
+
+    def upload(self, job: PooledJob) -> str:
+        """Route the job and upload its image to that server, to the next one when it fails."""
+        while True:
+            member = self.route(job)
+            try:
+                job.image_path = member.handler.upload_image(job.image, source_bytes=job.source_bytes)
+                return job.image_path
+            except Exception as e:
+                self.failover(job, e)
+
+    def resubmit(self, job: PooledJob, error: Exception) -> str:
+        """Upload the image and queue the prompt of a failed job on another server."""
+        self.failover(job, error)
+        self.upload(job)
+        return self.queue(job, self.handler.modify_workflow(job.image_path, *job.workflow_args))
+
+    def queue(self, job: PooledJob, workflow: Dict[str, Any]) -> str:
+        try:
+            job.prompt_id = job.member.handler.queue_prompt(workflow)
+        except PromptValidationError:
+            # The workflow itself is invalid, it would be rejected by every server
+            raise
+        except Exception as e:
+            return self.resubmit(job, e)
+        job.queued_at = time.perf_counter()
+        with self.lock:
+            # Counted until the next probe reads the queue of the server
+            job.member.queue_depth += 1
+        self.release(job)
+        return job.prompt_id
+
+    def wait(self, job: PooledJob) -> PromptWaiter:
+        while True:
+            try:
+                job.waiter = job.member.handler.wait_for_completion(job.prompt_id)
+                break
+            except PromptExecutionError:
+                # The workflow itself failed, it would fail on every server
+                raise
+            except Exception as e:
+                self.resubmit(job, e)
+        seconds = time.perf_counter() - job.queued_at
+        member = job.member
+        with self.lock:
+            member.failures = 0
+            member.queue_depth = max(member.queue_depth - 1, 0)
+            member.prompt_seconds = seconds if member.prompt_seconds is None else 0.8 * member.prompt_seconds + 0.2 * seconds
+        return job.waiter
+
+    def result(self, job: PooledJob) -> Image.Image:
+        while True:
+            try:
+                return job.member.handler.get_result(job.prompt_id, job.waiter)
+            except Exception as e:
+                self.resubmit(job, e)
+                self.wait(job)
+
+    def generate_enhanced_image(self, input_image: Image.Image, product_data: Dict[str, Any],
+                                source_bytes: Optional[bytes] = None,
+                                color_image: Optional[Image.Image] = None) -> Optional[Image.Image]:
+        """Same as ComfyUIHandler.generate_enhanced_image, on the server picked for the job."""
+        graph = self.enhancement_graph(input_image, source_bytes=source_bytes, color_image=color_image)
+        try:
+            graph.set_result("product_data", product_data)
+            return graph.result("result")
+        except Exception as e:
+            logger.error(f"Error in generate_enhanced_image: {e}")
+            return None
+        finally:
+            logger.info(f"Enhancement stages: {graph.report()}")
+            graph.close()
+
+    def enhancement_graph(self, input_image: Image.Image, source_bytes: Optional[bytes] = None,
+                          graph: Optional[StageGraph] = None,
+                          color_image: Optional[Image.Image] = None) -> StageGraph:
+        """
+        The stages of ComfyUIHandler.enhancement_graph, pinned to one server.
+
+        The server is picked when the upload starts, before the model output is known.
+        The 'queue', 'wait' and 'result' stages resubmit the job to another server when
+        theirs fails, so they can include a second upload.
+        """
+        graph = graph or StageGraph()
+        job = PooledJob(input_image, source_bytes)
+
+        def detect_color():
+            background_color = self.handler.color_detector.get_color_name(color_image if color_image is not None else input_image)
+            logger.info(f"Detected background color: {background_color}")
+            return background_color
+
+        def build_workflow(upload, color, product_data):
+            job.workflow_args = (product_data, color)
+            return self.handler.modify_workflow(upload, product_data, color)
+
+        graph.add("upload", lambda: self.upload(job))
+        graph.add("color", detect_color)
+        graph.add("product_data")
+        graph.add("workflow", build_workflow, deps=("upload", "color", "product_data"))
+        graph.add("queue", lambda workflow: self.queue(job, workflow), deps=("workflow",))
+        graph.add("wait", lambda queue: self.wait(job), deps=("queue",))
+        result = graph.add("result", lambda wait: self.result(job), deps=("wait",))
+        # A job that fails before queueing its prompt still holds its reservation
+        result.add_done_callback(lambda _: self.release(job))
+        return graph
+
+    def stats(self) -> List[Dict[str, Any]]:
+        """Health, load and job count of every server."""
+        with self.lock:
+            return [{
+                "address": member.address,
+                "healthy": member.healthy,
+                "queue_depth": member.queue_depth,
+                "reserved": member.reserved,
+                "jobs": member.jobs,
+                "failovers": member.failovers,
+                "failures": member.failures,
+                "prompt_seconds": member.prompt_seconds,
+                "last_error": member.last_error
+            } for member in self.members]
+
+    def close(self) -> None:
+        """Stop the health checks and close the connections to every server."""
+        self.stopped.set()
+        self.health_thread.join(self.probe_timeout + 1)
+        self.probes.shutdown(wait=False)
+        for member in self.members:
+            member.handler.close()
+
+    def _check_health(self) -> None:
+        while not self.stopped.wait(self.health_interval):
+            now = time.monotonic()
+            due = [member for member in self.members if member.healthy or now >= member.retry_at]
+            try:
+                list(self.probes.map(self.probe, due))
+            except RuntimeError:
+                # The probe pool was shut down by close()
+                return
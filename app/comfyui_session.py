@@ -0,0 +1,304 @@
+import json
+import time
+import struct
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+import requests
+import websocket
+from requests.adapters import HTTPAdapter
+
+import tracing
+
+logger = logging.getLogger('ComfyUI')
+
+# Binary websocket event carrying an image, as sent by SaveImageWebsocket nodes
+PREVIEW_IMAGE = 1
+
+
+class PromptExecutionError(Exception):
+    """The server ran the prompt and reported an execution error, resubmitting it elsewhere does not help."""
+
+
+class PromptValidationError(PromptExecutionError):
+    """The server rejected the prompt with 400 as an invalid workflow, every server would reject it."""
+
+
+def parse_image_frame(frame: bytes) -> Optional[bytes]:
+    """Return the encoded image of a binary websocket frame, None for other events."""
+    if len(frame) < 8:
+        return None
+    event_type, _image_format = struct.unpack(">II", frame[:8])
+    if event_type != PREVIEW_IMAGE:
+        return None
+    return frame[8:]
+
+
+class PromptWaiter:
+    """Collects the websocket events of one queued prompt until it has finished executing."""
+
+    def __init__(self, prompt_id: str, done=None, image_nodes=None, node_types=None, workflow=None):
+        self.prompt_id = prompt_id
+        # threading.Event by default, the async client passes an asyncio.Event
+        self.done = done or threading.Event()
+        # Nodes whose websocket images are kept, None keeps all of them
+        self.image_nodes = set(image_nodes) if image_nodes is not None else None
+        self.outputs: Dict[str, Any] = {}
+        self.images: Dict[str, list] = {}
+        self.error: Optional[str] = None
+        # Set when the wait was given up without a result from the server, see abort_pending
+        self.aborted: Optional[str] = None
+        self.current_node: Optional[str] = None
+        # Node id to class_type, labels the per-node execution times
+        self.node_types = node_types or {}
+        # The queued workflow, to run the history output node for it when no image arrived
+        self.workflow: Optional[Dict[str, Any]] = workflow
+        self.registered = time.perf_counter()
+        self.node_started: Optional[float] = None
+
+    def handle(self, message: Dict[str, Any]) -> None:
+        data = message.get('data', {})
+        if message['type'] == 'executing':
+            self.trace_node(data.get('node'), message.get('received') or time.perf_counter())
+            self.current_node = data.get('node')
+            if self.current_node is None:
+                self.done.set()
+            else:
+                logger.debug(f"Processing node: {self.current_node}")
+        elif message['type'] == 'executed':
+            self.outputs[data['node']] = data.get('output')
+        elif message['type'] == 'image':
+            node = data['node']
+            if self.image_nodes is None or node in self.image_nodes:
+                self.images.setdefault(node, []).append(data['image'])
+        elif message['type'] == 'execution_error':
+            self.error = data.get('exception_message', 'execution error')
+            self.done.set()
+
+    def trace_node(self, next_node: Optional[str], now: float) -> None:
+        """Time spent queued before the first node and in each node, from the 'executing' events."""
+        if not tracing.enabled():
+            return
+        if self.node_started is None:
+            tracing.observe("comfyui.queued", max(0.0, now - self.registered))
+        elif self.current_node is not None:
+            node_type = self.node_types.get(self.current_node, "unknown")
+            tracing.observe("comfyui.node", now - self.node_started, node=self.current_node, class_type=node_type)
+        self.node_started = now
+
+
+class PromptEvents:
+    def __init__(self, event_factory: Callable[[], Any] = threading.Event, max_early_events: int = 256):
+        """
+        Routes the websocket events of one client id to the waiters of its prompts.
+
+        Events of prompts that are not registered yet are kept and replayed on
+        registration: a short workflow can start executing before queue_prompt has
+        returned its id. The server executes one prompt at a time, so binary frames
+        belong to the node of the last 'executing' event. Shared by ComfyUISession and
+        the asyncio client, which passes asyncio.Event as event_factory.
+
+        Args:
+            event_factory (callable): Creates the 'done' event of each PromptWaiter
+            max_early_events (int): Prompts whose early events are kept, the oldest are dropped
+        """
+        self.event_factory = event_factory
+        self.max_early_events = max_early_events
+        self.lock = threading.Lock()
+        self.waiters: Dict[str, PromptWaiter] = {}
+        self.early_events: "OrderedDict[str, list]" = OrderedDict()
+        self.current_prompt: Optional[str] = None
+        self.current_node: Optional[str] = None
+
+    def register(self, prompt_id: str, image_nodes=None, node_types=None, workflow=None) -> PromptWaiter:
+        """Start collecting the events of a prompt, including ones that arrived before."""
+        with self.lock:
+            waiter = self.waiters.get(prompt_id)
+            if waiter is None:
+                waiter = PromptWaiter(prompt_id, done=self.event_factory(), image_nodes=image_nodes,
+                                      node_types=node_types, workflow=workflow)
+                self.waiters[prompt_id] = waiter
+                for message in self.early_events.pop(prompt_id, []):
+                    waiter.handle(message)
+            return waiter
+
+    def unregister(self, prompt_id: str) -> None:
+        with self.lock:
+            self.waiters.pop(prompt_id, None)
+
+    def pending(self) -> List[PromptWaiter]:
+        """Waiters whose prompt has not finished."""
+        with self.lock:
+            return [waiter for waiter in self.waiters.values() if not waiter.done.is_set()]
+
+    def dispatch_frame(self, frame: bytes) -> None:
+        image = parse_image_frame(frame)
+        if image is not None and self.current_prompt is not None:
+            self.dispatch({
+                'type': 'image',
+                'data': {'prompt_id': self.current_prompt, 'node': self.current_node, 'image': image}
+            })
+
+    def dispatch(self, message: Dict[str, Any]) -> None:
+        data = message.get('data')
+        if not isinstance(data, dict) or 'prompt_id' not in data:
+            return
+        prompt_id = data['prompt_id']
+        # Events of unregistered prompts are handled later, keep their arrival time
+        message['received'] = time.perf_counter()
+        if message['type'] == 'executing':
+            self.current_node = data.get('node')
+            self.current_prompt = prompt_id if self.current_node is not None else None
+        with self.lock:
+            waiter = self.waiters.get(prompt_id)
+            if waiter is None:
+                self.early_events.setdefault(prompt_id, []).append(message)
+                while len(self.early_events) > self.max_early_events:
+                    self.early_events.popitem(last=False)
+                return
+        waiter.handle(message)
+
+
+class ComfyUISession:
+    def __init__(self, server_address: str, client_id: str, pool_size: int = 8,
+                 http_timeout: float = 60, reconnect_delay: float = 1.0):
+        """
+        Long lived connection to one ComfyUI server.
+
+        HTTP requests share a keep-alive connection pool. A single websocket per client_id
+        is read by a background thread that dispatches 'executing' and 'executed' events to
+        the prompt waiting on them, so several prompts can be in flight over one socket.
+
+        Args:
+            server_address (str): host:port of the ComfyUI server
+            client_id (str): Client id the prompts are queued with
+            pool_size (int): Number of pooled HTTP connections
+            http_timeout (float): Timeout of a single HTTP request in seconds
+            reconnect_delay (float): Initial delay before reconnecting a dropped websocket
+        """
+        self.server_address = server_address
+        self.client_id = client_id
+        self.http_timeout = http_timeout
+        self.reconnect_delay = reconnect_delay
+
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.http.mount("http://", adapter)
+
+        self.lock = threading.Lock()
+        self.events = PromptEvents()
+        self.connected = threading.Event()
+        self.closed = False
+        self.ws: Optional[websocket.WebSocket] = None
+        self.ws_thread: Optional[threading.Thread] = None
+
+    def url(self, path: str) -> str:
+        return f"http://{self.server_address}{path}"
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        response = self.http.get(self.url(path), timeout=kwargs.pop('timeout', self.http_timeout), **kwargs)
+        response.raise_for_status()
+        return response
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        response = self.http.post(self.url(path), timeout=kwargs.pop('timeout', self.http_timeout), **kwargs)
+        response.raise_for_status()
+        return response
+
+    def ensure_websocket(self, timeout: float = 10) -> None:
+        """Start the websocket reader if needed and wait until it is connected."""
+        with self.lock:
+            if self.ws_thread is None or not self.ws_thread.is_alive():
+                self.closed = False
+                self.ws_thread = threading.Thread(target=self._run_websocket, daemon=True)
+                self.ws_thread.start()
+        if not self.connected.wait(timeout):
+            raise Exception(f"Could not connect websocket to {self.server_address}")
+
+    def register(self, prompt_id: str, image_nodes=None, node_types=None, workflow=None) -> PromptWaiter:
+        """Start collecting the events of a prompt, including ones that arrived before."""
+        return self.events.register(prompt_id, image_nodes=image_nodes, node_types=node_types, workflow=workflow)
+
+    def wait(self, prompt_id: str, timeout: Optional[float] = None) -> PromptWaiter:
+        """Block until the prompt has finished executing and return its waiter."""
+        waiter = self.register(prompt_id)
+        try:
+            if not waiter.done.wait(timeout):
+                raise TimeoutError(f"Timed out waiting for prompt {prompt_id}")
+            if waiter.error:
+                raise PromptExecutionError(f"Prompt {prompt_id} failed: {waiter.error}")
+            if waiter.aborted:
+                raise ConnectionError(f"Prompt {prompt_id} aborted: {waiter.aborted}")
+            logger.info(f"Workflow completed for prompt {prompt_id}")
+            return waiter
+        finally:
+            self.events.unregister(prompt_id)
+
+    def abort_pending(self, reason: str) -> int:
+        """Release every waiting prompt with a ConnectionError, e.g. when the server stopped answering."""
+        pending = self.events.pending()
+        for waiter in pending:
+            waiter.aborted = reason
+            waiter.done.set()
+        if pending:
+            logger.warning(f"Aborted {len(pending)} prompts waiting on {self.server_address}: {reason}")
+        return len(pending)
+
+    def close(self) -> None:
+        self.closed = True
+        ws = self.ws
+        if ws is not None:
+            try:
+                ws.close()
+            except Exception:
+                pass
+        self.http.close()
+
+    def _run_websocket(self) -> None:
+        delay = self.reconnect_delay
+        while not self.closed:
+            ws = websocket.WebSocket()
+            try:
+                with tracing.span("comfyui.ws_connect"):
+                    ws.connect(f"ws://{self.server_address}/ws?clientId={self.client_id}")
+                self.ws = ws
+                logger.info(f"WebSocket connected to {self.server_address}")
+                delay = self.reconnect_delay
+                self.connected.set()
+                self._check_pending()
+                while not self.closed:
+                    out = ws.recv()
+                    if isinstance(out, str):
+                        if not out:
+                            raise ConnectionError("WebSocket closed by server")
+                        self.events.dispatch(json.loads(out))
+                    else:
+                        self.events.dispatch_frame(out)
+            except Exception as e:
+                if not self.closed:
+                    logger.error(f"WebSocket error: {e}")
+            finally:
+                self.connected.clear()
+                self.ws = None
+                try:
+                    ws.close()
+                except Exception:
+                    pass
+            if not self.closed:
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+
+    def _check_pending(self) -> None:
+        """After a reconnect, finish waiters whose prompt completed while the socket was down."""
+        for waiter in self.events.pending():
+            try:
+                history = self.get(f"/history/{waiter.prompt_id}").json()
+            except Exception as e:
+                logger.error(f"Failed to check history of prompt {waiter.prompt_id}: {e}")
+                continue
+            if waiter.prompt_id in history:
+                for node, output in history[waiter.prompt_id].get('outputs', {}).items():
+                    waiter.outputs.setdefault(node, output)
+                waiter.done.set()
@@ -0,0 +1,269 @@
+"""
+In-process fake ComfyUI server for local testing of the ComfyUI clients.
+
+It speaks the parts of the ComfyUI API the app uses: /upload/image, /prompt, /queue,
+/ws, /history and /view. Queued prompts are executed one after another with a
+configurable delay and the uploaded input image is returned as the output of every
+image output node.
+
+    server = FakeComfyUIServer(delay=0.5).start()
+    handler = ComfyUIHandler(server_address=server.address)
+    ...
+    server.stop()
+"""
+import io
+import json
+import uuid
+import struct
+import asyncio
+import logging
+import threading
+from typing import Dict, Any, Optional
+
+from aiohttp import web, WSMsgType
+from PIL import Image
+
+logger = logging.getLogger('FakeComfyUI')
+
+FILE_OUTPUT_NODES = ("PreviewImage", "SaveImage")
+WEBSOCKET_OUTPUT_NODES = ("SaveImageWebsocket",)
+
+
+class FakeComfyUIServer:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, delay: float = 0.0,
+                 node_delay: float = 0.0, fail_prompts: bool = False, fail_execution: bool = False,
+                 drop_images: bool = False, reject_prompts: bool = False):
+        """
+        Args:
+            host (str): Interface to listen on
+            port (int): Port to listen on, 0 picks a free one
+            delay (float): Seconds each queued prompt takes to execute
+            node_delay (float): Extra seconds per executed node
+            fail_prompts (bool): Reject every /prompt request with a server error
+            fail_execution (bool): Accept prompts but fail them with an execution_error event
+            drop_images (bool): Never send the websocket images, as when they get lost
+            reject_prompts (bool): Reject every /prompt request with 400, as an invalid workflow
+        """
+        self.host = host
+        self.port = port
+        self.delay = delay
+        self.node_delay = node_delay
+        self.fail_prompts = fail_prompts
+        self.fail_execution = fail_execution
+        self.drop_images = drop_images
+        self.reject_prompts = reject_prompts
+
+        self.inputs: Dict[str, bytes] = {}
+        self.files: Dict[str, bytes] = {}
+        self.history: Dict[str, Any] = {}
+        self.workflows: Dict[str, Any] = {}
+        self.pending: list = []
+        self.running: Optional[str] = None
+        self.sockets: Dict[str, list] = {}
+        self.counters = {"uploads": 0, "prompts": 0, "history": 0, "views": 0, "ws_connections": 0}
+        # Longest queue (running + pending) right after a prompt was queued
+        self.max_queue_depth = 0
+
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.thread: Optional[threading.Thread] = None
+        self.runner: Optional[web.AppRunner] = None
+        self.ready = threading.Event()
+
+    @property
+    def address(self) -> str:
+        return f"{self.host}:{self.port}"
+
+    def start(self) -> "FakeComfyUIServer":
+        """Start serving on a background thread with its own event loop."""
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        if not self.ready.wait(10):
+            raise Exception("Fake ComfyUI server did not start")
+        return self
+
+    def stop(self) -> None:
+        if self.loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result(10)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(10)
+        self.loop = None
+
+    def drop_websockets(self) -> None:
+        """Close every open websocket, to exercise client reconnects."""
+        async def close_all():
+            for sockets in list(self.sockets.values()):
+                for ws in list(sockets):
+                    await ws.close()
+        asyncio.run_coroutine_threadsafe(close_all(), self.loop).result(10)
+
+    def _run(self) -> None:
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self._startup())
+        self.ready.set()
+        self.loop.run_forever()
+        self.loop.close()
+
+    async def _startup(self) -> None:
+        app = web.Application(client_max_size=64 * 1024**2)
+        app.router.add_post("/upload/image", self.upload_image)
+        app.router.add_post("/prompt", self.queue_prompt)
+        app.router.add_get("/queue", self.get_queue)
+        app.router.add_get("/ws", self.websocket)
+        app.router.add_get("/history/{prompt_id}", self.get_history)
+        app.router.add_get("/view", self.view)
+        self.queue = asyncio.Queue()
+        self.worker = asyncio.ensure_future(self._execute_prompts())
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def _shutdown(self) -> None:
+        self.worker.cancel()
+        for sockets in list(self.sockets.values()):
+            for ws in list(sockets):
+                await ws.close()
+        await self.runner.cleanup()
+
+    async def upload_image(self, request: web.Request) -> web.Response:
+        form = await request.post()
+        image = form['image']
+        self.inputs[image.filename] = image.file.read()
+        self.counters["uploads"] += 1
+        return web.json_response({"name": image.filename, "subfolder": "", "type": "input"})
+
+    async def queue_prompt(self, request: web.Request) -> web.Response:
+        if self.fail_prompts:
+            return web.json_response({"error": "fake failure"}, status=500)
+        if self.reject_prompts:
+            return web.json_response({"error": {"type": "prompt_outputs_failed_validation",
+                                                "message": "Prompt outputs failed validation"},
+                                      "node_errors": {}}, status=400)
+        body = await request.json()
+        prompt_id = str(uuid.uuid4())
+        self.counters["prompts"] += 1
+        self.workflows[prompt_id] = body["prompt"]
+        self.pending.append(prompt_id)
+        self.max_queue_depth = max(self.max_queue_depth, len(self.pending) + (1 if self.running else 0))
+        await self.queue.put((prompt_id, body["prompt"], body.get("client_id")))
+        return web.json_response({"prompt_id": prompt_id, "number": self.counters["prompts"], "node_errors": {}})
+
+    async def get_queue(self, request: web.Request) -> web.Response:
+        running = [[0, self.running]] if self.running else []
+        pending = [[i + 1, prompt_id] for i, prompt_id in enumerate(self.pending)]
+        return web.json_response({"queue_running": running, "queue_pending": pending})
+
+    async def get_history(self, request: web.Request) -> web.Response:
+        self.counters["history"] += 1
+        prompt_id = request.match_info["prompt_id"]
+        if prompt_id not in self.history:
+            return web.json_response({})
+        return web.json_response({prompt_id: self.history[prompt_id]})
+
+    async def view(self, request: web.Request) -> web.Response:
+        self.counters["views"] += 1
+        key = f"{request.query.get('type', 'output')}/{request.query.get('filename', '')}"
+        if request.query.get('type') == 'input':
+            data = self.inputs.get(request.query.get('filename', ''))
+        else:
+            data = self.files.get(key)
+        if data is None:
+            return web.Response(status=404)
+        return web.Response(body=data, content_type="image/png")
+
+    async def websocket(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        client_id = request.query.get("clientId", str(uuid.uuid4()))
+        self.sockets.setdefault(client_id, []).append(ws)
+        self.counters["ws_connections"] += 1
+        await ws.send_str(json.dumps({
+            "type": "status",
+            "data": {"status": {"exec_info": {"queue_remaining": len(self.pending)}}, "sid": client_id}
+        }))
+        try:
+            async for message in ws:
+                if message.type == WSMsgType.ERROR:
+                    break
+        finally:
+            self.sockets[client_id].remove(ws)
+        return ws
+
+    async def _send(self, client_id: str, message: Any) -> None:
+        for ws in list(self.sockets.get(client_id, [])):
+            try:
+                if isinstance(message, bytes):
+                    await ws.send_bytes(message)
+                else:
+                    await ws.send_str(json.dumps(message))
+            except Exception as e:
+                logger.debug(f"Dropping message for {client_id}: {e}")
+
+    def _output_image(self, workflow: Dict[str, Any]) -> bytes:
+        """The first uploaded input image of the workflow, or a blank image."""
+        for node in workflow.values():
+            if node.get("class_type") == "LoadImage":
+                data = self.inputs.get(node["inputs"].get("image"))
+                if data is not None:
+                    return data
+        buffer = io.BytesIO()
+        Image.new("RGB", (64, 64), "white").save(buffer, format="PNG")
+        return buffer.getvalue()
+
+    async def _execute_prompts(self) -> None:
+        while True:
+            prompt_id, workflow, client_id = await self.queue.get()
+            self.pending.remove(prompt_id)
+            self.running = prompt_id
+            await self._send(client_id, {"type": "execution_start", "data": {"prompt_id": prompt_id}})
+            await asyncio.sleep(self.delay)
+            if self.fail_execution:
+                node_id = next(iter(workflow), None)
+                self.history[prompt_id] = {"outputs": {}, "status": {"completed": False, "status_str": "error"}}
+                self.running = None
+                await self._send(client_id, {"type": "execution_error", "data": {
+                    "prompt_id": prompt_id, "node_id": node_id, "exception_message": "fake execution error"
+                }})
+                continue
+            image = self._output_image(workflow)
+            outputs = {}
+            for node_id, node in workflow.items():
+                await self._send(client_id, {"type": "executing", "data": {"node": node_id, "prompt_id": prompt_id}})
+                if self.node_delay:
+                    await asyncio.sleep(self.node_delay)
+                class_type = node.get("class_type")
+                if class_type in WEBSOCKET_OUTPUT_NODES and not self.drop_images:
+                    # Same framing as ComfyUI: event type PREVIEW_IMAGE (1), image format PNG (2)
+                    await self._send(client_id, struct.pack(">II", 1, 2) + image)
+                elif class_type in FILE_OUTPUT_NODES:
+                    filename = f"{prompt_id}_{node_id}.png"
+                    folder = "temp" if class_type == "PreviewImage" else "output"
+                    self.files[f"{folder}/{filename}"] = image
+                    output = {"images": [{"filename": filename, "subfolder": "", "type": folder}]}
+                    outputs[node_id] = output
+                    await self._send(client_id, {
+                        "type": "executed",
+                        "data": {"node": node_id, "output": output, "prompt_id": prompt_id}
+                    })
+            self.history[prompt_id] = {"outputs": outputs, "status": {"completed": True}}
+            self.running = None
+            await self._send(client_id, {"type": "executing", "data": {"node": None, "prompt_id": prompt_id}})
+
+
+if __name__ == "__main__":
+    import time
+    import argparse
+    parser = argparse.ArgumentParser(description="Run a fake ComfyUI server")
+    parser.add_argument("--port", type=int, default=8188)
+    parser.add_argument("--delay", type=float, default=1.0)
+    args = parser.parse_args()
+    server = FakeComfyUIServer(port=args.port, delay=args.delay).start()
+    print(f"Fake ComfyUI listening on {server.address}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
@@ -1,5 +1,7 @@
 import yaml
 import re
+import hashlib
+from PIL import Image
 
 def read_config(config_path ="config.yaml"):
     with open(config_path, 'r') as file:
@@ -14,8 +16,38 @@ def singleton(cls):
             instances[cls] = cls(*args, **kwargs)
         return instances[cls]
     
+    # The class itself, for building separate instances in tests
+    get_instance.__wrapped__ = cls
     return get_instance
 
+def image_hash(image):
+    """Content hash of the decoded pixels, independent of the file format the image came in."""
+    image = image.convert("RGB")
+    digest = hashlib.sha256(f"{image.size}".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+def scale_image(image, max_size=1024):
+    """Scale down image if it's larger than max_size while preserving aspect ratio"""
+    width, height = image.size
+    
+    if width > max_size or height > max_size:
+        ratio = min(max_size/width, max_size/height)
+        new_size = (int(width * ratio), int(height * ratio))
+        
+        image_copy = image.copy()
+        image_copy.thumbnail(new_size, Image.Resampling.LANCZOS)
+        return image_copy
+    return image
+
+def get_max_new_tokens(config, prompt_template, default=700):
+    """Return the token budget configured for the language prompt the template comes from."""
+    budgets = config.get("generation", {}).get("max_new_tokens", {})
+    for prompt_key, budget in budgets.items():
+        if config.get(prompt_key) == prompt_template:
+            return budget
+    return default
+
 def parse_data(data):
     parsed_data = {}
     try:
@@ -59,6 +91,72 @@ def parse_product_info(output_text):
             parsed_info['product_description'] = line.split("product_description:")[1].strip(":").strip()
     return parsed_info
 
+PRODUCT_KEYS = ("entity_name", "product_title", "product_description")
+PRODUCT_KEY_PATTERN = re.compile(r"^\s*(entity_name|product_title|product_description)\s*:\s*(.*)$")
+
+class ProductInfoStream:
+    """
+    Incrementally extract product fields from streamed model output.
+
+    entity_name and product_title are single line fields and are complete as soon as
+    their line ends. product_description may continue over several lines, so it is
+    complete once the closing code fence appears or the stream is finished.
+    """
+    def __init__(self):
+        self.buffer = ""
+        self.fields = {}
+        self.current_key = None
+        self.current_lines = []
+        self.closed = False
+
+    def feed(self, text):
+        """Add streamed text and return the fields completed by it."""
+        completed = {}
+        if self.closed:
+            return completed
+        self.buffer += text
+        *lines, self.buffer = self.buffer.split("\n")
+        for line in lines:
+            self._process_line(line, completed)
+            if self.closed:
+                break
+        return completed
+
+    def finish(self):
+        """Flush whatever is left once generation has ended."""
+        completed = {}
+        if not self.closed:
+            if self.buffer:
+                self._process_line(self.buffer, completed)
+                self.buffer = ""
+            self._complete_current(completed)
+            self.closed = True
+        return completed
+
+    def _process_line(self, line, completed):
+        if line.strip().startswith("```"):
+            if self.current_key or self.fields:
+                self._complete_current(completed)
+                self.closed = True
+            return
+        match = PRODUCT_KEY_PATTERN.match(line)
+        if match:
+            self._complete_current(completed)
+            self.current_key = match.group(1)
+            self.current_lines = [match.group(2).strip()]
+            if self.current_key != "product_description":
+                self._complete_current(completed)
+        elif self.current_key and line.strip():
+            self.current_lines.append(line.strip())
+
+    def _complete_current(self, completed):
+        if self.current_key and self.current_key not in self.fields:
+            value = " ".join(part for part in self.current_lines if part)
+            self.fields[self.current_key] = value
+            completed[self.current_key] = value
+        self.current_key = None
+        self.current_lines = []
+
 if __name__ == "__main__":
     text = """```yaml
   entity_name: jar
@@ -0,0 +1,213 @@
+"""
+One decode per uploaded image, with a derived image for each consumer.
+
+The VLM processor, the ComfyUI upload and the colour detector all want a different
+size, and a 12 MP phone JPEG is expensive to decode and resample several times. The
+target size of every consumer is computed from the header, the JPEG is decoded at the
+smallest DCT scale that still covers the largest target (draft mode), each derived
+image is resized once, from the decode or a sharper derived image at least as large,
+with the filter its consumer would have used, and the small derived images are then
+turned upright from the EXIF orientation.
+
+    ingestor = ImageIngestor()
+    ingested = ingestor.ingest(data)
+    ingested.images["vlm"], ingested.images["comfyui"], ingested.images["color"]
+"""
+import io
+import math
+import time
+import logging
+from functools import lru_cache
+from typing import Any, Dict, Optional, Tuple
+
+from PIL import Image
+
+logger = logging.getLogger('Ingest')
+
+EXIF_ORIENTATION = 0x0112
+# Transpose that makes an image with this EXIF orientation upright, as ImageOps.exif_transpose
+ORIENTATION_TRANSPOSES = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90
+}
+# EXIF orientations that swap width and height
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+# Filter of each consumer: the Mllama processor resizes bilinearly, the app scaled the
+# upload with LANCZOS and ColorDetector resizes with the PIL default
+RESAMPLING = {
+    "vlm": Image.Resampling.BILINEAR,
+    "comfyui": Image.Resampling.LANCZOS,
+    "color": Image.Resampling.BICUBIC
+}
+
+
+@lru_cache(maxsize=256)
+def mllama_canvas_size(width: int, height: int, tile_size: int = 560, max_tiles: int = 4) -> Tuple[int, int]:
+    """
+    Size the Mllama image processor resizes an image to before splitting it into tiles.
+
+    Same rules as get_optimal_tiled_canvas and get_image_size_fit_to_canvas of
+    transformers: the tile arrangement needing the smallest upscale is picked, or the
+    smallest downscale when every arrangement is smaller than the image, and the image
+    is fitted into it without going below one tile per side. Returns (width, height).
+    """
+    arrangements = [(rows, columns) for rows in range(1, max_tiles + 1) for columns in range(1, max_tiles + 1)
+                    if rows * columns <= max_tiles]
+    canvases = [(rows * tile_size, columns * tile_size) for rows, columns in arrangements]
+    scales = [min(canvas_height / height, canvas_width / width) for canvas_height, canvas_width in canvases]
+    upscales = [scale for scale in scales if scale >= 1]
+    selected = min(upscales) if upscales else max(scales)
+    canvas_height, canvas_width = min((canvas for canvas, scale in zip(canvases, scales) if scale == selected),
+                                      key=lambda canvas: canvas[0] * canvas[1])
+
+    target_width = min(max(width, tile_size), canvas_width)
+    target_height = min(max(height, tile_size), canvas_height)
+    scale_h = target_height / height
+    scale_w = target_width / width
+    if scale_w < scale_h:
+        return target_width, min(math.floor(height * scale_w) or 1, target_height)
+    return min(math.floor(width * scale_h) or 1, target_width), target_height
+
+
+def fit_size(width: int, height: int, max_size: int) -> Tuple[int, int]:
+    """Size scale_image gives an image: scaled down to fit max_size, never up."""
+    if width <= max_size and height <= max_size:
+        return width, height
+    ratio = min(max_size / width, max_size / height)
+    new_width, new_height = int(width * ratio), int(height * ratio)
+    # Then the aspect ratio correction of Image.thumbnail, so the upload hashes match
+    aspect = width / height
+
+    def round_aspect(number, key):
+        return max(min(math.floor(number), math.ceil(number), key=key), 1)
+
+    if new_width / new_height >= aspect:
+        new_width = round_aspect(new_height * aspect, key=lambda n: abs(aspect - n / new_height))
+    else:
+        new_height = round_aspect(new_width / aspect, key=lambda n: 0 if n == 0 else abs(aspect - new_width / n))
+    return new_width, new_height
+
+
+class IngestedImage:
+    def __init__(self, images: Dict[str, Image.Image], source_bytes: Optional[bytes], stats: Dict[str, Any]):
+        """
+        Args:
+            images (dict): Derived image per consumer
+            source_bytes (bytes): The file as it was uploaded, set when the ComfyUI image is its
+                unmodified decode, so the 'original' upload encoding can send it as it is
+            stats (dict): Sizes, orientation and timings of the ingestion
+        """
+        self.images = images
+        self.source_bytes = source_bytes
+        self.stats = stats
+
+
+class ImageIngestor:
+    def __init__(self, vlm_tile_size: Optional[int] = 560, vlm_max_tiles: int = 4, comfyui_max_size: int = 1024,
+                 color_sample_size: int = 150, draft: bool = True):
+        """
+        Args:
+            vlm_tile_size (int): Tile size of the VLM image processor, None gives the VLM the ComfyUI image
+            vlm_max_tiles (int): Maximum number of tiles of the VLM image processor
+            comfyui_max_size (int): Longest side of the image uploaded to ComfyUI
+            color_sample_size (int): Side of the square ColorDetector samples from
+            draft (bool): Let the JPEG decoder skip resolution the consumers do not need
+        """
+        self.vlm_tile_size = vlm_tile_size
+        self.vlm_max_tiles = vlm_max_tiles
+        self.comfyui_max_size = comfyui_max_size
+        self.color_sample_size = color_sample_size
+        self.draft = draft
+
+    def target_sizes(self, width: int, height: int) -> Dict[str, Tuple[int, int]]:
+        """
+        Size of each derived image of an upright image of this size.
+
+        The VLM gets what its processor would resize the ComfyUI image to, usually the
+        ComfyUI image itself, so the processor's own resize is a no-op.
+        """
+        comfyui_size = fit_size(width, height, self.comfyui_max_size)
+        sizes = {"comfyui": comfyui_size}
+        if self.vlm_tile_size:
+            sizes["vlm"] = mllama_canvas_size(*comfyui_size, self.vlm_tile_size, self.vlm_max_tiles)
+        else:
+            sizes["vlm"] = comfyui_size
+        sizes["color"] = (self.color_sample_size, self.color_sample_size)
+        return sizes
+
+    def ingest(self, data: bytes) -> IngestedImage:
+        """Decode an uploaded file once and derive the image of every consumer."""
+        start = time.perf_counter()
+        image = Image.open(io.BytesIO(data))
+        image_format = image.format
+        stored_size = image.size
+        orientation = image.getexif().get(EXIF_ORIENTATION, 1)
+        transposed = orientation in TRANSPOSED_ORIENTATIONS
+        width, height = stored_size[::-1] if transposed else stored_size
+        sizes = self.target_sizes(width, height)
+
+        # Resized in the stored orientation, the derived images are turned upright afterwards
+        stored_sizes = {name: size[::-1] if transposed else size for name, size in sizes.items()}
+        needed = (max(size[0] for size in stored_sizes.values()), max(size[1] for size in stored_sizes.values()))
+        if self.draft and image_format == "JPEG" and needed[0] < stored_size[0] and needed[1] < stored_size[1]:
+            # Decodes at the smallest of 1/1, 1/2, 1/4 and 1/8 that still covers needed
+            image.draft("RGB", needed)
+        image.load()
+        if image.mode not in ("RGB", "RGBA", "L"):
+            # Palette and CMYK images cannot be resampled as they are
+            image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+        decode_seconds = time.perf_counter() - start
+
+        images, resize_seconds = self.derive(image, stored_sizes)
+
+        start = time.perf_counter()
+        if orientation in ORIENTATION_TRANSPOSES:
+            upright = {}
+            for name, derived in images.items():
+                # Derived images can be the same object, transpose each one once
+                same = next((upright[other] for other in upright if images[other] is derived), None)
+                upright[name] = same or derived.transpose(ORIENTATION_TRANSPOSES[orientation])
+            images = upright
+        orient_seconds = time.perf_counter() - start
+
+        unmodified = image.size == stored_size and orientation == 1 and images["comfyui"] is image
+        return IngestedImage(images, data if unmodified else None, {
+            "format": image_format,
+            "stored_size": stored_size,
+            "decoded_size": image.size,
+            "orientation": orientation,
+            "sizes": sizes,
+            "decode_seconds": decode_seconds,
+            "orient_seconds": orient_seconds,
+            "resize_seconds": resize_seconds
+        })
+
+    def derive(self, image: Image.Image, sizes: Dict[str, Tuple[int, int]]) -> Tuple[Dict[str, Image.Image], Dict[str, float]]:
+        """Resize from the largest target down, each one from the smallest LANCZOS image that covers it."""
+        images, seconds = {}, {}
+        available = [image]
+        # Equal sizes are resized once, with the sharper filter
+        order = sorted(sizes.items(), key=lambda item: (item[1][0] * item[1][1],
+                                                        RESAMPLING.get(item[0]) == Image.Resampling.LANCZOS), reverse=True)
+        for name, size in order:
+            start = time.perf_counter()
+            source = min((candidate for candidate in available if candidate.width >= size[0] and candidate.height >= size[1]),
+                         key=lambda candidate: candidate.width * candidate.height, default=image)
+            if source.size == size:
+                derived = source
+            else:
+                resample = RESAMPLING.get(name, Image.Resampling.LANCZOS)
+                # reducing_gap first shrinks by an integer factor with a box filter, then resamples
+                derived = source.resize(size, resample, reducing_gap=3.0)
+                if resample == Image.Resampling.LANCZOS:
+                    # Only the sharpest resize is a source for the next ones, the upload
+                    # must not be a resample of the bilinear VLM image
+                    available.append(derived)
+            images[name] = derived
+            seconds[name] = time.perf_counter() - start
+        return images, seconds
@@ -1,40 +1,626 @@
-from transformers import MllamaForConditionalGeneration, AutoProcessor
+from transformers import MllamaForConditionalGeneration, AutoProcessor, AutoModelForCausalLM, TextIteratorStreamer
+from transformers import StoppingCriteria, StoppingCriteriaList, DynamicCache
+from threading import Thread, Event
 import torch
-import gc
+import copy
+import glob
+import json
+import time
+import hashlib
+import logging
+import os
+import threading
+import transformers
 
-from helpers import singleton
+import tracing
+from helpers import singleton, ProductInfoStream, PRODUCT_KEYS
+from residency import ResidencyManager, TorchResident
+
+logger = logging.getLogger('VLM')
+
+# Load and inference settings per deployment target, any field can be overridden.
+# dtype is the dtype the checkpoint is loaded in. quantize 'int8' replaces the linear
+# layers by dynamically quantised ones, which compute in float32, so the other weights
+# are then cast to float32. threads 0 keeps the torch default. quantized_cache_dir
+# keeps the quantised model on disk so later starts skip the conversion, null disables it.
+VLM_PROFILES = {
+    "gpu": {"dtype": "bfloat16", "quantize": None, "quantize_skip": [], "threads": 0, "interop_threads": 0,
+            "quantized_cache_dir": None},
+    "cpu": {"dtype": "bfloat16", "quantize": "int8", "quantize_skip": ["lm_head"], "threads": 0, "interop_threads": 0,
+            "quantized_cache_dir": ".vlm_cache"},
+    "cpu_float": {"dtype": "float32", "quantize": None, "quantize_skip": [], "threads": 0, "interop_threads": 0,
+                  "quantized_cache_dir": None},
+}
+
+# Assisted decoding modes of a request: off decodes one token per forward pass,
+# prompt_lookup proposes the continuation of an n-gram found earlier in the prompt or
+# the answer, draft proposes the tokens of a small draft model. Both only change how
+# many tokens a forward pass yields, greedy outputs stay the same.
+ASSISTED_MODES = ("off", "prompt_lookup", "draft")
+
+def quantize_linear_layers(model, skip=()):
+    """
+    Replace the nn.Linear layers of a model by int8 dynamically quantised ones, in place.
+
+    Layers are converted one at a time, so only one layer is held in float32 next to
+    the loaded weights instead of a float32 copy of the whole model as quantize_dynamic
+    would make. Weights are quantised per output channel.
+
+    Args:
+        model (torch.nn.Module): Model to quantise
+        skip (list): Names of layers to keep in floating point, e.g. 'lm_head', matched
+            against the full module name and its last component
+    """
+    from torch.ao.nn.quantized.dynamic import Linear as DynamicQuantizedLinear
+    from torch.ao.quantization import per_channel_dynamic_qconfig
+    names = [name for name, module in model.named_modules() if type(module) is torch.nn.Linear]
+    for name in names:
+        if name in skip or name.rsplit(".", 1)[-1] in skip:
+            continue
+        parent_name, _, child_name = name.rpartition(".")
+        parent = model.get_submodule(parent_name)
+        linear = getattr(parent, child_name)
+        float_linear = torch.nn.Linear(linear.in_features, linear.out_features, bias=linear.bias is not None,
+                                       device="meta")
+        float_linear.weight = torch.nn.Parameter(linear.weight.detach().float(), requires_grad=False)
+        if linear.bias is not None:
+            float_linear.bias = torch.nn.Parameter(linear.bias.detach().float(), requires_grad=False)
+        float_linear.qconfig = per_channel_dynamic_qconfig
+        setattr(parent, child_name, DynamicQuantizedLinear.from_float(float_linear))
+    return model
+
+def checkpoint_fingerprint(model_id):
+    """What identifies the loaded weights: the files of a local checkpoint, the commit of a hub one."""
+    if os.path.isdir(model_id):
+        files = sorted(glob.glob(os.path.join(model_id, "*.safetensors")) + glob.glob(os.path.join(model_id, "*.json")))
+        return [(os.path.basename(path), os.path.getsize(path), os.path.getmtime(path)) for path in files]
+    return getattr(transformers.AutoConfig.from_pretrained(model_id), "_commit_hash", None)
+
+def quantized_cache_path(model_id, settings):
+    """File of the quantised model in quantized_cache_dir, keyed by checkpoint, settings and library versions."""
+    key = json.dumps({
+        "model_id": model_id,
+        "checkpoint": checkpoint_fingerprint(model_id),
+        "settings": {name: settings[name] for name in ("dtype", "quantize", "quantize_skip")},
+        "torch": torch.__version__,
+        "transformers": transformers.__version__
+    }, sort_keys=True)
+    name = os.path.basename(os.path.normpath(model_id)).replace(os.sep, "_")
+    return os.path.join(settings["quantized_cache_dir"], f"{name}-{hashlib.sha256(key.encode()).hexdigest()[:16]}.pt")
+
+def load_vlm(model_id, settings):
+    """
+    Load the Mllama model with profile settings, from the quantised cache when it has it.
+
+    The safetensors checkpoint is memory mapped and loaded without a randomly
+    initialised copy (low_cpu_mem_usage), in settings['dtype'].
+    """
+    cache_path = None
+    if settings["quantize"] and settings["quantized_cache_dir"]:
+        cache_path = quantized_cache_path(model_id, settings)
+        if os.path.exists(cache_path):
+            start = time.perf_counter()
+            try:
+                # Written by this function, the file holds the pickled module
+                model = torch.load(cache_path, weights_only=False, mmap=True)
+                logger.info(f"Loaded quantised model from {cache_path} in {time.perf_counter() - start:.1f}s")
+                return model
+            except Exception as e:
+                logger.warning(f"Could not load quantised model from {cache_path}, converting again: {e}")
+
+    start = time.perf_counter()
+    model = MllamaForConditionalGeneration.from_pretrained(
+        model_id,
+        torch_dtype=getattr(torch, settings["dtype"]),
+        low_cpu_mem_usage=True,
+        use_safetensors=True
+    )
+    model.eval()
+    logger.info(f"Loaded {model_id} in {settings['dtype']} in {time.perf_counter() - start:.1f}s")
+    if settings["quantize"] is None:
+        return model
+    if settings["quantize"] != "int8":
+        raise ValueError(f"Unknown quantize setting '{settings['quantize']}', expected 'int8' or null")
+
+    start = time.perf_counter()
+    quantize_linear_layers(model, settings["quantize_skip"])
+    model.float()
+    logger.info(f"Quantised the linear layers to int8 in {time.perf_counter() - start:.1f}s")
+    if cache_path is not None:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        # Written next to the final file and renamed, a concurrent start never reads half of it
+        temporary_path = f"{cache_path}.{os.getpid()}.tmp"
+        torch.save(model, temporary_path)
+        os.replace(temporary_path, cache_path)
+        logger.info(f"Saved quantised model to {cache_path}")
+    return model
+
+def set_threads(settings):
+    """Apply the thread counts of a profile, 0 keeps the torch default."""
+    if settings["threads"]:
+        torch.set_num_threads(settings["threads"])
+    if settings["interop_threads"]:
+        try:
+            torch.set_num_interop_threads(settings["interop_threads"])
+        except RuntimeError as e:
+            # Only possible before the first inter-op parallel work of the process
+            logger.warning(f"Could not set {settings['interop_threads']} inter-op threads: {e}")
+
+class CancelCriteria(StoppingCriteria):
+    """Stops generation once its event is set from another thread."""
+    def __init__(self):
+        self.event = Event()
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return self.event.is_set()
+
+class TokenTimingCriteria(StoppingCriteria):
+    """
+    Records when generate produced its first token, which ends the prefill, and its
+    last one. Never stops generation, only added while tracing is enabled.
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.first_token = None
+        self.last_token = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        self.last_token = time.perf_counter()
+        if self.first_token is None:
+            self.first_token = self.last_token
+        return False
+
+class AssistedDecodingCounter:
+    """
+    Counts the candidate tokens assisted decoding proposed and how many the model accepted.
+
+    Every forward pass of the model scores its last token and the candidates, and yields
+    the accepted candidates plus one token of its own, so the accepted count is the new
+    tokens minus the forward passes. The first pass also prefills the prompt.
+    Only the passes made by the thread that created the counter are counted.
+    """
+    def __init__(self, model, prompt_tokens):
+        self.prompt_tokens = prompt_tokens
+        self.forwards = 0
+        self.proposed = 0
+        self.thread = threading.get_ident()
+        self.handle = model.register_forward_pre_hook(self, with_kwargs=True)
+
+    def __call__(self, module, args, kwargs):
+        input_ids = kwargs.get("input_ids")
+        if threading.get_ident() != self.thread or input_ids is None:
+            return
+        self.proposed += input_ids.shape[1] - (self.prompt_tokens if self.forwards == 0 else 1)
+        self.forwards += 1
+
+    def remove(self):
+        self.handle.remove()
+
+    def stats(self, new_tokens):
+        accepted = max(new_tokens - self.forwards, 0)
+        return {
+            "forwards": self.forwards,
+            "proposed_tokens": self.proposed,
+            "accepted_tokens": accepted,
+            "acceptance_rate": accepted / self.proposed if self.proposed else None
+        }
+
+class CrossAttentionCache(DynamicCache):
+    """
+    DynamicCache whose crop leaves the cross attention layers alone.
+
+    Assisted decoding crops the cache back after rejected candidates, but the cross
+    attention layers of Mllama hold the image states, not one entry per token.
+    """
+    def __init__(self, cross_attention_layers=(), **kwargs):
+        super().__init__(**kwargs)
+        self.cross_attention_layers = frozenset(cross_attention_layers)
+
+    def crop(self, tokens_to_remove):
+        for index, layer in enumerate(self.layers):
+            if index not in self.cross_attention_layers:
+                layer.crop(tokens_to_remove)
+
+class TextDraftMixin:
+    """
+    Lets a text only causal LM draft for Mllama in assisted decoding, which hands the
+    draft the generate inputs of the VLM: the image inputs are dropped.
+    """
+    image_inputs = ("pixel_values", "aspect_ratio_ids", "aspect_ratio_mask", "cross_attention_mask")
+
+    def _validate_model_kwargs(self, model_kwargs):
+        super()._validate_model_kwargs({k: v for k, v in model_kwargs.items() if k not in self.image_inputs})
+
+    def prepare_inputs_for_generation(self, *args, **kwargs):
+        for name in self.image_inputs:
+            kwargs.pop(name, None)
+        return super().prepare_inputs_for_generation(*args, **kwargs)
+
+class YamlBlockCriteria(StoppingCriteria):
+    """
+    Stops a row once its YAML answer is complete: the closing code fence was
+    generated or all of PRODUCT_KEYS have a complete value.
+    """
+    def __init__(self, tokenizer, prompt_length):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.streams = None
+        self.consumed = None
+        self.done = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.streams is None:
+            self.streams = [ProductInfoStream() for _ in range(input_ids.shape[0])]
+            self.consumed = [0] * input_ids.shape[0]
+            self.done = [False] * input_ids.shape[0]
+        texts = self.tokenizer.batch_decode(input_ids[:, self.prompt_length:], skip_special_tokens=True)
+        for row, text in enumerate(texts):
+            if self.done[row]:
+                continue
+            # Only feed complete lines, the decoded tail can still change with the next token
+            line_end = text.rfind("\n") + 1
+            if line_end > self.consumed[row]:
+                self.streams[row].feed(text[self.consumed[row]:line_end])
+                self.consumed[row] = line_end
+            stream = self.streams[row]
+            closing_fence = stream.fields and text[self.consumed[row]:].strip().startswith("```")
+            if stream.closed or closing_fence or all(key in stream.fields for key in PRODUCT_KEYS):
+                self.done[row] = True
+        return torch.tensor(self.done, dtype=torch.bool, device=input_ids.device)
 
 @singleton
 class VLMModel():
     def __init__(self,  **kwargs):
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.model = MllamaForConditionalGeneration.from_pretrained(
-            kwargs.get("model_id"),
-            torch_dtype=torch.bfloat16
-        )
+        """
+        Args:
+            model_id (str): Hub id or local directory of the Mllama checkpoint
+            residency_manager (ResidencyManager): Manager shared with the other heavy models
+            prefix_cache (bool): Reuse the key/value cache of the static instruction across calls
+            profile (str): Key of VLM_PROFILES, defaults to 'gpu' when CUDA is available and 'cpu' otherwise
+            profile_overrides (dict): Profile fields to override, see VLM_PROFILES
+            assisted_decoding (dict): mode (the default of ASSISTED_MODES), prompt_lookup_num_tokens,
+                max_matching_ngram_size and draft_model_id, a small causal LM with the same tokenizer
+        """
+        profile = kwargs.get("profile") or ("gpu" if torch.cuda.is_available() else "cpu")
+        if profile not in VLM_PROFILES:
+            raise ValueError(f"Unknown VLM profile '{profile}', expected one of {tuple(VLM_PROFILES)}")
+        overrides = kwargs.get("profile_overrides") or {}
+        unknown = set(overrides) - set(VLM_PROFILES[profile])
+        if unknown:
+            raise ValueError(f"Unknown VLM profile settings: {sorted(unknown)}")
+        self.profile = profile
+        self.settings = dict(VLM_PROFILES[profile], **overrides)
+        self.device = "cuda" if profile == "gpu" and torch.cuda.is_available() else "cpu"
+        if self.settings["quantize"] and self.device != "cpu":
+            raise ValueError("Dynamically quantised layers only run on the CPU, use the cpu profile")
+        set_threads(self.settings)
+        self.model = load_vlm(kwargs.get("model_id"), self.settings)
+        logger.info(f"VLM {kwargs.get('model_id')} on {self.device} with profile {profile} {self.settings}")
         self.processor = AutoProcessor.from_pretrained(kwargs.get("model_id"))
+        # Batched prompts must be padded on the left so that every row ends
+        # right before its first generated token
+        self.processor.tokenizer.padding_side = "left"
+        self.residency = kwargs.get("residency_manager") or ResidencyManager()
+        self.residency.register("vlm", TorchResident(self.model, self.device))
+        self.last_generation_stats = None
+        # Key/value caches of the static instruction text, keyed by the rendered prefix
+        self.prefix_cache = kwargs.get("prefix_cache", True)
+        self.prefix_caches = {}
+        assisted = kwargs.get("assisted_decoding") or {}
+        self.assisted_mode = assisted.get("mode") or "off"
+        if self.assisted_mode not in ASSISTED_MODES:
+            raise ValueError(f"Unknown assisted decoding mode '{self.assisted_mode}', expected one of {ASSISTED_MODES}")
+        self.prompt_lookup_num_tokens = assisted.get("prompt_lookup_num_tokens", 10)
+        self.max_matching_ngram_size = assisted.get("max_matching_ngram_size", 2)
+        draft_model_id = assisted.get("draft_model_id")
+        self.draft_model = self.load_draft_model(draft_model_id) if draft_model_id else None
+
+    def load_draft_model(self, model_id):
+        """
+        Load the draft model of assisted decoding on the device of the VLM.
 
-    def generate(self, prompt, image):
-        self.model.to(self.device)
-        messages = [
-            {"role": "user", "content": [
+        It is fed the token ids of the VLM prompt, so its input embeddings are extended to
+        the VLM's when they do not cover the image token, with the mean embedding. Its output
+        head is kept, assisted decoding needs logits as wide as the VLM's.
+        """
+        draft_model = AutoModelForCausalLM.from_pretrained(model_id, torch_dtype=self.model.dtype, low_cpu_mem_usage=True)
+        size = self.model.get_input_embeddings().num_embeddings
+        embeddings = draft_model.get_input_embeddings()
+        if embeddings.num_embeddings < size:
+            extended = torch.nn.Embedding(size, embeddings.embedding_dim, dtype=embeddings.weight.dtype)
+            with torch.no_grad():
+                extended.weight[:embeddings.num_embeddings] = embeddings.weight
+                extended.weight[embeddings.num_embeddings:] = embeddings.weight.mean(dim=0)
+            draft_model.set_input_embeddings(extended)
+        draft_model.__class__ = type(f"TextDraft{type(draft_model).__name__}", (TextDraftMixin, type(draft_model)), {})
+        logger.info(f"Loaded draft model {model_id} for assisted decoding")
+        return draft_model.eval().to(self.device)
+
+    def new_cache(self):
+        return CrossAttentionCache(self.model.config.text_config.cross_attention_layers)
+
+    def build_input_text(self, prompt, instruction=None):
+        if instruction is None:
+            content = [
+                {"type": "image"},
+                {"type": "text", "text": prompt}
+            ]
+        else:
+            # The static instruction goes before the image so that its key/value
+            # cache does not depend on the image and can be reused across calls
+            content = [
+                {"type": "text", "text": instruction},
                 {"type": "image"},
                 {"type": "text", "text": prompt}
-            ]}
-        ]
+            ]
+        messages = [{"role": "user", "content": content}]
         input_text = self.processor.apply_chat_template(messages, add_generation_prompt=True)
-        input_text += "```yaml"
+        return input_text + "```yaml"
+
+    def decode(self, sequence, input_text):
+        """Decode one generated sequence the same way for single and batched calls."""
+        pad_token_id = self.processor.tokenizer.pad_token_id
+        if pad_token_id is not None:
+            # Drop the left padding added by the processor and the right padding
+            # generate adds to rows that finished before the longest one
+            sequence = sequence[sequence != pad_token_id]
+        decoded_output = self.processor.decode(sequence)[len(input_text)-1:]
+        return decoded_output.replace("|end_header_id|>", "").replace("<|eot_id|>", "")
+
+    def get_prefix_cache(self, prefix_text):
+        """Return the token ids and key/value cache of the prefix, computing them on first use."""
+        if prefix_text not in self.prefix_caches:
+            prefix_ids = self.processor.tokenizer(prefix_text, return_tensors="pt")["input_ids"].to(self.device)
+            cache = self.new_cache()
+            with torch.no_grad():
+                # Without pixel values the cross attention layers are skipped, which is what
+                # they compute anyway for text that comes before the image token
+                self.model(input_ids=prefix_ids, past_key_values=cache, use_cache=True)
+            self.prefix_caches[prefix_text] = (prefix_ids, cache)
+            logger.info(f"Cached {prefix_ids.shape[1]} prefix tokens")
+        return self.prefix_caches[prefix_text]
+
+    def prepare_inputs(self, prompt, image, instruction=None, prefix_cache=True):
+        """
+        Build the chat text and the keyword arguments for model.generate.
+
+        When an instruction is given and prefix caching is enabled, only the tokens after
+        the cached instruction are prefilled: the image, the prompt and the generation header.
+        Assisted decoding needs prefix_cache=False: its first forward pass of transformers
+        takes the whole prompt and cannot start from a prefilled cache.
+        """
+        input_text = self.build_input_text(prompt, instruction)
         inputs = self.processor(image, input_text, return_tensors="pt").to(self.device)
-        output = self.model.generate(**inputs, max_new_tokens=700, min_p=0.15)
-        decoded_output =  self.processor.decode(output[0])[len(input_text)-1:]
+        if instruction is None or not self.prefix_cache or not prefix_cache:
+            return input_text, dict(inputs)
+
+        prefix_text = input_text[:input_text.index("<|image|>")]
+        prefix_ids, prefix_cache = self.get_prefix_cache(prefix_text)
+        prefix_length = prefix_ids.shape[1]
+        input_ids = inputs["input_ids"]
+        if not torch.equal(input_ids[:, :prefix_length], prefix_ids):
+            logger.debug("Prefix tokens do not match the full prompt, not using the prefix cache")
+            return input_text, dict(inputs)
+
+        # Prefill everything but the last prompt token, generate continues from there
+        cache = copy.deepcopy(prefix_cache)
+        end = input_ids.shape[1] - 1
+        with torch.no_grad():
+            self.model(
+                input_ids=input_ids[:, prefix_length:end],
+                attention_mask=inputs["attention_mask"][:, :end],
+                pixel_values=inputs["pixel_values"],
+                aspect_ratio_ids=inputs["aspect_ratio_ids"],
+                aspect_ratio_mask=inputs["aspect_ratio_mask"],
+                cross_attention_mask=inputs["cross_attention_mask"][:, prefix_length:end],
+                past_key_values=cache,
+                cache_position=torch.arange(prefix_length, end, device=self.device),
+                use_cache=True
+            )
+        # The image states now live in the cross attention cache, so no pixel values are passed
+        return input_text, dict(
+            input_ids=input_ids,
+            attention_mask=inputs["attention_mask"],
+            cross_attention_mask=inputs["cross_attention_mask"],
+            past_key_values=cache
+        )
+
+    def stopping_criteria(self, inputs):
+        criteria = StoppingCriteriaList([YamlBlockCriteria(self.processor.tokenizer, inputs["input_ids"].shape[1])])
+        if tracing.enabled():
+            criteria.append(TokenTimingCriteria())
+        return criteria
+
+    def trace_generation(self, span, mode, stopping_criteria, prompt_length, rows):
+        """Split the generate call of a span into prefill and decode, with token counts."""
+        timing = next((c for c in stopping_criteria if isinstance(c, TokenTimingCriteria)), None)
+        if timing is None or timing.first_token is None:
+            return
+        new_tokens = sum(self.last_generation_stats["new_tokens"])
+        prefill_seconds = timing.first_token - timing.start
+        decode_seconds = timing.last_token - timing.first_token
+        tracing.observe("vlm.prefill", prefill_seconds, mode=mode)
+        tracing.observe("vlm.decode", decode_seconds, mode=mode)
+        span.count("vlm.prompt_tokens", prompt_length * rows)
+        span.count("vlm.new_tokens", new_tokens)
+        span.set(rows=rows, prompt_tokens=prompt_length, new_tokens=new_tokens, prefill_seconds=prefill_seconds,
+                 decode_tokens_per_second=(new_tokens - rows) / decode_seconds if decode_seconds > 0 else None)
+
+    def assisted_decoding_mode(self, assisted=None, rows=1):
+        """
+        Assisted decoding mode of a request.
+
+        Args:
+            assisted (str): One of ASSISTED_MODES, None for the configured default
+            rows (int): Prompts decoded together, transformers only assists a single one
+        """
+        mode = assisted or self.assisted_mode
+        if mode not in ASSISTED_MODES:
+            raise ValueError(f"Unknown assisted decoding mode '{mode}', expected one of {ASSISTED_MODES}")
+        if mode != "off" and rows > 1:
+            logger.info(f"Assisted decoding needs a single prompt, decoding the {rows} rows normally")
+            return "off"
+        if mode == "draft" and self.draft_model is None:
+            raise ValueError("Assisted decoding mode 'draft' needs generation.assisted_decoding.draft_model_id")
+        return mode
+
+    def assisted_kwargs(self, mode):
+        """Keyword arguments of model.generate for an assisted decoding mode."""
+        if mode == "off":
+            return {}
+        # Rejected candidates are cropped from the cache, which must keep the image states
+        kwargs = {"past_key_values": self.new_cache()}
+        if mode == "prompt_lookup":
+            kwargs.update(prompt_lookup_num_tokens=self.prompt_lookup_num_tokens,
+                          max_matching_ngram_size=self.max_matching_ngram_size)
+        else:
+            kwargs.update(assistant_model=self.draft_model)
+        return kwargs
+
+    def run_generate(self, inputs, stopping_criteria, max_new_tokens, mode="off", **generate_kwargs):
+        """Call model.generate with an assisted decoding mode and record the generation stats."""
+        assisted_kwargs = self.assisted_kwargs(mode)
+        counter = None
+        if mode != "off":
+            counter = AssistedDecodingCounter(self.model, inputs["input_ids"].shape[1])
+        start = time.perf_counter()
         try:
-            self.model.to("cpu")
-        except Excpetion as e:
-            print(str(e))
-        torch.cuda.empty_cache()
-        gc.collect()
-        return decoded_output.replace("|end_header_id|>", "").replace("<|eot_id|>", "")
-    
+            output = self.model.generate(
+                **inputs,
+                **assisted_kwargs,
+                **generate_kwargs,
+                stopping_criteria=stopping_criteria,
+                max_new_tokens=max_new_tokens,
+                min_p=0.15
+            )
+        finally:
+            if counter is not None:
+                counter.remove()
+        self.record_generation_stats(output, inputs["input_ids"].shape[1], max_new_tokens,
+                                     time.perf_counter() - start, mode, counter)
+        return output
+
+    def record_generation_stats(self, output, prompt_length, max_new_tokens, seconds=None, assisted="off", counter=None):
+        """
+        Record how many tokens were generated and how much of the budget early stopping saved.
+
+        tokens_per_second covers the whole generate call, prefill included. With assisted
+        decoding the proposed and accepted candidate tokens are recorded as well.
+        """
+        generated = output[:, prompt_length:]
+        pad_token_id = self.processor.tokenizer.pad_token_id
+        if pad_token_id is not None:
+            new_tokens = (generated != pad_token_id).sum(dim=1).tolist()
+        else:
+            new_tokens = [generated.shape[1]] * generated.shape[0]
+        tokens_saved = [max_new_tokens - count for count in new_tokens]
+        self.last_generation_stats = {
+            "max_new_tokens": max_new_tokens,
+            "new_tokens": new_tokens,
+            "tokens_saved": tokens_saved,
+            "seconds": seconds,
+            "tokens_per_second": sum(new_tokens) / seconds if seconds else None,
+            "assisted": assisted
+        }
+        logger.info(f"Generated {new_tokens} new tokens, saved {tokens_saved} of the {max_new_tokens} token budget")
+        if counter is not None:
+            stats = counter.stats(sum(new_tokens))
+            self.last_generation_stats.update(stats)
+            tracing.count("vlm.proposed_tokens", stats["proposed_tokens"], assisted=assisted)
+            tracing.count("vlm.accepted_tokens", stats["accepted_tokens"], assisted=assisted)
+            logger.info(f"Assisted decoding ({assisted}) accepted {stats['accepted_tokens']} of {stats['proposed_tokens']} "
+                        f"candidate tokens in {stats['forwards']} forward passes")
+
+    def generate(self, prompt, image, max_new_tokens=700, instruction=None, assisted=None):
+        with tracing.span("vlm.generate", mode="single") as span, self.residency.use("vlm"):
+            mode = self.assisted_decoding_mode(assisted)
+            with tracing.span("vlm.prepare"):
+                input_text, inputs = self.prepare_inputs(prompt, image, instruction, prefix_cache=mode == "off")
+            stopping_criteria = self.stopping_criteria(inputs)
+            output = self.run_generate(inputs, stopping_criteria, max_new_tokens, mode)
+            self.trace_generation(span, "single", stopping_criteria, inputs["input_ids"].shape[1], 1)
+            return self.decode(output[0], input_text)
+
+    def generate_stream(self, prompt, image, max_new_tokens=700, instruction=None, assisted=None):
+        """
+        Generate an output for one prompt and image, yielding decoded text as it is produced.
+
+        The yielded chunks only contain generated text: the prompt, the "```yaml"
+        prefix and special tokens are not included. With assisted decoding a chunk can
+        hold several tokens. assisted is one of ASSISTED_MODES, None for the configured one.
+        """
+        with tracing.span("vlm.generate", mode="stream") as span, self.residency.use("vlm"):
+            mode = self.assisted_decoding_mode(assisted)
+            with tracing.span("vlm.prepare"):
+                input_text, inputs = self.prepare_inputs(prompt, image, instruction, prefix_cache=mode == "off")
+            streamer = TextIteratorStreamer(self.processor.tokenizer, skip_prompt=True, skip_special_tokens=True)
+            cancel = CancelCriteria()
+            stopping_criteria = self.stopping_criteria(inputs)
+            stopping_criteria.append(cancel)
+
+            error = []
+
+            def run():
+                try:
+                    self.run_generate(inputs, stopping_criteria, max_new_tokens, mode, streamer=streamer)
+                    self.trace_generation(span, "stream", stopping_criteria, inputs["input_ids"].shape[1], 1)
+                except Exception as e:
+                    logger.exception("Error during streamed generation")
+                    error.append(e)
+                    # Unblock the consumer, the streamer is only ended on success
+                    streamer.end()
+
+            thread = Thread(target=run)
+            thread.start()
+            try:
+                for text in streamer:
+                    yield text
+                thread.join()
+                if error:
+                    # The consumer must not take the text so far for a complete answer
+                    raise error[0]
+            finally:
+                # Stop decoding if the consumer stopped reading early
+                cancel.event.set()
+                thread.join()
+
+    def generate_batch(self, prompts, images, max_new_tokens=700, instruction=None, assisted=None):
+        """
+        Generate outputs for several prompt/image pairs with a single generate call.
+
+        Args:
+            prompts (list): Prompt texts, one per image
+            images (list): PIL images, one per prompt
+            max_new_tokens (int): Token budget per item, decoding stops earlier once the YAML block is complete
+            instruction (str): Static instruction placed before the image of every item
+            assisted (str): One of ASSISTED_MODES, None for the configured one, only applied to a single item
+
+        Returns:
+            list: Decoded outputs in the same order as the inputs
+        """
+        if len(prompts) != len(images):
+            raise ValueError(f"Got {len(prompts)} prompts for {len(images)} images")
+        if not prompts:
+            return []
+
+        with tracing.span("vlm.generate", mode="batch") as span, self.residency.use("vlm"):
+            with tracing.span("vlm.prepare"):
+                input_texts = [self.build_input_text(prompt, instruction) for prompt in prompts]
+                inputs = self.processor(
+                    [[image] for image in images],
+                    input_texts,
+                    padding=True,
+                    return_tensors="pt"
+                ).to(self.device)
+            stopping_criteria = self.stopping_criteria(inputs)
+            mode = self.assisted_decoding_mode(assisted, len(prompts))
+            output = self.run_generate(dict(inputs), stopping_criteria, max_new_tokens, mode)
+            self.trace_generation(span, "batch", stopping_criteria, inputs["input_ids"].shape[1], len(prompts))
+            return [
+                self.decode(sequence, input_text)
+                for sequence, input_text in zip(output, input_texts)
+            ]
+
 
 """if __name__ == "__main__":
     from PIL import Image
@@ -42,4 +628,4 @@ class VLMModel():
     prompt = "Write a title and a description for this image"
     model = VLMModel(model_id = "meta-llama/Llama-3.2-11B-Vision-Instruct")
     description = model.generate(prompt, image)
-    print(description)"""
\ No newline at end of file
+    print(description)"""
@@ -0,0 +1,75 @@
+"""
+Factories of the heavy objects of the app, shared by the Streamlit process and the
+worker processes. Each factory imports its module when it runs, see ModelRegistry.
+"""
+from typing import Any, Dict, Optional, Iterable
+
+from model_registry import ModelRegistry
+from residency import ResidencyManager
+
+
+def build_vlm(config: Dict[str, Any], residency_manager: ResidencyManager):
+    from model import VLMModel
+    model_config = dict(config["model"])
+    return VLMModel(
+        model_id = model_config.pop("model_id"),
+        residency_manager=residency_manager,
+        prefix_cache=config.get("generation", {}).get("prefix_cache", True),
+        assisted_decoding=config.get("generation", {}).get("assisted_decoding"),
+        profile=model_config.pop("profile", None),
+        profile_overrides=model_config
+    )
+
+
+def build_comfy_handler(config: Dict[str, Any]):
+    """A ComfyUIHandler, or a ComfyUIPool with one handler per server when comfyui.servers is set."""
+    from comfyui import ComfyUIHandler
+    comfyui_config = config.get("comfyui", {})
+    upload_config = comfyui_config.get("upload", {})
+    handler_kwargs = dict(
+        workflow_path=comfyui_config.get("workflow_path", "workflow.json"),
+        output_node=comfyui_config.get("output_node", "75"),
+        history_output_node=comfyui_config.get("history_output_node", "76"),
+        upload_encoding=upload_config.get("encoding", "png"),
+        png_compress_level=upload_config.get("png_compress_level", 1),
+        input_dir=upload_config.get("input_dir"),
+        max_input_age_hours=upload_config.get("max_input_age_hours", 24),
+        max_inputs=upload_config.get("max_inputs", 1000),
+        color_backend=comfyui_config.get("color_backend", "kmeans")
+    )
+    servers = comfyui_config.get("servers") or []
+    if not servers:
+        return ComfyUIHandler(server_address=comfyui_config.get("server_address", "127.0.0.1:8188"), **handler_kwargs)
+    from comfyui_pool import ComfyUIPool
+    return ComfyUIPool([ComfyUIHandler(server_address=address, **handler_kwargs) for address in servers],
+                       **comfyui_config.get("pool", {}))
+
+
+def build_audio_transcriber(config: Dict[str, Any], residency_manager: ResidencyManager):
+    from audio_transcriber import AudioTranscriber
+    transcription_config = dict(config.get("transcription", {}))
+    return AudioTranscriber(
+        model_path=transcription_config.pop("model_path", "deepdml/faster-whisper-large-v3-turbo-ct2"),
+        device=transcription_config.pop("device", "cuda"),
+        residency_manager=residency_manager,
+        **transcription_config
+    )
+
+
+def build_registry(config: Dict[str, Any], warm_up: Optional[Iterable[str]] = None) -> ModelRegistry:
+    """
+    Registry with the VLM ('vlm'), ComfyUI client ('comfyui') and Whisper ('whisper').
+
+    Args:
+        config (dict): Parsed config.yaml
+        warm_up (list): Models loaded in the background right away, startup.warm_up by default
+    """
+    residency_manager = ResidencyManager(**config.get("residency", {}))
+    registry = ModelRegistry()
+    registry.register("vlm", lambda: build_vlm(config, residency_manager))
+    registry.register("comfyui", lambda: build_comfy_handler(config))
+    registry.register("whisper", lambda: build_audio_transcriber(config, residency_manager))
+    if warm_up is None:
+        warm_up = config.get("startup", {}).get("warm_up", ["vlm", "comfyui"])
+    registry.warm_up(warm_up)
+    return registry
@@ -0,0 +1,106 @@
+import time
+import logging
+import threading
+from typing import Any, Callable, Dict, Iterable, Optional
+
+logger = logging.getLogger('ModelRegistry')
+
+# Lifecycle of a registered model
+STATES = ("idle", "loading", "ready", "failed")
+
+
+class ModelRegistry:
+    def __init__(self):
+        """
+        Heavy objects (models, server clients) built on first use or warmed up in the background.
+
+        Factories should import their heavy dependencies themselves, so that importing
+        the app only costs what the UI needs and the models load while it is already shown.
+        """
+        self.lock = threading.Lock()
+        self.entries: Dict[str, Dict[str, Any]] = {}
+
+    def register(self, name: str, factory: Callable[[], Any]) -> None:
+        """
+        Args:
+            name (str): Name the object is requested with
+            factory (callable): Builds the object, called at most once unless it fails
+        """
+        with self.lock:
+            if name in self.entries:
+                raise ValueError(f"Model '{name}' is already registered")
+            self.entries[name] = {
+                "factory": factory,
+                "state": "idle",
+                "value": None,
+                "error": None,
+                "done": threading.Event(),
+                "thread": None,
+                "load_seconds": None,
+            }
+
+    def warm_up(self, names: Optional[Iterable[str]] = None) -> None:
+        """Start loading the given models (all of them by default) in background threads."""
+        for name in (self.entries if names is None else names):
+            with self.lock:
+                entry = self.entries[name]
+                if not self._claim(entry):
+                    continue
+                entry["thread"] = threading.Thread(target=self._load, args=(name,), name=f"warm-up-{name}", daemon=True)
+                entry["thread"].start()
+
+    def get(self, name: str, timeout: Optional[float] = None) -> Any:
+        """
+        Return the model, building it in this thread if nobody started it yet, otherwise
+        waiting for the load in progress.
+        """
+        with self.lock:
+            entry = self.entries[name]
+            load_here = self._claim(entry)
+        if load_here:
+            self._load(name)
+        if not entry["done"].wait(timeout):
+            raise TimeoutError(f"Model '{name}' is still loading")
+        if entry["state"] == "failed":
+            raise RuntimeError(f"Model '{name}' failed to load: {entry['error']}")
+        return entry["value"]
+
+    def is_ready(self, name: str) -> bool:
+        return self.entries[name]["state"] == "ready"
+
+    def status(self) -> Dict[str, Dict[str, Any]]:
+        """State, load time and error of every registered model."""
+        with self.lock:
+            return {
+                name: {"state": entry["state"], "load_seconds": entry["load_seconds"], "error": entry["error"]}
+                for name, entry in self.entries.items()
+            }
+
+    def _claim(self, entry: Dict[str, Any]) -> bool:
+        """Mark an idle or failed entry as loading, called with the lock held."""
+        if entry["state"] not in ("idle", "failed"):
+            return False
+        entry["state"] = "loading"
+        entry["error"] = None
+        entry["done"].clear()
+        return True
+
+    def _load(self, name: str) -> None:
+        entry = self.entries[name]
+        logger.info(f"Loading {name}")
+        start = time.perf_counter()
+        try:
+            value = entry["factory"]()
+        except Exception as e:
+            logger.error(f"Failed to load {name}: {e}")
+            with self.lock:
+                entry["state"] = "failed"
+                entry["error"] = str(e)
+        else:
+            with self.lock:
+                entry["value"] = value
+                entry["state"] = "ready"
+                entry["load_seconds"] = time.perf_counter() - start
+            logger.info(f"Loaded {name} in {entry['load_seconds']:.1f}s")
+        finally:
+            entry["done"].set()
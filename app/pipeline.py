@@ -0,0 +1,139 @@
+import time
+import logging
+import threading
+import contextvars
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Optional
+
+logger = logging.getLogger('Pipeline')
+
+
+class StageGraph:
+    def __init__(self, executor: Optional[Executor] = None, max_workers: int = 4):
+        """
+        Stages that start as soon as the stages they depend on have finished.
+
+        A stage function receives the results of its dependencies as keyword arguments
+        named after them. Stages without a function are external: their result comes
+        from the caller through set_result, e.g. a field parsed from a model stream.
+        A failed stage fails every stage that depends on it. Stages run in the context
+        of the add() call, so their tracing spans nest under the caller's span.
+
+            graph = StageGraph()
+            graph.add("upload", upload)
+            graph.add("product_data")
+            graph.add("workflow", lambda upload, product_data: ..., deps=("upload", "product_data"))
+            graph.set_result("product_data", data)
+            graph.result("workflow")
+
+        Args:
+            executor (Executor): Runs the stages, a thread pool owned by the graph by default
+            max_workers (int): Threads of the owned pool
+        """
+        self.executor = executor or ThreadPoolExecutor(max_workers, thread_name_prefix="stage")
+        self.own_executor = executor is None
+        self.lock = threading.Lock()
+        self.stages: Dict[str, Dict[str, Any]] = {}
+        self.start_time = time.perf_counter()
+
+    def add(self, name: str, fn: Optional[Callable[..., Any]] = None, deps: Iterable[str] = ()) -> Future:
+        """Add a stage, its dependencies must have been added before."""
+        deps = tuple(deps)
+        with self.lock:
+            if name in self.stages:
+                raise ValueError(f"Stage '{name}' already exists")
+            missing = [dep for dep in deps if dep not in self.stages]
+            if missing:
+                raise KeyError(f"Stage '{name}' depends on unknown stages {missing}")
+            stage = {"fn": fn, "deps": deps, "future": Future(), "launched": False,
+                     "context": contextvars.copy_context(), "ready": None, "start": None, "end": None}
+            self.stages[name] = stage
+        for dep in deps:
+            self.stages[dep]["future"].add_done_callback(lambda _: self._launch(name))
+        if fn is not None and not deps:
+            self._launch(name)
+        return stage["future"]
+
+    def set_result(self, name: str, value: Any) -> None:
+        """Resolve an external stage."""
+        stage = self._external(name)
+        stage["end"] = time.perf_counter()
+        stage["future"].set_result(value)
+
+    def set_exception(self, name: str, exception: BaseException) -> None:
+        """Fail an external stage and everything that depends on it."""
+        stage = self._external(name)
+        stage["end"] = time.perf_counter()
+        stage["future"].set_exception(exception)
+
+    def done(self, name: str) -> bool:
+        return self.stages[name]["future"].done()
+
+    def result(self, name: str, timeout: Optional[float] = None) -> Any:
+        return self.stages[name]["future"].result(timeout)
+
+    def timings(self) -> Dict[str, Dict[str, Optional[float]]]:
+        """
+        Per stage, relative to the creation of the graph: when its inputs were ready,
+        when it finished, and how long it ran (external stages have no run time).
+        """
+        timings = {}
+        for name, stage in self.stages.items():
+            relative = {key: None if stage[key] is None else stage[key] - self.start_time
+                        for key in ("ready", "start", "end")}
+            seconds = stage["end"] - stage["start"] if stage["start"] is not None and stage["end"] is not None else None
+            timings[name] = {"ready": relative["ready"], "finished": relative["end"], "seconds": seconds}
+        return timings
+
+    def report(self) -> str:
+        parts = []
+        for name, timing in self.timings().items():
+            future = self.stages[name]["future"]
+            if timing["finished"] is None:
+                parts.append(f"{name} unfinished")
+            elif future.done() and future.exception() is not None:
+                parts.append(f"{name} failed at {timing['finished']:.2f}s")
+            elif timing["seconds"] is None:
+                parts.append(f"{name} at {timing['finished']:.2f}s")
+            else:
+                parts.append(f"{name} {timing['seconds']:.2f}s (done at {timing['finished']:.2f}s)")
+        return ", ".join(parts)
+
+    def close(self) -> None:
+        if self.own_executor:
+            self.executor.shutdown(wait=False)
+
+    def _external(self, name: str) -> Dict[str, Any]:
+        stage = self.stages[name]
+        if stage["fn"] is not None:
+            raise ValueError(f"Stage '{name}' is not external")
+        return stage
+
+    def _launch(self, name: str) -> None:
+        stage = self.stages[name]
+        with self.lock:
+            if stage["launched"] or not all(self.stages[dep]["future"].done() for dep in stage["deps"]):
+                return
+            stage["launched"] = True
+        stage["ready"] = time.perf_counter()
+        for dep in stage["deps"]:
+            error = self.stages[dep]["future"].exception()
+            if error is not None:
+                stage["end"] = stage["ready"]
+                stage["future"].set_exception(error)
+                return
+        inputs = {dep: self.stages[dep]["future"].result() for dep in stage["deps"]}
+        self.executor.submit(self._run, name, inputs)
+
+    def _run(self, name: str, inputs: Dict[str, Any]) -> None:
+        stage = self.stages[name]
+        stage["start"] = time.perf_counter()
+        try:
+            result = stage["context"].run(stage["fn"], **inputs)
+        except BaseException as e:
+            stage["end"] = time.perf_counter()
+            logger.error(f"Stage {name} failed: {e}")
+            stage["future"].set_exception(e)
+        else:
+            stage["end"] = time.perf_counter()
+            stage["future"].set_result(result)
@@ -0,0 +1,195 @@
+import gc
+import sys
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Dict, Any, Optional
+
+logger = logging.getLogger('Residency')
+
+POLICIES = ("always_resident", "idle_timeout", "on_pressure")
+
+
+def _loaded_torch():
+    """torch if a model has imported it already, importing it here would slow down startup."""
+    return sys.modules.get("torch")
+
+
+class TorchResident:
+    """Adapter that moves a torch module between its compute device and the CPU."""
+
+    def __init__(self, module: "torch.nn.Module", device: str):
+        self.module = module
+        self.device = device
+
+    def footprint(self) -> int:
+        tensors = list(self.module.parameters()) + list(self.module.buffers())
+        return sum(t.numel() * t.element_size() for t in tensors)
+
+    def load(self) -> None:
+        self.module.to(self.device)
+
+    def unload(self) -> None:
+        self.module.to("cpu")
+
+
+class CTranslate2Resident:
+    """Adapter for CTranslate2 models (faster-whisper), which manage their own weights."""
+
+    def __init__(self, model: Any, footprint_bytes: int = 0):
+        self.model = model
+        self.footprint_bytes = footprint_bytes
+
+    def footprint(self) -> int:
+        return self.footprint_bytes
+
+    def load(self) -> None:
+        if not self.model.model_is_loaded:
+            self.model.load_model()
+
+    def unload(self) -> None:
+        self.model.unload_model(to_cpu=True)
+
+
+class ResidencyManager:
+    def __init__(self, policy: str = "always_resident", idle_seconds: float = 300,
+                 memory_budget_gb: Optional[float] = None):
+        """
+        Decide when heavy models are moved to and from their compute device.
+
+        Args:
+            policy (str): 'always_resident' keeps models on the device after first use,
+                'idle_timeout' offloads a model once it has been idle for idle_seconds,
+                'on_pressure' offloads the least recently used idle models only when
+                another model needs the memory
+            idle_seconds (float): Idle time before offloading with 'idle_timeout'
+            memory_budget_gb (float): Device memory the models may share. When not set
+                the free memory reported by CUDA is used
+        """
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown residency policy '{policy}', expected one of {POLICIES}")
+        self.policy = policy
+        self.idle_seconds = idle_seconds
+        self.memory_budget = int(memory_budget_gb * 1024**3) if memory_budget_gb else None
+        self.lock = threading.RLock()
+        self.models: Dict[str, Dict[str, Any]] = {}
+
+    def register(self, name: str, resident, loaded: bool = False) -> None:
+        """Register a model adapter. Set loaded when it already sits on its device."""
+        with self.lock:
+            self.models[name] = {
+                "resident": resident,
+                "loaded": loaded,
+                "in_use": 0,
+                "last_used": time.monotonic(),
+                "timer": None,
+                "stats": {"loads": 0, "offloads": 0, "transfer_seconds": 0.0, "gc_seconds": 0.0},
+            }
+
+    def is_loaded(self, name: str) -> bool:
+        return self.models[name]["loaded"]
+
+    def acquire(self, name: str) -> None:
+        """Make sure the model is on its device and mark it as in use."""
+        with self.lock:
+            entry = self.models[name]
+            if entry["timer"] is not None:
+                entry["timer"].cancel()
+                entry["timer"] = None
+            if not entry["loaded"]:
+                if self.policy == "on_pressure":
+                    self._make_room(name)
+                start = time.perf_counter()
+                entry["resident"].load()
+                entry["stats"]["transfer_seconds"] += time.perf_counter() - start
+                entry["stats"]["loads"] += 1
+                entry["loaded"] = True
+                logger.info(f"Loaded {name} to device in {time.perf_counter() - start:.3f}s")
+            entry["in_use"] += 1
+
+    def release(self, name: str) -> None:
+        """Mark the model as no longer in use and apply the idle policy."""
+        with self.lock:
+            entry = self.models[name]
+            entry["in_use"] = max(0, entry["in_use"] - 1)
+            entry["last_used"] = time.monotonic()
+            if self.policy == "idle_timeout" and entry["in_use"] == 0:
+                if self.idle_seconds <= 0:
+                    self.offload(name)
+                else:
+                    entry["timer"] = threading.Timer(self.idle_seconds, self._offload_if_idle, args=(name,))
+                    entry["timer"].daemon = True
+                    entry["timer"].start()
+
+    @contextmanager
+    def use(self, name: str):
+        """Context manager around acquire/release."""
+        self.acquire(name)
+        try:
+            yield
+        finally:
+            self.release(name)
+
+    def offload(self, name: str) -> bool:
+        """Move an idle model off its device. Returns False if it is busy or not loaded."""
+        with self.lock:
+            entry = self.models[name]
+            if not entry["loaded"] or entry["in_use"] > 0:
+                return False
+            start = time.perf_counter()
+            try:
+                entry["resident"].unload()
+            except Exception as e:
+                logger.error(f"Failed to offload {name}: {e}")
+                return False
+            transfer_time = time.perf_counter() - start
+            start = time.perf_counter()
+            torch = _loaded_torch()
+            if torch is not None and torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            gc.collect()
+            gc_time = time.perf_counter() - start
+            entry["loaded"] = False
+            entry["stats"]["offloads"] += 1
+            entry["stats"]["transfer_seconds"] += transfer_time
+            entry["stats"]["gc_seconds"] += gc_time
+            logger.info(f"Offloaded {name} in {transfer_time:.3f}s (gc {gc_time:.3f}s)")
+            return True
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        with self.lock:
+            return {
+                name: dict(entry["stats"], loaded=entry["loaded"], in_use=entry["in_use"])
+                for name, entry in self.models.items()
+            }
+
+    def _offload_if_idle(self, name: str) -> None:
+        with self.lock:
+            entry = self.models[name]
+            entry["timer"] = None
+            if entry["in_use"] == 0 and time.monotonic() - entry["last_used"] >= self.idle_seconds:
+                self.offload(name)
+
+    def _available_memory(self) -> Optional[int]:
+        if self.memory_budget is not None:
+            used = sum(e["resident"].footprint() for e in self.models.values() if e["loaded"])
+            return self.memory_budget - used
+        torch = _loaded_torch()
+        if torch is not None and torch.cuda.is_available():
+            return torch.cuda.mem_get_info()[0]
+        return None
+
+    def _make_room(self, name: str) -> None:
+        needed = self.models[name]["resident"].footprint()
+        candidates = sorted(
+            (n for n, e in self.models.items() if n != name and e["loaded"] and e["in_use"] == 0),
+            key=lambda n: self.models[n]["last_used"]
+        )
+        available = self._available_memory()
+        while available is not None and available < needed and candidates:
+            self.offload(candidates.pop(0))
+            available = self._available_memory()
+        if available is not None and available < needed:
+            logger.warning(f"Not enough device memory for {name}: need {needed}, have {available}")
+
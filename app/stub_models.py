@@ -0,0 +1,104 @@
+"""
+Stand-ins for the VLM and Whisper with realistic timing but no weights, for local
+testing and benchmarks of the parts around the models (worker pool, pipelines,
+batch runs). Used with the fake ComfyUI server for the enhancement step.
+
+    registry = build_stub_registry(config)
+"""
+import io
+import time
+from typing import Any, Dict, Iterable, Optional
+
+from model_registry import ModelRegistry
+
+STUB_ANSWER = (
+    "\nentity_name: mug\n"
+    "product_title: Kırmızı Seramik Kupa - 300 ml\n"
+    "product_description: 300 ml hacimli kırmızı seramik kupa, bulaşık makinesinde yıkanabilir.\n"
+    # Indented, so that YAML reads it as the rest of the description
+    "  Günlük kullanım için dayanıklıdır.\n"
+    "```"
+)
+
+
+class StubVLM:
+    def __init__(self, token_seconds: float = 0.01, prefill_seconds: float = 0.2, answer: str = STUB_ANSWER):
+        """
+        Args:
+            token_seconds (float): Decode time per streamed token
+            prefill_seconds (float): Time before the first token
+            answer (str): Text every request is answered with, split on spaces into tokens
+        """
+        self.token_seconds = token_seconds
+        self.prefill_seconds = prefill_seconds
+        self.answer = answer
+        self.last_generation_stats = None
+
+    def tokens(self):
+        words = self.answer.split(" ")
+        return [word if i == 0 else " " + word for i, word in enumerate(words)]
+
+    # assisted is accepted like in VLMModel, it does not change the stub timing
+    def generate_stream(self, prompt, image, max_new_tokens=700, instruction=None, assisted=None):
+        time.sleep(self.prefill_seconds)
+        for token in self.tokens()[:max_new_tokens]:
+            time.sleep(self.token_seconds)
+            yield token
+
+    def generate(self, prompt, image, max_new_tokens=700, instruction=None, assisted=None):
+        return "".join(self.generate_stream(prompt, image, max_new_tokens, instruction))
+
+    def generate_batch(self, prompts, images, max_new_tokens=700, instruction=None, assisted=None):
+        time.sleep(self.prefill_seconds)
+        tokens = self.tokens()[:max_new_tokens]
+        time.sleep(self.token_seconds * len(tokens))
+        return ["".join(tokens) for _ in prompts]
+
+
+class StubTranscriber:
+    def __init__(self, real_time_factor: float = 0.1, text: str = "kırmızı seramik kupa 300 ml", language: str = "tr"):
+        """
+        Args:
+            real_time_factor (float): Processing seconds per second of audio, 16 kHz int16 assumed
+            text (str): Transcription returned for every clip
+            language (str): Language returned for every clip
+        """
+        self.real_time_factor = real_time_factor
+        self.text = text
+        self.language = language
+
+    def transcribe(self, audio_data):
+        size = len(audio_data.getvalue()) if isinstance(audio_data, io.BytesIO) else len(audio_data)
+        time.sleep(size / 32000 * self.real_time_factor)
+        return self.text, self.language
+
+    def __call__(self, audio_data):
+        return self.transcribe(audio_data)
+
+
+def build_stub_registry(config: Dict[str, Any], warm_up: Optional[Iterable[str]] = None) -> ModelRegistry:
+    """
+    Registry like model_factories.build_registry with stub models. The ComfyUI client is
+    the real one, point comfyui.server_address at a FakeComfyUIServer. Timings come from
+    the optional 'stub_models' section of the config.
+    """
+    from model_factories import build_comfy_handler
+
+    stub_config = config.get("stub_models", {})
+    load_seconds = stub_config.get("load_seconds", 0.0)
+
+    def load(factory):
+        def build():
+            time.sleep(load_seconds)
+            return factory()
+        return build
+
+    registry = ModelRegistry()
+    registry.register("vlm", load(lambda: StubVLM(
+        token_seconds=stub_config.get("token_seconds", 0.01),
+        prefill_seconds=stub_config.get("prefill_seconds", 0.2)
+    )))
+    registry.register("comfyui", lambda: build_comfy_handler(config))
+    registry.register("whisper", load(lambda: StubTranscriber(stub_config.get("real_time_factor", 0.1))))
+    registry.warm_up(warm_up or [])
+    return registry
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The app modules are imported flat, as when running from app/
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if APP_DIR not in sys.path:
+    sys.path.insert(0, APP_DIR)
@@ -0,0 +1,25 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from batch import Checkpoint
+
+
+def test_concurrent_appends_are_all_counted(tmp_path):
+    path = str(tmp_path / "results.jsonl")
+    checkpoint = Checkpoint(path)
+
+    def append(index):
+        checkpoint.append({"id": str(index), "status": "error" if index % 5 == 0 else "ok"})
+
+    with ThreadPoolExecutor(16) as executor:
+        list(executor.map(append, range(500)))
+    checkpoint.close()
+    assert checkpoint.counts == {"ok": 400, "error": 100}
+    with open(path, encoding="utf-8") as file:
+        assert len([json.loads(line) for line in file]) == 500
+
+    # Counts only cover the records appended since opening, done ids are read back
+    reopened = Checkpoint(path)
+    assert reopened.counts == {"ok": 0, "error": 0}
+    assert len(reopened.done) == 400 and len(reopened.failed) == 100
+    reopened.close()
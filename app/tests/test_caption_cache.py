@@ -0,0 +1,108 @@
+import os
+
+import pytest
+from PIL import Image
+
+import caption_cache
+from caption_cache import CaptionCache
+
+IMAGE = Image.new("RGB", (32, 32), (10, 120, 200))
+PROMPT = "Ürünü YAML olarak tanımla\n prompt: kupa"
+MODEL_ID = "meta-llama/Llama-3.2-11B-Vision-Instruct"
+
+
+@pytest.fixture
+def make_cache(tmp_path):
+    def make(**kwargs):
+        return CaptionCache.__wrapped__(**dict({"disk_dir": str(tmp_path / "cache")}, **kwargs))
+    return make
+
+
+class CountingModel:
+    def __init__(self):
+        self.calls = 0
+
+    def caption(self, prompt):
+        self.calls += 1
+        return f"answer {self.calls} to {prompt}"
+
+
+def caption(cache, model, image=IMAGE, prompt=PROMPT, model_id=MODEL_ID):
+    """The lookup of app.caption_stream: the model only runs on a miss."""
+    key = cache.make_key(image, prompt, model_id, max_new_tokens=700)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+    answer = model.caption(prompt)
+    cache.put(key, answer)
+    return answer
+
+
+def test_memory_hit_does_not_run_the_model(make_cache):
+    cache, model = make_cache(), CountingModel()
+    first = caption(cache, model)
+    assert caption(cache, model) == first
+    assert caption(cache, model, image=IMAGE.copy()) == first
+    assert model.calls == 1
+    assert cache.stats() == {"memory_hits": 2, "disk_hits": 0, "misses": 1, "evictions": 0, "memory_entries": 1}
+
+
+def test_disk_hit_after_memory_is_cleared(make_cache):
+    cache, model = make_cache(), CountingModel()
+    first = caption(cache, model)
+    cache.memory.clear()
+    assert caption(cache, model) == first
+    # A new process reads the same store
+    restarted = make_cache()
+    assert caption(restarted, model) == first
+    assert model.calls == 1
+    assert cache.counters["disk_hits"] == 1 and restarted.counters["disk_hits"] == 1
+
+
+def test_changed_prompt_image_or_model_misses(make_cache):
+    cache, model = make_cache(), CountingModel()
+    caption(cache, model)
+    caption(cache, model, prompt=PROMPT.replace("YAML", "yaml"))
+    caption(cache, model, model_id="tiny_vlm")
+    caption(cache, model, image=Image.new("RGB", (32, 32), (10, 120, 201)))
+    assert model.calls == 4
+    assert cache.counters["misses"] == 4 and cache.counters["memory_hits"] == 0
+
+
+def test_memory_tier_is_lru(make_cache):
+    cache = make_cache(memory_entries=2, disk_dir=None)
+    for key in ("a", "b"):
+        cache.put(key, key)
+    cache.get("a")
+    cache.put("c", "c")
+    assert list(cache.memory) == ["a", "c"]
+    assert cache.get("b") is None
+
+
+def test_disk_is_evicted_by_size_without_scanning_on_every_write(make_cache, monkeypatch, tmp_path):
+    scans = []
+    scandir = os.scandir
+    monkeypatch.setattr(caption_cache.os, "scandir", lambda path: scans.append(path) or scandir(path))
+    # Room for about ten answers of 1 kB
+    cache = make_cache(disk_max_mb=10.5 / 1024)
+    for index in range(10):
+        cache.put(f"{index:02d}", "x" * 1000)
+    assert len(scans) == 1
+    assert cache.counters["evictions"] == 0
+
+    for index in range(10, 30):
+        cache.put(f"{index:02d}", "x" * 1000)
+    files = sorted(name[:-5] for name in os.listdir(tmp_path / "cache"))
+    sizes = sum(os.path.getsize(tmp_path / "cache" / f"{name}.json") for name in files)
+    assert sizes == cache.disk_bytes <= cache.disk_max_bytes
+    assert cache.counters["evictions"] == 30 - len(files)
+    # The least recently written entries went first, and evicting below the budget spares scans
+    assert files == [f"{index:02d}" for index in range(30 - len(files), 30)]
+    assert len(scans) <= 11
+
+
+def test_overwritten_entry_is_counted_once(make_cache, tmp_path):
+    cache = make_cache()
+    cache.put("a", "short")
+    cache.put("a", "a longer answer")
+    assert cache.disk_bytes == os.path.getsize(tmp_path / "cache" / "a.json")
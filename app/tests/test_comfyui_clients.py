@@ -0,0 +1,225 @@
+import io
+import os
+import time
+import asyncio
+import threading
+
+import pytest
+from PIL import Image
+
+from comfyui import ComfyUIHandler
+from comfyui_async import AsyncComfyUIClient
+from comfyui_session import PromptExecutionError, PromptValidationError
+from fake_comfyui import FakeComfyUIServer
+
+WORKFLOW = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "workflow.json")
+PRODUCT_DATA = {"entity_name": "jar"}
+
+
+@pytest.fixture
+def start_server():
+    servers = []
+
+    def start(**kwargs):
+        server = FakeComfyUIServer(**kwargs).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.stop()
+
+
+def images(count):
+    return [Image.new("RGB", (64, 64), (40 * index % 256, 90, 200)) for index in range(count)]
+
+
+def make_handler(server, **kwargs):
+    return ComfyUIHandler(server_address=server.address, workflow_path=WORKFLOW, color_backend="histogram", **kwargs)
+
+
+def test_handler_runs_concurrent_prompts_over_one_websocket(start_server):
+    server = start_server(delay=0.1)
+    handler = make_handler(server)
+    results = [None] * 4
+
+    def run(index, image):
+        results[index] = handler.generate_enhanced_image(image, PRODUCT_DATA)
+
+    threads = [threading.Thread(target=run, args=(index, image)) for index, image in enumerate(images(4))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+    handler.close()
+
+    assert all(isinstance(result, Image.Image) for result in results)
+    assert server.counters["prompts"] == 4
+    assert server.counters["ws_connections"] == 1
+
+
+def test_handler_finishes_prompt_after_websocket_reconnect(start_server):
+    server = start_server(delay=0.5)
+    handler = make_handler(server)
+    prompt_id = handler.queue_prompt(handler.modify_workflow(handler.upload_image(images(1)[0]), PRODUCT_DATA, "white"))
+    server.drop_websockets()
+    waiter = handler.wait_for_completion(prompt_id, timeout=20)
+    result = handler.get_result(prompt_id, waiter)
+    handler.close()
+
+    assert isinstance(result, Image.Image)
+    assert server.counters["ws_connections"] >= 2
+
+
+def test_handler_runs_history_output_node_when_the_image_is_lost(start_server):
+    server = start_server(drop_images=True)
+    handler = make_handler(server)
+    result = handler.generate_enhanced_image(images(1)[0], PRODUCT_DATA)
+    handler.close()
+
+    assert isinstance(result, Image.Image)
+    # The job ran without the SaveImage, the second prompt only with it and the nodes feeding it
+    first, second = server.workflows.values()
+    assert "76" not in first and "75" in first
+    assert "76" in second and "75" not in second
+    assert second["15"] == first["15"] and second["54"] == first["54"]
+
+
+def test_handler_raises_execution_error(start_server):
+    server = start_server(fail_execution=True)
+    handler = make_handler(server)
+    prompt_id = handler.queue_prompt(handler.modify_workflow(handler.upload_image(images(1)[0]), PRODUCT_DATA, "white"))
+    with pytest.raises(PromptExecutionError, match="fake execution error"):
+        handler.wait_for_completion(prompt_id, timeout=10)
+    assert handler.generate_enhanced_image(images(1)[0], PRODUCT_DATA) is None
+    handler.close()
+
+
+def test_handler_raises_validation_error(start_server):
+    server = start_server(reject_prompts=True)
+    handler = make_handler(server)
+    workflow = handler.modify_workflow(handler.upload_image(images(1)[0]), PRODUCT_DATA, "white")
+    with pytest.raises(PromptValidationError, match="failed validation"):
+        handler.queue_prompt(workflow)
+    handler.close()
+
+
+def test_async_client_runs_concurrent_prompts_within_queue_depth(start_server):
+    server = start_server(delay=0.1)
+    async def run():
+        async with AsyncComfyUIClient(server.address, max_queue_depth=2, handler=make_handler(server)) as client:
+            return await client.gather([(image, PRODUCT_DATA) for image in images(6)], concurrency=6)
+
+    results = asyncio.run(run())
+    assert all(isinstance(result, Image.Image) for result in results)
+    assert server.counters["prompts"] == 6
+    assert server.max_queue_depth <= 2
+
+
+def test_async_client_finishes_prompt_after_websocket_reconnect(start_server):
+    server = start_server(delay=0.5)
+    handler = make_handler(server)
+
+    async def run():
+        async with AsyncComfyUIClient(server.address, handler=handler) as client:
+            path = await client.upload_image(images(1)[0])
+            prompt_id = await client.queue_prompt(handler.modify_workflow(path, PRODUCT_DATA, "white"))
+            await asyncio.get_running_loop().run_in_executor(None, server.drop_websockets)
+            waiter = await client.wait_for_completion(prompt_id, timeout=20)
+            return await client.get_result(prompt_id, waiter)
+
+    assert isinstance(asyncio.run(run()), Image.Image)
+    assert server.counters["ws_connections"] >= 2
+
+
+def test_async_client_runs_history_output_node_when_the_image_is_lost(start_server):
+    server = start_server(drop_images=True)
+
+    async def run():
+        async with AsyncComfyUIClient(server.address, handler=make_handler(server)) as client:
+            return await client.generate_enhanced_image(images(1)[0], PRODUCT_DATA)
+
+    assert isinstance(asyncio.run(run()), Image.Image)
+    assert [("76" in workflow) for workflow in server.workflows.values()] == [False, True]
+
+
+def test_async_client_raises_execution_error(start_server):
+    server = start_server(fail_execution=True)
+    handler = make_handler(server)
+
+    async def run():
+        async with AsyncComfyUIClient(server.address, handler=handler) as client:
+            path = await client.upload_image(images(1)[0])
+            prompt_id = await client.queue_prompt(handler.modify_workflow(path, PRODUCT_DATA, "white"))
+            with pytest.raises(PromptExecutionError, match="fake execution error"):
+                await client.wait_for_completion(prompt_id, timeout=10)
+            return await client.generate_enhanced_image(images(1)[0], PRODUCT_DATA)
+
+    assert asyncio.run(run()) is None
+
+
+def test_uploads_are_named_by_content_and_skipped_when_present(start_server):
+    server = start_server()
+    handler = make_handler(server)
+    first, second = images(2)
+    name = handler.upload_image(first)
+    assert name == handler.upload_name(first.copy()) and name.startswith("input_")
+    assert handler.upload_image(first.copy()) == name
+    assert handler.last_upload_stats["skipped"] and handler.last_upload_stats["bytes"] == 0
+    assert handler.upload_image(second) != name
+    handler.close()
+
+    assert server.counters["uploads"] == 2
+
+
+@pytest.mark.parametrize("encoding,extension", [("png", "png"), ("webp_lossless", "webp"), ("original", "jpeg")])
+def test_upload_encodings(start_server, encoding, extension):
+    server = start_server()
+    handler = make_handler(server, upload_encoding=encoding)
+    image = images(1)[0]
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=90)
+    source_bytes = buffer.getvalue()
+    name = handler.upload_image(image, source_bytes=source_bytes)
+    handler.close()
+
+    assert name.endswith("." + extension)
+    assert not handler.last_upload_stats["skipped"] and handler.last_upload_stats["bytes"] == len(server.inputs[name])
+    uploaded = Image.open(io.BytesIO(server.inputs[name]))
+    if encoding == "original":
+        assert server.inputs[name] == source_bytes
+    else:
+        # Both encodings are lossless
+        assert uploaded.format == extension.upper() and uploaded.convert("RGB").tobytes() == image.tobytes()
+
+
+def test_reused_input_is_refreshed_and_kept_by_cleanup(start_server, tmp_path):
+    server = start_server()
+    handler = make_handler(server, input_dir=str(tmp_path), max_input_age_hours=1)
+    image = images(1)[0]
+    reused = tmp_path / handler.upload_name(image)
+    stale = tmp_path / "input_stale.png"
+    for path in (reused, stale):
+        path.write_bytes(b"")
+        os.utime(path, (time.time() - 7200, time.time() - 7200))
+
+    assert handler.upload_image(image) == reused.name
+    handler.close()
+
+    assert server.counters["uploads"] == 0
+    assert time.time() - reused.stat().st_mtime < 60
+    assert handler.cleanup_inputs(force=True) == 1
+    assert reused.exists() and not stale.exists()
+
+
+def test_async_client_raises_validation_error(start_server):
+    server = start_server(reject_prompts=True)
+    handler = make_handler(server)
+
+    async def run():
+        async with AsyncComfyUIClient(server.address, handler=handler) as client:
+            path = await client.upload_image(images(1)[0])
+            with pytest.raises(PromptValidationError, match="failed validation"):
+                await client.queue_prompt(handler.modify_workflow(path, PRODUCT_DATA, "white"))
+
+    asyncio.run(run())
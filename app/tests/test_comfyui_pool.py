@@ -0,0 +1,126 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from PIL import Image
+
+from comfyui import ComfyUIHandler
+from comfyui_pool import ComfyUIPool, PooledJob
+from fake_comfyui import FakeComfyUIServer
+
+WORKFLOW = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "workflow.json")
+PRODUCT_DATA = {"entity_name": "jar"}
+
+
+@pytest.fixture
+def start_servers():
+    servers = []
+
+    def start(*configs):
+        started = [FakeComfyUIServer(**config).start() for config in configs]
+        servers.extend(started)
+        return started
+
+    yield start
+    for server in servers:
+        server.stop()
+
+
+@pytest.fixture
+def make_pool():
+    pools = []
+
+    def make(servers, **kwargs):
+        pool = ComfyUIPool([ComfyUIHandler(server_address=server.address, workflow_path=WORKFLOW,
+                                           color_backend="histogram") for server in servers], **kwargs)
+        pools.append(pool)
+        return pool
+
+    yield make
+    for pool in pools:
+        pool.close()
+
+
+def images(count):
+    return [Image.new("RGB", (64, 64), (40 * index % 256, 120, 60)) for index in range(count)]
+
+
+def run_jobs(pool, count, concurrency=4):
+    with ThreadPoolExecutor(concurrency) as executor:
+        return list(executor.map(lambda image: pool.generate_enhanced_image(image, PRODUCT_DATA), images(count)))
+
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError("Condition not reached")
+        time.sleep(0.05)
+
+
+def test_routes_to_the_shortest_queue(start_servers, make_pool):
+    servers = start_servers({}, {}, {})
+    pool = make_pool(servers, health_interval=60)
+    pool.members[0].queue_depth = 3
+    pool.members[1].queue_depth = 1
+    pool.members[2].queue_depth = 2
+
+    first, second = PooledJob(images(1)[0]), PooledJob(images(1)[0])
+    assert pool.route(first) is pool.members[1]
+    # The reservation of the first job counts until its prompt is queued
+    assert pool.route(second) is pool.members[2]
+    pool.release(first)
+    pool.release(second)
+
+
+def test_faster_server_runs_more_jobs(start_servers, make_pool):
+    fast, slow = start_servers({"delay": 0.1}, {"delay": 1.0})
+    pool = make_pool([fast, slow], health_interval=0.2)
+
+    results = run_jobs(pool, 12)
+
+    assert all(isinstance(result, Image.Image) for result in results)
+    assert fast.counters["prompts"] > slow.counters["prompts"]
+    assert fast.counters["prompts"] + slow.counters["prompts"] == 12
+
+
+def test_jobs_fail_over_from_a_server_rejecting_prompts(start_servers, make_pool):
+    failing, working = start_servers({"fail_prompts": True}, {"delay": 0.1})
+    pool = make_pool([failing, working], health_interval=60)
+
+    results = run_jobs(pool, 6)
+
+    assert all(isinstance(result, Image.Image) for result in results)
+    assert working.counters["prompts"] == 6
+    stats = {item["address"]: item for item in pool.stats()}
+    assert not stats[failing.address]["healthy"] and stats[failing.address]["failovers"] >= 1
+    assert stats[working.address]["healthy"] and stats[working.address]["failovers"] == 0
+
+
+def test_invalid_workflow_does_not_fail_over(start_servers, make_pool):
+    servers = start_servers({"reject_prompts": True}, {"reject_prompts": True})
+    pool = make_pool(servers, health_interval=60)
+
+    assert run_jobs(pool, 2) == [None, None]
+    assert all(item["healthy"] and item["failovers"] == 0 for item in pool.stats())
+
+
+def test_stopped_server_is_marked_down_and_comes_back(start_servers, make_pool):
+    stopped, working = start_servers({"delay": 0.1}, {"delay": 0.1})
+    pool = make_pool([stopped, working], health_interval=0.1, probe_timeout=0.5, max_retry_delay=0.2)
+    port = stopped.port
+    stopped.stop()
+    wait_for(lambda: not pool.stats()[0]["healthy"])
+
+    results = run_jobs(pool, 4)
+    assert all(isinstance(result, Image.Image) for result in results)
+    assert working.counters["prompts"] == 4
+
+    start_servers({"port": port, "delay": 0.1})
+    wait_for(lambda: pool.stats()[0]["healthy"])
+    # A job that cannot go to the other server runs on the restarted one
+    job = PooledJob(images(1)[0])
+    job.failed.add(working.address)
+    assert pool.route(job) is pool.members[0]
+    pool.release(job)
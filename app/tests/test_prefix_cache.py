@@ -0,0 +1,43 @@
+import os
+
+import pytest
+from PIL import Image
+
+from benchmarks.tiny_mllama import tiny_vlm
+from helpers import read_config
+from model import VLMModel
+from stub_models import STUB_ANSWER
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="module")
+def vlm(tmp_path_factory):
+    config = read_config(os.path.join(APP_DIR, "config.yaml"))
+    directory = str(tmp_path_factory.mktemp("tiny_vlm"))
+    tiny_vlm(directory, [config["prompt"], config["en_prompt"], STUB_ANSWER])
+    vlm = VLMModel(model_id=directory, profile="cpu_float")
+    vlm.model.generation_config.do_sample = False
+    return vlm, config
+
+
+@pytest.mark.parametrize("language", ["prompt", "en_prompt"])
+def test_prefix_cache_keeps_greedy_output(vlm, language):
+    vlm, config = vlm
+    instruction = config[language]
+    images = [Image.new("RGB", (160, 120), color) for color in ("white", "red")]
+    prompts = ["\n prompt: 300 ml kırmızı kupa", "\n prompt: 700 gram kuşburnu marmelat"]
+    try:
+        vlm.prefix_cache = False
+        uncached = [vlm.generate(prompt, image, 24, instruction=instruction, assisted="off")
+                    for prompt, image in zip(prompts, images)]
+        vlm.prefix_cache = True
+        # The first call fills the cache, the second reuses it
+        cached = [vlm.generate(prompt, image, 24, instruction=instruction, assisted="off")
+                  for prompt, image in zip(prompts, images)]
+    finally:
+        vlm.prefix_cache = True
+    assert all(vlm.last_generation_stats["new_tokens"])
+    assert cached == uncached
+    # The cached calls did start from the prefix cache
+    assert "past_key_values" in vlm.prepare_inputs(prompts[0], images[0], instruction)[1]
@@ -0,0 +1,92 @@
+import time
+
+import torch
+
+from residency import ResidencyManager, TorchResident
+
+FEATURES = 256
+
+
+def linear():
+    return TorchResident(torch.nn.Linear(FEATURES, FEATURES), "cpu")
+
+
+def footprint_gb(models):
+    return models * (FEATURES * FEATURES + FEATURES) * 4 / 1024**3
+
+
+def manager(policy, names=("a", "b", "c"), **kwargs):
+    residency = ResidencyManager(policy=policy, **kwargs)
+    for name in names:
+        residency.register(name, linear())
+    return residency
+
+
+def loaded(residency):
+    return {name for name in residency.models if residency.is_loaded(name)}
+
+
+def test_always_resident_keeps_models_loaded():
+    residency = manager("always_resident")
+    for name in ("a", "b", "c"):
+        with residency.use(name):
+            pass
+    assert loaded(residency) == {"a", "b", "c"}
+    assert all(stats["offloads"] == 0 for stats in residency.stats().values())
+
+
+def test_on_pressure_offloads_least_recently_used_model():
+    # Room for two of the three models
+    residency = manager("on_pressure", memory_budget_gb=footprint_gb(2.5))
+    for name in ("a", "b", "a"):
+        with residency.use(name):
+            pass
+    assert loaded(residency) == {"a", "b"}
+
+    with residency.use("c"):
+        assert loaded(residency) == {"a", "c"}
+    with residency.use("b"):
+        assert loaded(residency) == {"b", "c"}
+
+
+def test_on_pressure_never_offloads_a_model_in_use():
+    residency = manager("on_pressure", names=("a", "b"), memory_budget_gb=footprint_gb(1.5))
+    with residency.use("a"):
+        with residency.use("b"):
+            # Over budget, but a is busy
+            assert loaded(residency) == {"a", "b"}
+        assert residency.offload("a") is False
+    assert residency.stats()["a"]["offloads"] == 0
+    assert residency.offload("a") is True
+
+
+def test_idle_timeout_offloads_after_idle_seconds():
+    residency = manager("idle_timeout", names=("a",), idle_seconds=0.1)
+    with residency.use("a"):
+        time.sleep(0.3)
+        # The timer only starts once the model is released
+        assert residency.is_loaded("a")
+    assert residency.is_loaded("a")
+    time.sleep(0.4)
+    assert not residency.is_loaded("a")
+
+    # Using the model again before the timeout cancels the pending offload
+    with residency.use("a"):
+        pass
+    time.sleep(0.05)
+    with residency.use("a"):
+        pass
+    assert residency.is_loaded("a")
+    time.sleep(0.4)
+    assert not residency.is_loaded("a")
+
+
+def test_transfer_and_gc_stats_are_recorded():
+    residency = manager("idle_timeout", names=("a",), idle_seconds=0)
+    for _ in range(3):
+        with residency.use("a"):
+            pass
+    stats = residency.stats()["a"]
+    assert stats["loads"] == 3 and stats["offloads"] == 3
+    assert stats["transfer_seconds"] > 0 and stats["gc_seconds"] > 0
+    assert not stats["loaded"] and stats["in_use"] == 0
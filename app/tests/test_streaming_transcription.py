@@ -0,0 +1,79 @@
+import logging
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import numpy as np
+
+from audio_transcriber import SAMPLING_RATE, StreamingTranscription
+
+
+class ScriptedWhisper:
+    """Whisper model returning the given words (start, end, text) in recording time, silence without them."""
+
+    def __init__(self, stream, words=()):
+        self.stream = stream
+        # The text of a word can be a function of the call number, for words heard differently each time
+        self.words = list(words)
+        self.transcribed_samples = []
+
+    def detect_language(self, audio):
+        return "tr", 0.99, []
+
+    def transcribe(self, audio, **kwargs):
+        self.transcribed_samples.append(len(audio))
+        start = self.stream.buffer_offset
+        end = start + len(audio) / SAMPLING_RATE
+        call = len(self.transcribed_samples)
+        words = [SimpleNamespace(start=s - start, end=e - start, word=w(call) if callable(w) else w)
+                 for s, e, w in self.words if s >= start and e <= end]
+        segments = [SimpleNamespace(words=words)] if words else []
+        return segments, SimpleNamespace(language="tr")
+
+
+class Residency:
+    @contextmanager
+    def use(self, name):
+        yield
+
+
+def streaming(window_seconds=15.0, words=()):
+    transcriber = SimpleNamespace(residency=Residency(), logger=logging.getLogger("test"), vad_parameters=None,
+                                  settings={"beam_size": 1, "vad_filter": True})
+    stream = StreamingTranscription(transcriber, min_chunk_seconds=1.0, window_seconds=window_seconds)
+    transcriber.model = ScriptedWhisper(stream, words)
+    return stream, transcriber.model
+
+
+def test_silence_keeps_the_window_bounded():
+    window_seconds = 15.0
+    stream, model = streaming(window_seconds)
+    second = np.zeros(SAMPLING_RATE, dtype=np.float32)
+    for _ in range(180):
+        stream.add_chunk(second)
+        assert len(stream.buffer) <= window_seconds * SAMPLING_RATE
+    # Whisper sees at most the window and the chunk added before the trim
+    assert max(model.transcribed_samples) <= (window_seconds + 1) * SAMPLING_RATE
+    assert stream.buffer_offset > 150
+
+
+def test_unconfirmed_words_are_forced_and_the_rest_of_the_window_kept():
+    # The first word is heard differently on every call, so only the window limit commits it.
+    # The second one comes after the cut and is kept for agreement on the next call.
+    stream, model = streaming(10.0, words=[(0.5, 0.9, lambda call: f" kupa{call}"), (9.8, 10.4, " kırmızı")])
+    second = np.zeros(SAMPLING_RATE, dtype=np.float32)
+    for _ in range(10):
+        stream.add_chunk(second)
+    assert stream.committed == []
+
+    # The 11th second fills the window: the first word is forced and the audio trimmed to the cut
+    stream.add_chunk(second)
+    assert stream.committed == [(0.5, 0.9, " kupa11")]
+    assert stream.buffer_offset == 6.0
+    assert stream.tentative == [(9.8, 10.4, " kırmızı")]
+
+    stream.add_chunk(second)
+    assert stream.committed == [(0.5, 0.9, " kupa11"), (9.8, 10.4, " kırmızı")]
+    for _ in range(30):
+        stream.add_chunk(second)
+        assert len(stream.buffer) <= 10.0 * SAMPLING_RATE
+    assert stream.text(stream.committed) == "kupa11 kırmızı"
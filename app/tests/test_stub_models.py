@@ -0,0 +1,19 @@
+from helpers import ProductInfoStream, load_yaml_data
+from stub_models import STUB_ANSWER, StubVLM
+
+
+def test_stub_answer_is_valid_yaml():
+    # Parsed by YAML, not by the line-based fallback of parse_product_info
+    data = load_yaml_data("```yaml" + STUB_ANSWER)
+    assert isinstance(data, dict)
+    assert data["entity_name"] == "mug"
+    assert data["product_description"].endswith("yıkanabilir. Günlük kullanım için dayanıklıdır.")
+
+
+def test_stub_answer_streams_the_same_fields():
+    stream = ProductInfoStream()
+    fields = {}
+    for token in StubVLM().tokens():
+        fields.update(stream.feed(token))
+    fields.update(stream.finish())
+    assert fields == load_yaml_data("```yaml" + STUB_ANSWER)
@@ -0,0 +1,108 @@
+import os
+import time
+
+import pytest
+from PIL import Image
+
+from fake_comfyui import FakeComfyUIServer
+from stub_models import STUB_ANSWER
+from worker_pool import WorkerPool
+
+WORKFLOW = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "workflow.json")
+IMAGE = Image.new("RGB", (64, 64), (200, 30, 30))
+
+
+@pytest.fixture(scope="module")
+def server():
+    server = FakeComfyUIServer(delay=0.1).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def start_pool(server):
+    pools = []
+
+    def start(processes=2, **stub_models):
+        config = {
+            "comfyui": {"server_address": server.address, "workflow_path": WORKFLOW, "color_backend": "histogram"},
+            "stub_models": dict({"prefill_seconds": 0.05, "token_seconds": 0.005}, **stub_models)
+        }
+        pool = WorkerPool(processes=processes, config=config, registry_factory="stub_models:build_stub_registry").start()
+        pools.append(pool)
+        deadline = time.monotonic() + 60
+        while pool.stats()["ready"] < processes:
+            assert time.monotonic() < deadline, "Workers did not start"
+            time.sleep(0.05)
+        return pool
+
+    yield start
+    for pool in pools:
+        pool.close()
+
+
+def test_job_states_progress_and_results(start_pool):
+    pool = start_pool(processes=1, token_seconds=0.02)
+    first = pool.submit("caption", {"prompt": "kupa", "image": IMAGE}, session_id="a")
+    second = pool.submit("caption", {"prompt": "kupa", "image": IMAGE}, session_id="a")
+    queued = pool.status(second)
+    assert queued["state"] == "queued" and queued["queued_jobs"] == 1
+
+    states, progress = set(), []
+    while True:
+        status = pool.status(first)
+        states.add(status["state"])
+        if status["progress"]:
+            progress.append(status["progress"])
+        if status["state"] == "done":
+            break
+        time.sleep(0.01)
+    assert "running" in states
+    # Partial answers grow until the full one
+    assert len(set(progress)) > 1 and all(STUB_ANSWER.startswith(text) for text in progress)
+    assert status["result"] == STUB_ANSWER and status["worker"] == 0
+    assert status["submitted"] <= status["started"] <= status["finished"]
+
+    assert "".join(pool.stream(second)) == STUB_ANSWER
+    with pytest.raises(KeyError):
+        pool.status(second)
+
+
+def test_enhance_and_failed_jobs(start_pool):
+    pool = start_pool(processes=2)
+    enhance = pool.submit("enhance", {"image": IMAGE, "product_data": {"entity_name": "mug"}})
+    broken = pool.submit("transcribe", {})
+    assert pool.result(enhance, timeout=30).size == IMAGE.size
+    status = pool.wait(broken, timeout=30)
+    assert status["state"] == "failed" and "KeyError" in status["error"]
+    with pytest.raises(ValueError):
+        pool.submit("unknown", {})
+
+
+def test_sessions_take_turns(start_pool):
+    pool = start_pool(processes=1)
+    batch = [pool.submit("caption", {"prompt": "kupa", "image": IMAGE}, session_id="batch") for _ in range(4)]
+    single = pool.submit("caption", {"prompt": "kupa", "image": IMAGE}, session_id="single")
+    statuses = {job_id: pool.wait(job_id, timeout=60) for job_id in batch + [single]}
+
+    # The single job runs after the batch's second one, not behind the whole batch
+    order = sorted(statuses, key=lambda job_id: statuses[job_id]["started"])
+    assert order.index(single) == 2
+    assert all(status["state"] == "done" for status in statuses.values())
+
+
+def test_worker_crash_fails_its_job_and_is_replaced(start_pool):
+    pool = start_pool(processes=1, prefill_seconds=5.0)
+    job_id = pool.submit("caption", {"prompt": "kupa", "image": IMAGE})
+    while pool.status(job_id)["state"] != "running":
+        time.sleep(0.01)
+    pool.workers[0]["process"].kill()
+
+    status = pool.wait(job_id, timeout=30)
+    assert status["state"] == "failed" and "worker exited" in status["error"]
+    # A replacement worker takes the next job
+    deadline = time.monotonic() + 60
+    while pool.stats()["ready"] < 1:
+        assert time.monotonic() < deadline, "Worker was not replaced"
+        time.sleep(0.05)
+    assert pool.workers[0]["process"].is_alive()
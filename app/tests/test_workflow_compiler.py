@@ -0,0 +1,94 @@
+import os
+import json
+
+import pytest
+
+from helpers import read_config
+from model_factories import build_comfy_handler
+from workflow_compiler import WorkflowTemplate, upstream_nodes
+
+# 1 load -> 2 caption -> 3 save, 4 mask -> 5 preview branches off 1, 6 is unconnected
+GRAPH = {
+    "1": {"class_type": "LoadImage", "inputs": {"image": "input.png"}},
+    "2": {"class_type": "Caption", "inputs": {"image": ["1", 0], "text": "product"}},
+    "3": {"class_type": "SaveImage", "inputs": {"images": ["2", 0], "filename_prefix": "out"}},
+    "4": {"class_type": "Mask", "inputs": {"image": ["1", 0], "prompt": "jar"}},
+    "5": {"class_type": "PreviewImage", "inputs": {"images": ["4", 0]}},
+    "6": {"class_type": "Note", "inputs": {"text": "unused"}},
+}
+WORKFLOW = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "workflow.json")
+SLOTS = {"image": ("1", "image"), "caption": ("2", "text"), "mask_prompt": ("4", "prompt"), "source": ("3", "images")}
+
+
+@pytest.fixture
+def workflow_path(tmp_path):
+    path = tmp_path / "workflow.json"
+    path.write_text(json.dumps(GRAPH))
+    return str(path)
+
+
+def test_upstream_nodes_follow_links():
+    assert upstream_nodes(GRAPH, ["3"]) == {"1", "2", "3"}
+    assert upstream_nodes(GRAPH, ["3", "5"]) == {"1", "2", "3", "4", "5"}
+
+
+def test_nodes_outside_the_outputs_are_pruned(workflow_path):
+    template = WorkflowTemplate(workflow_path, outputs=["3"], slots=SLOTS)
+    assert sorted(template.graph, key=int) == ["1", "2", "3"]
+    assert template.pruned == ["4", "5", "6"]
+    # Kept nodes keep their links to each other
+    assert template.graph["3"]["inputs"]["images"] == ["2", 0]
+    assert template.graph["2"]["inputs"]["image"] == ["1", 0]
+
+
+def test_render_patches_slots_and_rewrites_links(workflow_path):
+    template = WorkflowTemplate(workflow_path, outputs=["3"], slots=SLOTS)
+    payload = template.render(image="upload.png", caption="red jar", source=["1", 0], mask_prompt="ignored")
+    assert payload["1"]["inputs"]["image"] == "upload.png"
+    assert payload["2"]["inputs"] == {"image": ["1", 0], "text": "red jar"}
+    # The save node now reads the loaded image directly, the caption node stays in the payload
+    assert payload["3"]["inputs"]["images"] == ["1", 0]
+    # Slots of pruned nodes are skipped
+    assert "4" not in payload
+    # The template is not modified by rendering
+    assert template.graph["3"]["inputs"]["images"] == ["2", 0]
+    assert template.graph["1"]["inputs"]["image"] == "input.png"
+    assert template.render()["2"]["inputs"]["text"] == "product"
+
+
+def test_unknown_slot_raises(workflow_path):
+    template = WorkflowTemplate(workflow_path, outputs=["3"], slots=SLOTS)
+    with pytest.raises(KeyError):
+        template.render(background="white")
+
+
+def test_missing_output_raises(workflow_path):
+    with pytest.raises(KeyError, match="no node 70"):
+        WorkflowTemplate(workflow_path, outputs=["3", "70"], slots=SLOTS)
+
+
+def test_dangling_link_raises(tmp_path):
+    path = tmp_path / "workflow.json"
+    path.write_text(json.dumps(dict(GRAPH, **{"3": {"class_type": "SaveImage", "inputs": {"images": ["9", 0]}}})))
+    with pytest.raises(KeyError, match="no node 9"):
+        WorkflowTemplate(str(path), outputs=["3"], slots=SLOTS)
+
+
+def test_slot_on_missing_input_raises(workflow_path):
+    with pytest.raises(Exception, match="slot 'seed'"):
+        WorkflowTemplate(workflow_path, outputs=["3"], slots=dict(SLOTS, seed=("2", "seed")))
+
+
+def test_shipped_workflow_is_pruned_to_the_configured_output():
+    config = read_config(os.path.join(os.path.dirname(WORKFLOW), "config.yaml"))
+    config["comfyui"]["workflow_path"] = WORKFLOW
+    handler = build_comfy_handler(config)
+    template = handler.load_workflow()
+    handler.close()
+
+    # The PreviewImages, the SaveImage and the separate upscale branch never run with a job
+    assert {"17", "23", "43", "69", "70", "76", "77", "78", "79", "80"} <= set(template.pruned)
+    assert {"15", "41", "54", "51", "75"} <= set(template.graph)
+    assert set(template.graph) | set(template.pruned) == set(template.workflow)
+    # The /history fallback runs the SaveImage alone
+    assert handler.history_nodes == set(template.graph) - {"75"} | {"76"}
@@ -0,0 +1,293 @@
+"""
+Spans and metrics of the pipeline stages, exported as Prometheus text and JSON.
+
+Tracing is off until configure(enabled=True). While it is off, span() returns a shared
+no-op span and observe() and count() return right away, so instrumented code costs a
+function call per stage.
+
+    with tracing.span("comfyui.upload", encoding="png") as span:
+        ...
+        span.set(bytes=len(data))
+    tracing.observe("vlm.prefill", seconds)
+    tracing.count("vlm.new_tokens", 120)
+
+Every span and observe() adds to the pipeline_stage_seconds histogram with the stage
+name and the labels as Prometheus labels, keep them low cardinality. JSON exports also
+carry percentiles over the most recent observations of each series and the most recent
+spans, with their attributes, parent and trace id.
+"""
+import re
+import time
+import uuid
+import json
+import logging
+import threading
+import contextvars
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+logger = logging.getLogger('Tracing')
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+QUANTILES = (50, 95, 99)
+
+_metrics: Optional["Metrics"] = None
+_server: Optional[ThreadingHTTPServer] = None
+_current_span: contextvars.ContextVar = contextvars.ContextVar("current_span", default=None)
+
+
+def _label_key(labels: Dict[str, Any]) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _metric_name(name: str) -> str:
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+def _format_labels(labels: Sequence[Tuple[str, str]]) -> str:
+    if not labels:
+        return ""
+    escaped = (f'{key}="{_escape(value)}"' for key, value in labels)
+    return "{" + ",".join(escaped) + "}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metrics:
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS, reservoir: int = 1024, recent_spans: int = 512):
+        """
+        Args:
+            buckets (list): Upper bounds in seconds of the latency histogram buckets
+            reservoir (int): Recent observations per series kept for the JSON percentiles
+            recent_spans (int): Finished spans kept for the JSON export
+        """
+        self.buckets = tuple(sorted(buckets))
+        self.reservoir = reservoir
+        self.lock = threading.Lock()
+        self.histograms: Dict[Tuple, Dict[str, Any]] = {}
+        self.counters: Dict[Tuple, float] = {}
+        self.spans = deque(maxlen=recent_spans)
+
+    def observe(self, stage: str, seconds: float, labels: Dict[str, Any]) -> None:
+        key = (stage, _label_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = {"buckets": [0] * len(self.buckets), "count": 0, "sum": 0.0,
+                             "recent": deque(maxlen=self.reservoir)}
+                self.histograms[key] = histogram
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram["buckets"][index] += 1
+                    break
+            histogram["count"] += 1
+            histogram["sum"] += seconds
+            histogram["recent"].append(seconds)
+
+    def count(self, name: str, value: float, labels: Dict[str, Any]) -> None:
+        key = (name, _label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def prometheus(self) -> str:
+        """Text exposition format, version 0.0.4."""
+        lines = ["# HELP pipeline_stage_seconds Duration of the pipeline stages",
+                 "# TYPE pipeline_stage_seconds histogram"]
+        with self.lock:
+            histograms = [(key, dict(value, buckets=list(value["buckets"]))) for key, value in self.histograms.items()]
+            counters = list(self.counters.items())
+        for (stage, labels), histogram in sorted(histograms):
+            series = (("stage", stage),) + labels
+            cumulative = 0
+            for bound, count in zip(self.buckets, histogram["buckets"]):
+                cumulative += count
+                lines.append(f"pipeline_stage_seconds_bucket{_format_labels(series + (('le', repr(bound)),))} {cumulative}")
+            lines.append(f"pipeline_stage_seconds_bucket{_format_labels(series + (('le', '+Inf'),))} {histogram['count']}")
+            lines.append(f"pipeline_stage_seconds_sum{_format_labels(series)} {histogram['sum']}")
+            lines.append(f"pipeline_stage_seconds_count{_format_labels(series)} {histogram['count']}")
+        typed = set()
+        for (name, labels), value in sorted(counters):
+            metric = f"pipeline_{_metric_name(name)}_total"
+            if metric not in typed:
+                typed.add(metric)
+                lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self.lock:
+            histograms = [(key, value["count"], value["sum"], sorted(value["recent"]))
+                          for key, value in self.histograms.items()]
+            counters = list(self.counters.items())
+            spans = list(self.spans)
+        stages = {}
+        for (stage, labels), count, total, recent in sorted(histograms):
+            summary = {"labels": dict(labels), "count": count, "sum": total, "mean": total / count if count else 0.0}
+            for quantile in QUANTILES:
+                summary[f"p{quantile}"] = recent[min(len(recent) - 1, int(len(recent) * quantile / 100))] if recent else None
+            stages.setdefault(stage, []).append(summary)
+        totals = {}
+        for (name, labels), value in sorted(counters):
+            totals.setdefault(name, []).append({"labels": dict(labels), "value": value})
+        return {"stages": stages, "counters": totals, "recent_spans": spans}
+
+
+class Span:
+    def __init__(self, metrics: Metrics, name: str, labels: Dict[str, Any]):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.attributes: Dict[str, Any] = {}
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent: Optional["Span"] = None
+        self.trace_id: Optional[str] = None
+        self.start = 0.0
+        self.token = None
+
+    def set(self, **attributes) -> "Span":
+        """Attach values to this span, e.g. sizes or token counts, kept with the recent spans."""
+        self.attributes.update(attributes)
+        return self
+
+    def count(self, name: str, value: float = 1) -> None:
+        """Add to a counter with this span's labels."""
+        self.metrics.count(name, value, self.labels)
+
+    def __enter__(self) -> "Span":
+        self.parent = _current_span.get()
+        self.trace_id = self.parent.trace_id if self.parent is not None else uuid.uuid4().hex[:16]
+        self.token = _current_span.set(self)
+        self.start = time.perf_counter()
+        self.wall_start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> None:
+        seconds = time.perf_counter() - self.start
+        try:
+            _current_span.reset(self.token)
+        except ValueError:
+            # Exited in another context, e.g. a generator closed by a different thread
+            pass
+        self.metrics.observe(self.name, seconds, self.labels)
+        if exc_type is not None:
+            self.metrics.count("stage_errors", 1, dict(self.labels, stage=self.name))
+        self.metrics.spans.append({
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent.span_id if self.parent is not None else None,
+            "start": self.wall_start,
+            "seconds": seconds,
+            "labels": self.labels,
+            "attributes": self.attributes,
+            "error": repr(exc) if exc is not None else None
+        })
+
+
+class _NoopSpan:
+    def set(self, **attributes) -> "_NoopSpan":
+        return self
+
+    def count(self, name: str, value: float = 1) -> None:
+        pass
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> None:
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+def configure(enabled: bool = True, port: Optional[int] = None, host: str = "0.0.0.0",
+              buckets: Optional[Sequence[float]] = None, reservoir: int = 1024, recent_spans: int = 512) -> None:
+    """
+    Turn tracing on or off for this process. Enabling again keeps the collected metrics.
+
+    Args:
+        enabled (bool): Record spans and metrics
+        port (int): Serve /metrics (Prometheus) and /metrics.json on this port, None does not serve
+        host (str): Interface the metrics server listens on
+        buckets (list): Histogram bucket bounds in seconds, DEFAULT_BUCKETS when None
+        reservoir (int): Recent observations per series for the JSON percentiles
+        recent_spans (int): Finished spans kept for the JSON export
+    """
+    global _metrics
+    if not enabled:
+        _metrics = None
+        return
+    if _metrics is None:
+        _metrics = Metrics(buckets or DEFAULT_BUCKETS, reservoir, recent_spans)
+    if port is not None:
+        serve(port, host)
+
+
+def enabled() -> bool:
+    return _metrics is not None
+
+
+def span(name: str, **labels):
+    """Context manager timing a stage, a shared no-op when tracing is off."""
+    metrics = _metrics
+    if metrics is None:
+        return NOOP_SPAN
+    return Span(metrics, name, labels)
+
+
+def observe(stage: str, seconds: float, **labels) -> None:
+    """Record a duration measured elsewhere, e.g. from server events."""
+    metrics = _metrics
+    if metrics is not None:
+        metrics.observe(stage, seconds, labels)
+
+
+def count(name: str, value: float = 1, **labels) -> None:
+    metrics = _metrics
+    if metrics is not None:
+        metrics.count(name, value, labels)
+
+
+def prometheus() -> str:
+    return _metrics.prometheus() if _metrics is not None else ""
+
+
+def to_json() -> str:
+    return json.dumps(_metrics.to_dict() if _metrics is not None else {}, default=str)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            body, content_type = prometheus().encode(), "text/plain; version=0.0.4; charset=utf-8"
+        elif self.path == "/metrics.json":
+            body, content_type = to_json().encode(), "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port: int, host: str = "0.0.0.0") -> Optional[ThreadingHTTPServer]:
+    """Serve the metrics from a background thread, once per process."""
+    global _server
+    if _server is None:
+        try:
+            _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        except OSError as e:
+            logger.error(f"Could not serve metrics on {host}:{port}: {e}")
+            return None
+        threading.Thread(target=_server.serve_forever, name="metrics", daemon=True).start()
+        logger.info(f"Serving metrics on http://{host}:{_server.server_address[1]}/metrics")
+    return _server
@@ -0,0 +1,345 @@
+"""
+Pool of inference worker processes behind a local job queue.
+
+Every worker builds its own model registry (VLM, Whisper, ComfyUI client) and runs one
+job at a time. Jobs carry an id and the session that submitted them. Queued jobs are
+handed to idle workers round-robin over the sessions, so one user's batch cannot starve
+the others. The UI polls status() for the state, partial output and result of a job.
+
+    pool = WorkerPool(processes=2, config=config).start()
+    job_id = pool.submit("caption", {"prompt": prompt, "image": image}, session_id="abc")
+    for text in pool.stream(job_id):
+        ...
+"""
+import io
+import time
+import uuid
+import logging
+import importlib
+import threading
+import multiprocessing
+from multiprocessing.connection import wait as wait_connections
+from collections import OrderedDict, deque
+from typing import Any, Callable, Dict, Iterator, Optional
+
+import tracing
+
+logger = logging.getLogger('WorkerPool')
+
+JOB_STATES = ("queued", "running", "done", "failed")
+
+
+def resolve(path: str) -> Callable:
+    """Function named by 'module:function'."""
+    module, name = path.split(":")
+    return getattr(importlib.import_module(module), name)
+
+
+def run_caption(registry, payload: Dict[str, Any], report: Callable[[Any], None]) -> str:
+    text = ""
+    for chunk in registry.get("vlm").generate_stream(
+        payload["prompt"],
+        payload["image"],
+        max_new_tokens=payload.get("max_new_tokens", 700),
+        instruction=payload.get("instruction"),
+        assisted=payload.get("assisted")
+    ):
+        text += chunk
+        report(text)
+    return text
+
+
+def run_enhance(registry, payload: Dict[str, Any], report: Callable[[Any], None]):
+    return registry.get("comfyui").generate_enhanced_image(
+        payload["image"], payload["product_data"], source_bytes=payload.get("source_bytes"),
+        color_image=payload.get("color_image")
+    )
+
+
+def run_transcribe(registry, payload: Dict[str, Any], report: Callable[[Any], None]):
+    return registry.get("whisper")(io.BytesIO(payload["audio"]))
+
+
+# Job kind -> handler(registry, payload, report), run inside the worker
+JOB_HANDLERS = {
+    "caption": run_caption,
+    "enhance": run_enhance,
+    "transcribe": run_transcribe,
+}
+
+
+def worker_main(worker_id: int, registry_factory: str, config: Dict[str, Any], warm_up, inbox, events,
+                progress_interval: float) -> None:
+    """
+    Entry point of a worker process: build the models, then run jobs from the inbox.
+
+    events is this worker's own pipe to the pool. A shared queue would be left locked
+    for every worker if one of them died while writing to it.
+    """
+    logging.basicConfig(level=logging.INFO, format=f'%(asctime)s - worker {worker_id} - %(name)s - %(levelname)s - %(message)s')
+    tracing_config = dict(config.get("tracing", {}))
+    if tracing_config.get("port") is not None:
+        # Next to the port of the app process, every worker serves its own metrics
+        tracing_config["port"] += 1 + worker_id
+    tracing.configure(**tracing_config)
+    registry = resolve(registry_factory)(config, warm_up=warm_up)
+    events.send(("ready", None, None))
+    while True:
+        job = inbox.get()
+        if job is None:
+            break
+        job_id, kind, payload = job
+        last_report = [0.0]
+
+        def report(progress):
+            now = time.monotonic()
+            if now - last_report[0] >= progress_interval:
+                last_report[0] = now
+                events.send(("progress", job_id, progress))
+
+        try:
+            result = JOB_HANDLERS[kind](registry, payload, report)
+            events.send(("done", job_id, result))
+        except Exception as e:
+            logger.exception(f"Job {job_id} failed")
+            events.send(("failed", job_id, f"{type(e).__name__}: {e}"))
+
+
+class WorkerPool:
+    def __init__(self, processes: int = 2, config: Optional[Dict[str, Any]] = None,
+                 registry_factory: str = "model_factories:build_registry", warm_up=None,
+                 start_method: str = "spawn", progress_interval: float = 0.05, max_finished_jobs: int = 1000):
+        """
+        Args:
+            processes (int): Number of worker processes, each loads its own models
+            config (dict): Parsed config.yaml passed to the registry factory
+            registry_factory (str): 'module:function' building a ModelRegistry from
+                (config, warm_up=...), e.g. 'stub_models:build_stub_registry' for tests
+            warm_up (list): Models every worker loads before taking jobs, startup.warm_up by default
+            start_method (str): multiprocessing start method, spawn is the one safe with CUDA
+            progress_interval (float): Minimum seconds between progress updates of a job
+            max_finished_jobs (int): Finished jobs kept for polling before the oldest are dropped
+        """
+        self.processes = processes
+        self.config = config or {}
+        self.registry_factory = registry_factory
+        self.warm_up = warm_up
+        self.context = multiprocessing.get_context(start_method)
+        self.progress_interval = progress_interval
+        self.max_finished_jobs = max_finished_jobs
+
+        self.lock = threading.Lock()
+        self.jobs: Dict[str, Dict[str, Any]] = {}
+        self.finished: "OrderedDict[str, None]" = OrderedDict()
+        # Queued job ids per session, served round-robin
+        self.sessions: "OrderedDict[str, deque]" = OrderedDict()
+        self.workers: Dict[int, Dict[str, Any]] = {}
+        self.collector: Optional[threading.Thread] = None
+        self.closed = False
+
+    def start(self) -> "WorkerPool":
+        if self.collector is not None:
+            return self
+        for worker_id in range(self.processes):
+            self._spawn(worker_id)
+        self.collector = threading.Thread(target=self._collect, name="worker-pool-collector", daemon=True)
+        self.collector.start()
+        return self
+
+    def submit(self, kind: str, payload: Dict[str, Any], session_id: str = "default") -> str:
+        """Queue a job and return its id. payload must be picklable."""
+        if kind not in JOB_HANDLERS:
+            raise ValueError(f"Unknown job kind '{kind}', expected one of {tuple(JOB_HANDLERS)}")
+        job_id = uuid.uuid4().hex
+        with self.lock:
+            self.jobs[job_id] = {
+                "id": job_id,
+                "kind": kind,
+                "session_id": session_id,
+                "payload": payload,
+                "state": "queued",
+                "progress": None,
+                "result": None,
+                "error": None,
+                "worker": None,
+                "submitted": time.time(),
+                "started": None,
+                "finished": None,
+            }
+            self.sessions.setdefault(session_id, deque()).append(job_id)
+            self._dispatch()
+        return job_id
+
+    def status(self, job_id: str) -> Dict[str, Any]:
+        """State, latest progress, result or error and timestamps of a job."""
+        with self.lock:
+            job = self.jobs[job_id]
+            status = {key: value for key, value in job.items() if key != "payload"}
+            if job["state"] == "queued":
+                status["queued_jobs"] = sum(len(jobs) for jobs in self.sessions.values())
+            return status
+
+    def wait(self, job_id: str, timeout: Optional[float] = None, poll_interval: float = 0.05) -> Dict[str, Any]:
+        """Poll until the job has finished and return its status."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            status = self.status(job_id)
+            if status["state"] in ("done", "failed"):
+                return status
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError(f"Job {job_id} did not finish in {timeout}s")
+            time.sleep(poll_interval)
+
+    def result(self, job_id: str, timeout: Optional[float] = None) -> Any:
+        """Wait for the job, return its result and forget it. Raises if the job failed."""
+        status = self.wait(job_id, timeout)
+        self.pop(job_id)
+        if status["state"] == "failed":
+            raise RuntimeError(f"Job {job_id} failed: {status['error']}")
+        return status["result"]
+
+    def stream(self, job_id: str, poll_interval: float = 0.1) -> Iterator[str]:
+        """Yield the new text of a caption job as it grows, like VLMModel.generate_stream."""
+        sent = ""
+        while True:
+            status = self.status(job_id)
+            text = status["result"] if status["state"] == "done" else status["progress"]
+            if text and len(text) > len(sent):
+                yield text[len(sent):]
+                sent = text
+            if status["state"] == "failed":
+                self.pop(job_id)
+                raise RuntimeError(f"Job {job_id} failed: {status['error']}")
+            if status["state"] == "done":
+                self.pop(job_id)
+                return
+            time.sleep(poll_interval)
+
+    def pop(self, job_id: str) -> None:
+        with self.lock:
+            self.jobs.pop(job_id, None)
+            self.finished.pop(job_id, None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "workers": self.processes,
+                "ready": sum(1 for w in self.workers.values() if w["ready"]),
+                "busy": sum(1 for w in self.workers.values() if w["job"] is not None),
+                "queued": sum(len(jobs) for jobs in self.sessions.values()),
+                "sessions": len(self.sessions),
+            }
+
+    def close(self, timeout: float = 5) -> None:
+        self.closed = True
+        for worker in self.workers.values():
+            worker["inbox"].put(None)
+        for worker in self.workers.values():
+            worker["process"].join(timeout)
+            if worker["process"].is_alive():
+                worker["process"].terminate()
+
+    def _spawn(self, worker_id: int) -> None:
+        inbox = self.context.Queue()
+        events, events_writer = self.context.Pipe(duplex=False)
+        process = self.context.Process(
+            target=worker_main,
+            args=(worker_id, self.registry_factory, self.config, self.warm_up, inbox, events_writer, self.progress_interval),
+            name=f"inference-worker-{worker_id}",
+            daemon=True
+        )
+        process.start()
+        # Only the worker holds the writing end, so its exit shows up as EOF here
+        events_writer.close()
+        failures = self.workers.get(worker_id, {}).get("failures", 0)
+        self.workers[worker_id] = {"process": process, "inbox": inbox, "events": events, "job": None,
+                                   "ready": False, "failures": failures}
+
+    def _dispatch(self) -> None:
+        """Hand queued jobs to idle workers, one session after the other. Called with the lock held."""
+        for worker_id, worker in self.workers.items():
+            if not worker["ready"] or worker["job"] is not None:
+                continue
+            if not self.sessions:
+                return
+            session_id, jobs = next(iter(self.sessions.items()))
+            job_id = jobs.popleft()
+            # The session goes to the back of the line, or away when it has nothing queued
+            del self.sessions[session_id]
+            if jobs:
+                self.sessions[session_id] = jobs
+            job = self.jobs[job_id]
+            job.update(state="running", worker=worker_id, started=time.time())
+            worker["job"] = job_id
+            worker["inbox"].put((job_id, job["kind"], job.pop("payload")))
+
+    def _finish(self, job_id: str, state: str, result: Any = None, error: Optional[str] = None) -> None:
+        job = self.jobs.get(job_id)
+        if job is None:
+            return
+        job.update(state=state, result=result, error=error, finished=time.time())
+        self.finished[job_id] = None
+        while len(self.finished) > self.max_finished_jobs:
+            self.jobs.pop(self.finished.popitem(last=False)[0], None)
+
+    def _collect(self) -> None:
+        while not self.closed:
+            with self.lock:
+                connections = {w["events"]: worker_id for worker_id, w in self.workers.items() if w["events"] is not None}
+            if not connections:
+                time.sleep(0.5)
+            for connection in wait_connections(list(connections), timeout=0.5):
+                worker_id = connections[connection]
+                try:
+                    event, job_id, data = connection.recv()
+                except (EOFError, OSError):
+                    # The worker exited, _check_workers fails its job and replaces it
+                    with self.lock:
+                        self.workers[worker_id]["events"] = None
+                    self.workers[worker_id]["process"].join(5)
+                    continue
+                with self.lock:
+                    worker = self.workers[worker_id]
+                    if event == "ready":
+                        worker["ready"] = True
+                        worker["failures"] = 0
+                        logger.info(f"Worker {worker_id} is ready")
+                    elif event == "progress":
+                        if job_id in self.jobs:
+                            self.jobs[job_id]["progress"] = data
+                    elif event in ("done", "failed"):
+                        worker["job"] = None
+                        if event == "done":
+                            self._finish(job_id, "done", result=data)
+                        else:
+                            self._finish(job_id, "failed", error=data)
+                    self._dispatch()
+            self._check_workers()
+
+    def _check_workers(self, max_startup_failures: int = 3) -> None:
+        """
+        Fail the job of a worker that died and start a replacement. A worker that keeps
+        dying before it is ready (missing model, out of memory) is given up on, and once
+        no worker is left the queued jobs are failed instead of waiting forever.
+        """
+        with self.lock:
+            for worker_id, worker in list(self.workers.items()):
+                if self.closed or worker["process"].is_alive():
+                    continue
+                exitcode = worker["process"].exitcode
+                if worker["job"] is not None:
+                    self._finish(worker["job"], "failed", error=f"worker exited with code {exitcode}")
+                if not worker["ready"]:
+                    worker["failures"] += 1
+                if worker["failures"] >= max_startup_failures:
+                    logger.error(f"Worker {worker_id} failed to start {worker['failures']} times, giving up on it")
+                    del self.workers[worker_id]
+                    continue
+                logger.error(f"Worker {worker_id} exited with code {exitcode}, restarting it")
+                self._spawn(worker_id)
+            if not self.workers:
+                for jobs in self.sessions.values():
+                    for job_id in jobs:
+                        self._finish(job_id, "failed", error="no inference worker could be started")
+                self.sessions.clear()
+
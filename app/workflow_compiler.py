@@ -0,0 +1,82 @@
+import json
+import logging
+from typing import Dict, Any, Iterable, Optional, Set, Tuple
+
+logger = logging.getLogger('ComfyUI')
+
+# Named parameters of workflow.json: slot name -> (node id, input name)
+DEFAULT_SLOTS = {
+    "image": ("15", "image"),
+    "grounding_prompt": ("41", "prompt"),
+    "positive_prompt": ("54", "text"),
+}
+
+
+def upstream_nodes(graph: Dict[str, Any], outputs: Iterable[str]) -> Set[str]:
+    """Ids of the output nodes and every node they depend on."""
+    keep = set()
+    stack = list(outputs)
+    while stack:
+        node_id = stack.pop()
+        if node_id in keep:
+            continue
+        if node_id not in graph:
+            raise KeyError(f"Workflow has no node {node_id}")
+        keep.add(node_id)
+        for value in graph[node_id].get("inputs", {}).values():
+            # Links to other nodes are [node_id, output_index] pairs
+            if isinstance(value, list) and len(value) == 2 and isinstance(value[0], str):
+                stack.append(value[0])
+    return keep
+
+
+class WorkflowTemplate:
+    def __init__(self, workflow_path: str, outputs: Iterable[str],
+                 slots: Optional[Dict[str, Tuple[str, str]]] = None):
+        """
+        Workflow loaded once and pruned to the nodes that feed the requested outputs.
+
+        Args:
+            workflow_path (str): ComfyUI API format workflow JSON
+            outputs (list): Ids of the output nodes whose results are read
+            slots (dict): Named parameters, slot name -> (node id, input name)
+        """
+        self.workflow_path = workflow_path
+        self.outputs = tuple(outputs)
+        self.slots = dict(slots or DEFAULT_SLOTS)
+        try:
+            with open(workflow_path, 'r') as file:
+                self.workflow = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError) as e:
+            logger.error(f"Error loading workflow: {e}")
+            raise Exception(f"Error loading workflow: {e}")
+
+        keep = upstream_nodes(self.workflow, self.outputs)
+        self.graph = {node_id: node for node_id, node in self.workflow.items() if node_id in keep}
+        self.pruned = sorted(set(self.workflow) - keep, key=int)
+        logger.info(f"Compiled workflow with {len(self.graph)} nodes, pruned {self.pruned}")
+
+        for name, (node_id, input_name) in self.slots.items():
+            if node_id not in self.workflow or input_name not in self.workflow[node_id].get("inputs", {}):
+                raise Exception(f"Workflow structure mismatch: slot '{name}' points to missing {node_id}.{input_name}")
+
+    def render(self, **params) -> Dict[str, Any]:
+        """
+        Build the prompt payload with the given slot values.
+
+        Nodes are shared with the template, only the patched nodes are copied, so the
+        template itself is never modified.
+        """
+        graph = dict(self.graph)
+        for name, value in params.items():
+            if name not in self.slots:
+                raise KeyError(f"Unknown workflow slot '{name}'")
+            node_id, input_name = self.slots[name]
+            if node_id not in graph:
+                logger.debug(f"Slot '{name}' feeds pruned node {node_id}, skipping")
+                continue
+            node = dict(graph[node_id])
+            node["inputs"] = dict(node["inputs"], **{input_name: value})
+            graph[node_id] = node
+        return graph
+